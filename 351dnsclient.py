@@ -4,16 +4,18 @@ Project 4
 Chris Grace (ctg2887)
 Sam Hedin (sph3971)
 """
-import itertools
+import json
 import sys
+import time
 from argparse import ArgumentParser
 
-import crypto
 import util
 from DNSPacket import DNSPacket
-from network import UDPCommunication
+from network import UpstreamPool
 from records.Record import print_record
+from stub_resolver import serve
 from util import dprint
+from validator import INVALID_RRSIG, NORESPONSE, NOTFOUND, RECORD_TYPES, VALID, Validator
 
 DEFAULT_PORT = 53
 
@@ -24,267 +26,167 @@ def getArgumentDict():
     :return: A dictionary containing the command line arguments
     """
     ap = ArgumentParser()
-    ap.add_argument('server', help='\"@server:port\" - address of the dns server')
-    ap.add_argument('domain-name', help='Domain name to query for')
-    ap.add_argument('record', help='Type of record you are requesting (A, DNSKEY, or DS)')
+    ap.add_argument('server', help='\"@server:port\" - address of the dns server. Several can be given, separated '
+                                   'by commas, and each query goes to the fastest one which is up')
+    ap.add_argument('domain-name', nargs='?', help='Domain name to query for')
+    ap.add_argument('record', nargs='?', help='Type of record you are requesting (A, DNSKEY, or DS)')
     ap.add_argument('--debug', help='Include printing for debugging', action='store_true')
+    ap.add_argument('--cache-file', help='File to keep validated zone keys in between runs')
+    ap.add_argument('--batch', metavar='FILE',
+                    help='Validate every "name type" line in FILE instead of a single name. "-" reads stdin')
+    ap.add_argument('--format', choices=['jsonl', 'tsv'], default='jsonl', help='Output format for --batch')
+    ap.add_argument('--serve', metavar='[HOST:]PORT',
+                    help='Run as a local validating resolver listening on HOST:PORT (127.0.0.1 by default)')
+    ap.add_argument('--workers', type=int, default=1,
+                    help='Number of processes to serve from with --serve. They share one port and validated zones')
+    ap.add_argument('--hedge', action='store_true',
+                    help='With several servers, send queries which are slower than usual to a second server as well')
     args = ap.parse_args()
+    if args.batch is None and args.serve is None and args.record is None:
+        ap.error("domain-name and record are required unless --batch or --serve is given")
     # vars(..) will return the dict the namespace is using
     return vars(args)
 
 
-def parse_server(addr):
+def parse_server(addr, hedge=False):
     """
     Pasers the server information from the command line
-    :param addr: The address string to parse
-    :return: The resolver address as a tuple
+    :param addr: The address string to parse, "@server[:port]" or "@server[:port],server[:port],..."
+    :param hedge: Whether a pool of servers should hedge slow queries
+    :return: The resolver address as a tuple, or an UpstreamPool when several are given
     """
     if addr[0] != '@':
         print("ERROR\tServer must start with \"@\" symbol!")
         sys.exit(0)
-    split_addr = addr.split(':')
-    ip = split_addr[0][1:]
-    port = split_addr[1] if len(split_addr) > 1 else DEFAULT_PORT
-    return ip, port
+    addresses = []
+    for server in addr[1:].split(','):
+        split_addr = server.split(':')
+        port = int(split_addr[1]) if len(split_addr) > 1 else DEFAULT_PORT
+        addresses.append((split_addr[0], port))
+    if len(addresses) == 1:
+        return addresses[0]
+    return UpstreamPool(addresses, hedge)
 
 
-def main():
-    # Handle arguments
-    args = getArgumentDict()
-    domain_name = args['domain-name']
-
-    resolver_address = parse_server(args['server'])
-
-    record = args['record']
-    if record not in ["A", "DNSKEY", "DS"]:
-        print("ERROR\t" + str(record) + " NOT SUPPORTED")
-        sys.exit(1)
-
-    if args['debug']:
-        util.debug_print_enabled = True
-
-    connection = UDPCommunication()
-
-    query_type = DNSPacket.RR_TYPE_A
-    if record == "DNSKEY":
-        query_type = DNSPacket.RR_TYPE_DNSKEY
-    elif record == "DS":
-        query_type = DNSPacket.RR_TYPE_DS
-
-    split_domain = domain_name.split('.')
-    parent_domain = '.'.join(split_domain[1:])
-
-    # Regardless of query type, we need to verify the chain of trust
-    if not verify_zone(domain_name, connection, resolver_address):
-        print("ERROR\tMISSING-DS")
-        sys.exit(1)
-
-    if query_type == DNSPacket.RR_TYPE_A:
-        dprint("\n\n\nGetting A Record:")
-        arecord_response = get_packet(connection, domain_name, resolver_address, DNSPacket.RR_TYPE_A)
-        arecord_response.print()
-        arecord_response.dump()
-        rr_set = get_rrset(arecord_response, error_if_empty="ERROR\tMISSING-A")
-        rrsig_set = get_rrsigs(arecord_response, error_if_empty="ERROR\tMISSING-RRSIG")
-        dnskey_response = get_packet(connection, domain_name, resolver_address, DNSPacket.RR_TYPE_DNSKEY)
-
-        keys = get_keys(dnskey_response, error_if_empty="ERROR\tMISSING-DNSKEY")
-        key_rrsig_set = get_rrsigs(arecord_response, error_if_empty="ERROR\tMISSING-RRSIG")
-        if validate_RRSET(keys, key_rrsig_set, rr_set, domain_name) is None:
-            print("ERROR\tINVALID-RRSIG")
-            sys.exit(1)
-
-        associated_rrsig = validate_RRSET(keys, rrsig_set, rr_set, domain_name)
-        if associated_rrsig is not None:
-            for record in rr_set:
-                print_record(record, associated_rrsig, True)
-        else:
-            for record in rr_set:
-                print_record(record, associated_rrsig, False)
-            print("ERROR\tINVALID-RRSIG")
-            sys.exit(1)
-
-    elif query_type == DNSPacket.RR_TYPE_DNSKEY:
-        dprint("\n\n\nGetting Keys:")
-        dnskey_response = get_packet(connection, domain_name, resolver_address, DNSPacket.RR_TYPE_DNSKEY)
-        dprint("\nDNSKEY Record Response packet:")
-        dnskey_response.dump()
-        keys = get_keys(dnskey_response, error_if_empty="ERROR\tMISSING-DNSKEY")
-        rrsig_set = get_rrsigs(dnskey_response, error_if_empty="ERROR\tMISSING-RRSIG")
-        rr_set = get_rrset(dnskey_response)
-
-        associated_rrsig = validate_RRSET(keys, rrsig_set, rr_set, domain_name)
-        if associated_rrsig is not None:
-            for record in rr_set:
-                print_record(record, associated_rrsig, True)
-        else:
-            for record in rr_set:
-                print_record(record, associated_rrsig, False)
-            print("ERROR\tINVALID-RRSIG")
-            sys.exit(1)
-
-    elif query_type == DNSPacket.RR_TYPE_DS:
-        dprint("\n\n\nGetting DS records")
-        ds_response = get_packet(connection, domain_name, resolver_address, DNSPacket.RR_TYPE_DS)
-        ds_response.dump()
-        ds_rr_set = get_rrset(ds_response, error_if_empty="ERROR\tMISSING-DS")
-        ds_rrsig_set = get_rrsigs(ds_response, error_if_empty="ERROR\tMISSING-RRSIG")
-
-        dnskey_response = get_packet(connection, parent_domain, resolver_address, DNSPacket.RR_TYPE_DNSKEY)
-        dprint("\nDNSKEY Record Response packet:")
-        keys = get_keys(dnskey_response, error_if_empty="ERROR\tMISSING-DNSKEY")
-
-        associated_rrsig = validate_RRSET(keys, ds_rrsig_set, ds_rr_set, domain_name)
-        for ds_record in ds_rr_set:
-            if associated_rrsig is not None:
-                print_record(ds_record, associated_rrsig, True)
-            else:
-                print_record(ds_record, associated_rrsig, False)
-
-
-def get_packet(connection, domain_name, resolver_address, type):
+def parse_listen(addr):
     """
-    Requests a packet from domain_name and returns it
-    :param connection: A UDPConnection to use
-    :param domain_name: The domain name to request
-    :param resolver_address: The resolver addresss
-    :param type: The type of packet being requested
-    :return: The packet
+    Parses the address to listen on when running as a resolver
+    :param addr: "host:port", or just "port"
+    :return: The listen address as a tuple
     """
-    query = DNSPacket.newQuery(domain_name, type, using_dnssec=True)
-    connection.sendPacket(resolver_address, query)
-    return connection.waitForPacket()
+    host, _, port = addr.rpartition(':')
+    return host or '127.0.0.1', int(port)
 
 
-def get_keys(dnskey_response, error_if_empty="="):
-    """
-    Pulls DNSKEYs out of a response packet
-    :param response: A DNS response
-    :param error_if_empty: The error to print if no non RRSIG records are found
-    :return: A list of DNSKEY records
-    """
-    keys = []
-    for answer in dnskey_response.answers:
-        if answer.type == DNSPacket.RR_TYPE_DNSKEY:
-            keys.append(answer)
-    if error_if_empty != "" and len(keys) == 0:
-        print(error_if_empty)
-        sys.exit(1)
-    return keys
+# Statuses which are printed without the "ERROR" prefix
+PLAIN_STATUSES = (NOTFOUND, NORESPONSE)
 
 
-def get_rrsigs(response, error_if_empty=""):
+def read_batch(lines):
     """
-    Pulls out the RRSIGs from a response packet
-    :param response: A DNS response
-    :param error_if_empty: The error to print if no non RRSIG records are found
-    :return: A list of RRSIG records
+    Parses batch input, one "name type" pair per line. Blank lines and lines starting with # are skipped
+    :param lines: An iterable of lines
+    :return: A generator of (name, record type name) tuples. The type is None when the line is malformed
     """
-    rrsig_set = []
-    for answer in response.answers:
-        if answer.type == DNSPacket.RR_TYPE_RRSIG:
-            rrsig_set.append(answer)
-    if error_if_empty != "" and len(rrsig_set) == 0:
-        print(error_if_empty)
-        sys.exit(1)
-    return rrsig_set
-
-
-def get_rrset(response, error_if_empty=""):
-    """
-    Pulls out the RRSET which was signed from a response packet
-    :param response: A DNS response
-    :param error_if_empty: The error to print if no non RRSIG records are found
-    :return: The RRSET
-    """
-    rr_set = []
-    for answer in response.answers:
-        if answer.type != DNSPacket.RR_TYPE_RRSIG:
-            rr_set.append(answer)
-    if error_if_empty != "" and len(rr_set) == 0:
-        print(error_if_empty)
-        sys.exit(1)
-    return rr_set
+    for line in lines:
+        fields = line.split()
+        if len(fields) == 0 or fields[0].startswith('#'):
+            continue
+        if len(fields) != 2:
+            yield line.strip(), None
+        else:
+            yield fields[0], fields[1].upper()
 
 
-def validate_RRSET(keys, rrsig_set, rr_set, domain_name):
+def format_result(name, record, status, rr_set, output_format):
     """
-    Validates the signature on an RRset
-    :param keys: The DNSKEYS to check with
-    :param rrsig_set: A set of RRSIGs to check
+    Formats the result of one batch lookup as a line of output
+    :param name: The domain name
+    :param record: The record type name
+    :param status: The lookup status
     :param rr_set: The RRset
-    :param domain_name: The domain name of the RRset
-    :return: The RRSIG record that verified
-    """
-    for sig in rrsig_set:
-        if sig.algorithm != DNSPacket.ALGO_TYPE_RSASHA256:
-            dprint("ERROR\tUNKNOWN ALGORITHM", sig.algorithm)
-            return None
-        for set_ordering in itertools.permutations(rr_set, len(rr_set)):
-            rrset_data = crypto.createRRSetData(set_ordering, sig, domain_name)
-            for key in keys:
-                if crypto.verify_signature(sig.signature, key, rrset_data):
-                    return sig
-    return None
-
+    :param output_format: 'jsonl' or 'tsv'
+    :return: The line, without a trailing newline
+    """
+    if output_format == 'tsv':
+        return "\t".join([name, str(record), status, str(len(rr_set))])
+    return json.dumps({'name': name, 'type': record, 'status': status, 'records': [str(rr) for rr in rr_set]})
+
+
+def run_batch(lines, out, output_format, validator):
+    """
+    Validates every name in a batch with one Validator, so the socket and caches are shared between them.
+    A name that fails only affects its own line of output
+    :param lines: An iterable of "name type" lines
+    :param out: File to write results to, one line per name
+    :param output_format: 'jsonl' or 'tsv'
+    :param validator: The Validator
+    :return: Tuple of (number of names, number which validated)
+    """
+    count = 0
+    valid = 0
+    for name, record in read_batch(lines):
+        rr_set = []
+        if record is None:
+            status = 'BAD-INPUT'
+        else:
+            try:
+                result = validator.validate(name, record)
+                status, rr_set = result.status, result.rr_set
+            except Exception as error:
+                # Malformed responses and the like. Report them and carry on with the next name
+                dprint("Lookup of {0} failed: {1!r}".format(name, error))
+                status = 'ERROR'
+        count += 1
+        valid += status == VALID
+        out.write(format_result(name, record, status, rr_set, output_format) + "\n")
+        out.flush()
+    return count, valid
 
-def verify_zone(domain_name, connection, resolver_address):
-    """
-    Attempts to verify the public key of the given zone by establishing PKI from root
-    :param domain_name: The domain name to begin at
-    :param connection: A UDP connection object to use
-    :param resolver_address: The address of the resolver
-    :return: True if zone verified, false otherwise
-    """
-    split_domain = domain_name.split('.')
-    for i in range(len(split_domain)):
-        cur_domain = '.'.join(split_domain[i:])
-        parent_domain = '.'.join(split_domain[i + 1:])
-        dprint("\n\nVerifying {0} key using {1}".format(cur_domain, parent_domain))
 
-        # Fetch DS records
-        query = DNSPacket.newQuery(cur_domain, DNSPacket.RR_TYPE_DS, using_dnssec=True)
-        connection.sendPacket(resolver_address, query)
-        ds_response = connection.waitForPacket()
+def main():
+    # Handle arguments
+    args = getArgumentDict()
+    resolver_address = parse_server(args['server'], args['hedge'])
 
-        # Pull DS records out from the response
-        ds_records = []
-        for answer in ds_response.answers:
-            if answer.type == DNSPacket.RR_TYPE_DS:
-                ds_records.append(answer)
-        if len(ds_records) == 0:
-            return False
-        dprint("\nFound {0} ds records".format(len(ds_records)))
+    if args['debug']:
+        util.debug_print_enabled = True
 
-        # Fetch DNSKEY records
-        query = DNSPacket.newQuery(cur_domain, DNSPacket.RR_TYPE_DNSKEY, using_dnssec=True)
-        connection.sendPacket(resolver_address, query)
-        dnskey_response = connection.waitForPacket()
+    if args['serve']:
+        serve(resolver_address, parse_listen(args['serve']), args['cache_file'], args['workers'])
+        return
 
-        # Pull keys from the response
-        keys = get_keys(dnskey_response)
-        if len(keys) == 0:
-            return False
-        dprint("\nFound {0} keys".format(len(keys)))
+    if not args['batch'] and args['record'] not in RECORD_TYPES:
+        print("ERROR\t" + str(args['record']) + " NOT SUPPORTED")
+        sys.exit(1)
 
-        # Try to validate a key, any key
-        key_validated = False
-        for ds_record in ds_records:
-            for key in keys:
-                ds_digest = ds_record.digest
-                key_hashed = crypto.createDSRecord(key, cur_domain)
-                dprint("\nDS hash: ", ds_digest)
-                dprint("DNSKEY hash:", key_hashed)
-                if ds_digest == key_hashed:
-                    dprint("MATCH WOOHOO")
-                    key_validated = True
-                    break
-            if key_validated:
-                break
-        else:
-            dprint("ERROR: Unable to validate any DNSKEY with parent zone")
-            return False
-    return True
+    with Validator(resolver_address, cache_file=args['cache_file']) as validator:
+        if args['batch']:
+            start = time.perf_counter()
+            if args['batch'] == '-':
+                count, valid = run_batch(sys.stdin, sys.stdout, args['format'], validator)
+            else:
+                with open(args['batch']) as lines:
+                    count, valid = run_batch(lines, sys.stdout, args['format'], validator)
+            elapsed = time.perf_counter() - start
+            print("{0} names, {1} valid, in {2:.2f}s ({3:.1f} names/s)".format(
+                count, valid, elapsed, count / elapsed if elapsed > 0 else 0), file=sys.stderr)
+            validator.save()
+            return
+
+        result = validator.validate(args['domain-name'], args['record'])
+        validator.save()
+
+    for rr in result.rr_set:
+        print_record(rr, result.rrsig, result.valid)
+    # An invalid DS set is still printed, just marked INVALID
+    if result.valid or (result.status == INVALID_RRSIG and result.type == DNSPacket.RR_TYPE_DS):
+        return
+    if result.status in PLAIN_STATUSES:
+        print(result.status)
+    else:
+        print("ERROR\t" + result.status)
+    sys.exit(0 if result.status == NOTFOUND else 1)
 
 
 if __name__ == '__main__':
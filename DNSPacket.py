@@ -2,10 +2,20 @@
 Represents a DNS packet. Will build a query to send to server, or parse through a server's response.
 """
 
+import random
+
 import records.Record
+from domain_name import DomainName
 from records.Record import parse_record
 from util import *
 
+HEADER_STRUCT = struct.Struct('!HHHHHH')
+QUESTION_TYPE_STRUCT = struct.Struct('!H')
+QUESTION_TAIL_STRUCT = struct.Struct('!HH')
+
+# Query IDs are the only thing stopping off-path spoofing, so they come from the OS random source
+_id_random = random.SystemRandom()
+
 RCODE = {0: 'No error. The request completed successfully.',
          1: 'Format error. The name server was unable to interpret the query.',
          2: 'Server failure. The name server was unable to process this query due to a problem with the name server.',
@@ -28,6 +38,20 @@ RCODE = {0: 'No error. The request completed successfully.',
          16: 'BADALG. Algorithm not supported.',
          17: 'BADTRUNC. Bad truncation.'}
 
+# Short codes for the response codes a lookup can end with. Any other code is reported as "RCODE-<n>"
+RCODE_STATUS = {1: 'FORMERR', 2: 'SERVFAIL', 3: 'NOTFOUND', 4: 'NOTIMP', 5: 'REFUSED'}
+
+
+class DNSError(Exception):
+    """
+    A query which can't be answered, like a name that doesn't exist or a resolver that never replies.
+    status is the short code the client reports it with (EX: 'NOTFOUND')
+    """
+
+    def __init__(self, status, message=None):
+        Exception.__init__(self, message or status)
+        self.status = status
+
 
 class DNSPacket:
     RR_TYPE_A = 1
@@ -44,26 +68,59 @@ class DNSPacket:
 
     # https://www.iana.org/assignments/dns-sec-alg-numbers/dns-sec-alg-numbers.xhtml
     ALGO_TYPE_RSASHA1 = 5
+    ALGO_TYPE_RSASHA1_NSEC3_SHA1 = 7
     ALGO_TYPE_RSASHA256 = 8
+    ALGO_TYPE_RSASHA512 = 10
+    ALGO_TYPE_ECDSAP256SHA256 = 13
+    ALGO_TYPE_ECDSAP384SHA384 = 14
+    ALGO_TYPE_ED25519 = 15
 
     HEADER_LEN = 12
 
+    MAX_ID = 0xFFFF
+    # UDP payload size advertised in the OPT record. Small enough to avoid IP fragmentation,
+    # anything bigger comes back truncated and is fetched over TCP instead
+    EDNS_PAYLOAD_SIZE = 1232
+
     def __init__(self):
         self.header = bytearray(DNSPacket.HEADER_LEN)
         self.name = b''
+        # Offset -> uncompressed name, for following compression pointers
+        self.names = {}
+
+    @staticmethod
+    def random_id():
+        """
+        :return: A random 16 bit query ID
+        """
+        return _id_random.randint(0, DNSPacket.MAX_ID)
+
+    @staticmethod
+    def is_truncated(b):
+        """
+        Checks the TC bit of a raw packet, without parsing the (possibly cut off) rest of it
+        :param b: The bytes of the packet
+        :return: True if the packet was truncated
+        """
+        return len(b) >= DNSPacket.HEADER_LEN and b[2] & 0x02 != 0
 
     @classmethod
-    def newQuery(cls, url, question_type, using_dnssec=False):
+    def newQuery(cls, url, question_type, using_dnssec=False, packet_id=None):
         """
         Create a new DNSPacket for a query. The type can be set using parameters.
         :param url: url to query
         :param question_type: type of record being requested
         :param using_dnssec: True is using dnssec, false otherwise
+        :param packet_id: ID for the query. A random one is picked if not given
         :return: The constructed DNS query packet
         """
         packet = cls()
+        packet.id = packet_id if packet_id is not None else cls.random_id()
 
         question = packet.createQuestion(url, question_type)
+        # Kept so responses can be matched back to this query
+        packet.name = bytes(question[:-4])
+        packet.question_type = question_type
 
         if using_dnssec:
             header = packet.createDnsHeader(1, 0, 0, 1)
@@ -75,35 +132,32 @@ class DNSPacket:
         return packet
 
     @classmethod
-    def newFromBytes(cls, b, packet_id=0):
+    def newFromBytes(cls, b, packet_id=None, lazy=False):
         """
         Will parse a bytes object representing a DNS packet. Fields in the DNSPacket will be filled in.
+        Only the answer section is parsed, the authority and additional sections are skipped entirely.
         :param b: byte-string usually received from networking interface
-        :param packet_id: expected ID of the packet
+        :param packet_id: expected ID of the packet, or None to accept any
+        :param lazy: Only parse record headers, and decode the rest of each record when it is first used
         :return: The packet if successful, None otherwise
+        :raises DNSError: if the response code is an error, like the name not existing
         """
         packet = cls()
         packet.bytes = b
+        # Everything below walks this one view with offsets, so the packet is never copied
+        view = memoryview(b)
 
         # First parse out the header
-        if packet.parse_header(b, packet_id) is None:
+        if packet.parse_header(view, packet_id) is None:
             return
         # Not really interested in authority_records or additional_records
-        # print("ID =", packet.id)
-        # print("num_questions =", packet.num_questions)
-        # print("num_answers =", packet.num_answers)
-        # print("num_authority_records =", packet.num_authority_records)
-        # print("num_additional_records =", packet.num_additional_records)
-        # print("QR: ", packet.qr)
-        # print("Opcode: ", packet.opcode)
-        # print("AA: ", packet.aa)
 
         # Parse through question section. We aren't interested in the data here, just move to the answer section
         # Can't just skip it, because the 'name' part of this section is not a defined length
-        answers_start_i = packet.skip_questions(b)
+        answers_start_i = packet.skip_questions(view)
 
         # Parse answers:
-        packet.parse_answers(b[answers_start_i:])
+        packet.parse_answers(view, answers_start_i, lazy)
         return packet
 
     def skip_questions(self, b):
@@ -115,37 +169,36 @@ class DNSPacket:
         count = self.HEADER_LEN
         for _ in range(self.num_questions):
             if count == self.HEADER_LEN:
-                temp = parse_name(b[count:])
+                temp = read_name(b, count, self.names)
                 count += temp[0]
-                for s in temp[1]:
-                    self.name += s
+                self.name = temp[1]
+                self.question_type = QUESTION_TYPE_STRUCT.unpack_from(b, count)[0]
             else:
-                count += skip_name(b[count:])
+                count += skip_name(b, count)
             count += 4  # Skip Type and Class
         return count
 
-    def parse_answers(self, b):
+    def parse_answers(self, b, offset=0, lazy=False):
         """
         Parses the answer section and returns a list of records
         :param b: Bytes of packet
+        :param offset: Index of the start of the answer section
+        :param lazy: Leave the records undecoded until they are used
         :return: A list of records
         """
         self.answers = []
-        count = 0
+        count = offset
         for _ in range(self.num_answers):
-            result = parse_record(b[count:])
-            if isinstance(result[1], records.Record.RRSigRecord) and len(result[1].signer_name) == 2:
-                result[1].signer_name = self.name
-            elif len(result[1].name) == 2:
-                result[1].name = self.expand_name(b, result[1].name)
+            result = parse_record(b, count, self.names, lazy)
             count += result[0]
-            # print(result[1])
-            self.answers.append(result[1])
+            # Record types we don't handle come back as None
+            if result[1] is not None:
+                self.answers.append(result[1])
 
     def createDnsHeader(self, num_questions, num_answers, num_ns, num_additional):
         return struct.pack(
             '!HHHHHH',
-            0x0001,  # just use an ID of 1
+            self.id,
             # The flags section. "0x0130" will set the "recursion desired" bit,
             # the Authenticated data (AD) bit, and the Checking Disabled (CD) bit.
             # See https://mycourses.rit.edu/d2l/le/713074/discussions/threads/2901592/View
@@ -167,8 +220,7 @@ class DNSPacket:
             0,
             41,  # TYPE = OPT
             # This is the "Class" field. In opt records it is used for the requested UDP payload size.
-            # Up this if there are fragmentation issues
-            4024,
+            DNSPacket.EDNS_PAYLOAD_SIZE,
             0,  # Sets ERcode and EDNS0 version to 0 (no idea what they are for)
             # This is the "TTL" field. In opt records the D0 flag goes here, and the rest is zero'd
             0x8000,
@@ -177,18 +229,9 @@ class DNSPacket:
         )
 
     def createQuestion(self, url, question_type):
-        # Create the QNAME section, which holds the url. This consists of number of labels, one for each domain. Each
-        # label is 1 byte telling the # of characters in the next domain, then the ASCII bytes 0x00 ends the section
-        question_qname = bytearray(len(url) + 2)
-        i = 0
-        for domain in url.split('.'):
-            question_qname[i] = len(domain)
-            i += 1
-            insertBytes(question_qname, domain.encode('utf-8', 'strict'), i)
-            i += len(domain)
-
+        # The QNAME section holds the url in wire format, which DomainName has already worked out.
         # The last 2 bytes is "class" which should always be 1 for "internet"
-        return struct.pack("!{0}sHH".format(len(question_qname)), question_qname, question_type, 1)
+        return DomainName.get(url).wire + QUESTION_TAIL_STRUCT.pack(question_type, 1)
 
     def dump(self):
         dump_packet(self.bytes)
@@ -198,19 +241,21 @@ class DNSPacket:
         for record in self.answers:
             dprint("\t", record)
 
-    def parse_header(self, b, packet_id=0):
+    def parse_header(self, b, packet_id=None):
         """
         Parses the header of a DNS packet
         :param b: The bytes of the packet
         :param packet_id: The expected packet ID
-        :return: The packet
+        :return: The packet, or None if the ID doesn't match
+        :raises DNSError: if the response code is an error
         """
         # First parse out the header
-        self.id = int.from_bytes(b[:2], 'big')
-        if packet_id != 0 and self.id != packet_id:
-            print("ERROR\tID " + str(self.id) + " Does not match. Expected " + str(packet_id))
-        temp = int.from_bytes(b[2:4], 'big')
-        self.qr = temp & 2 ** 15 == 1
+        (self.id, temp, self.num_questions, self.num_answers, self.num_authority_records,
+         self.num_additional_records) = HEADER_STRUCT.unpack_from(b, 0)
+        if packet_id is not None and self.id != packet_id:
+            dprint("ERROR\tID " + str(self.id) + " Does not match. Expected " + str(packet_id))
+            return
+        self.qr = temp >> 15 & 1 == 1
         self.opcode = temp >> 11 & 15
         self.aa = temp >> 10 & 1 == 1
         self.tc = temp >> 9 & 1 == 1
@@ -221,27 +266,13 @@ class DNSPacket:
         self.cd = temp >> 4 & 1 == 1
         self.rcode = temp & 15
         if self.rcode != 0:
-            if self.rcode == 3:
-                print("NOTFOUND")
-                exit(0)
-            elif self.rcode in RCODE:
-                print("ERROR\t" + RCODE[self.rcode])
-            else:
-                print("ERROR\tRcode " + str(self.rcode) + " unrecognized")
-            return
+            raise DNSError(RCODE_STATUS.get(self.rcode, 'RCODE-' + str(self.rcode)),
+                           RCODE.get(self.rcode, "Rcode " + str(self.rcode) + " unrecognized"))
 
-        # More stuff, not sure if needed
-        self.num_questions = int.from_bytes(b[4:6], 'big')
-        self.num_answers = int.from_bytes(b[6:8], 'big')
-        self.num_authority_records = int.from_bytes(b[8:10], 'big')
-        self.num_additional_records = int.from_bytes(b[10:12], 'big')
         self.questions = []
         self.answers = []
         return self
 
-    def expand_name(self, data, pointer):
-        return self.name
-
 # For testing
 # if __name__ == '__main__':
 # DNSPacket.newFromBytes(DNSPacket.default_header)
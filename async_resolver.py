@@ -0,0 +1,494 @@
+"""
+An asyncio resolver core. Instead of walking the chain of trust one round trip at a time, every DS and DNSKEY
+query for every ancestor zone is sent at once, along with the query for the target RRset, and validation runs
+once the answers are in.
+"""
+
+import asyncio
+import socket
+import struct
+from collections import defaultdict
+
+from cache import ChainCache
+from DNSPacket import DNSError, DNSPacket
+from domain_name import DomainName
+from network import RTTEstimator, UpstreamPool
+from util import dprint
+from validation import find_ds_match, get_ds_records, get_keys, get_rrset, get_rrsigs, validate_RRSET
+
+# Random picks to try before walking the ID space for a free one
+MAX_ID_TRIES = 16
+
+
+class _MultiplexProtocol(asyncio.DatagramProtocol):
+    """
+    Passes every datagram on the shared socket to the transport for routing
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def datagram_received(self, data, addr):
+        self.owner.dispatch(data, addr)
+
+    def error_received(self, exc):
+        # ICMP errors on an unconnected socket can't be tied to a query, so they just end in a timeout
+        dprint("Socket error:", exc)
+
+
+def allocate_id(pending):
+    """
+    Picks a random ID which no pending query is using
+    :param pending: Dict of the pending queries, by ID
+    :return: The query ID
+    """
+    if len(pending) > DNSPacket.MAX_ID:
+        raise RuntimeError("Every query ID is in use")
+    for _ in range(MAX_ID_TRIES):
+        packet_id = DNSPacket.random_id()
+        if packet_id not in pending:
+            return packet_id
+    # The table is nearly full. Walk up from a random start, wrapping around at 16 bits
+    start = DNSPacket.random_id()
+    for offset in range(DNSPacket.MAX_ID + 1):
+        packet_id = (start + offset) & DNSPacket.MAX_ID
+        if packet_id not in pending:
+            return packet_id
+
+
+class _TCPConnection:
+    """
+    A persistent DNS over TCP connection to one resolver. Any number of queries can be sent down it without
+    waiting, and a reader task hands each answer to its query by ID, in whatever order they come back
+    https://tools.ietf.org/html/rfc7766#section-6.2.1
+    """
+    # Close the connection ourselves after this long unused, before the server does it for us
+    IDLE_TIMEOUT = 10
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.idle_handle = None
+        # Stops concurrent queries from each opening their own connection
+        self.open_lock = asyncio.Lock()
+        # ID -> future
+        self.pending = {}
+
+    def is_open(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def open(self):
+        async with self.open_lock:
+            if not self.is_open():
+                self.reader, self.writer = await asyncio.open_connection(self.addr[0], self.addr[1])
+                self.read_task = asyncio.ensure_future(self.read_answers(self.reader))
+
+    async def read_answers(self, reader):
+        try:
+            while True:
+                length = int.from_bytes(await reader.readexactly(2), 'big')
+                data = await reader.readexactly(length)
+                future = self.pending.get(int.from_bytes(data[:2], 'big'))
+                if future is not None and not future.done():
+                    future.set_result(data)
+        except (asyncio.IncompleteReadError, OSError):
+            self.close(ConnectionError("Connection to {0} closed".format(self.addr)))
+
+    def close(self, exc=None):
+        """
+        Closes the connection, failing any queries still waiting on it
+        :param exc: The exception to fail them with
+        :return: None
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.read_task is not None and self.read_task is not asyncio.current_task():
+            self.read_task.cancel()
+        self.read_task = None
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+            self.idle_handle = None
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc or ConnectionError("Connection closed"))
+
+    async def query(self, domain_name, type):
+        """
+        Sends a query down the connection and waits for its answer
+        :param domain_name: The domain name to request
+        :param type: The type of record being requested
+        :return: The response packet
+        """
+        await self.open()
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+            self.idle_handle = None
+        packet_id = allocate_id(self.pending)
+        query = DNSPacket.newQuery(domain_name, type, using_dnssec=True, packet_id=packet_id)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[packet_id] = future
+        try:
+            self.writer.write(len(query.bytes).to_bytes(2, 'big') + query.bytes)
+            await self.writer.drain()
+            data = await asyncio.wait_for(future, AsyncUDPTransport.TIMEOUT)
+        finally:
+            del self.pending[packet_id]
+            if len(self.pending) == 0 and self.is_open():
+                self.idle_handle = asyncio.get_running_loop().call_later(_TCPConnection.IDLE_TIMEOUT, self.close)
+        return DNSPacket.newFromBytes(data, packet_id, lazy=True)
+
+
+class AsyncTCPPool:
+    """
+    Keeps one persistent TCP connection per resolver, for answers too big for UDP
+    """
+
+    def __init__(self):
+        self.connections = {}
+
+    async def query(self, addr, domain_name, type):
+        """
+        Sends a query over TCP, reconnecting once if the server dropped the connection
+        :param addr: The resolver address
+        :param domain_name: The domain name to request
+        :param type: The type of record being requested
+        :return: The response packet
+        """
+        connection = self.connections.get(addr)
+        if connection is None:
+            connection = self.connections[addr] = _TCPConnection(addr)
+        try:
+            return await connection.query(domain_name, type)
+        except (ConnectionError, OSError):
+            dprint("TCP connection to {0} lost, reconnecting".format(addr))
+            connection.close()
+            return await connection.query(domain_name, type)
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections.clear()
+
+
+class AsyncUDPTransport:
+    """
+    Sends queries over UDP without blocking, so any number of them can be waiting on answers at once.
+    Every query shares one socket. Each gets a random ID, and answers are routed back to the waiting
+    query by ID, source address and question. Truncated answers are fetched again over TCP.
+    Responses are parsed in lazy mode, so only the records validation actually looks at get decoded.
+
+    Identical queries are coalesced: while a query for a (resolver, name, type) is outstanding, anyone else
+    asking the same thing waits on it instead of sending their own, and they all get the same DNSPacket.
+    Without this, validating many names under one zone at once sends the same DS and DNSKEY queries for
+    every ancestor zone once per name.
+
+    Lost queries are sent again after a timeout that adapts to how quickly each resolver usually answers,
+    doubling on every retry (see network.RTTEstimator). Given an UpstreamPool instead of an address, retries
+    go to the next best resolver in the pool while earlier copies are still waiting, and the first answer
+    from any of them wins
+    """
+    # Most time spent on one query, retries included
+    TIMEOUT = 5
+    # Most times one query is sent
+    MAX_TRIES = 4
+    # Stands in for the response when it came back truncated
+    TRUNCATED = object()
+    # Receive buffer for the shared socket, which takes the answers to every query in flight at once.
+    # The kernel caps it at net.core.rmem_max
+    RECEIVE_BUFFER = 1 << 20
+
+    def __init__(self):
+        self.transport = None
+        # Stops the first few concurrent queries from each opening their own socket
+        self.open_lock = asyncio.Lock()
+        # ID -> (resolver address, question name, question type, future)
+        self.pending = {}
+        # (UpstreamPool, DomainName, type) -> task sending the query
+        self.in_flight = {}
+        # Queries answered by joining one already in flight
+        self.coalesced = 0
+        # Resolver address -> RTTEstimator
+        self.rtt = defaultdict(RTTEstimator)
+        # Single resolver address -> UpstreamPool of just that one
+        self.pools = {}
+        self.tcp_pool = AsyncTCPPool()
+
+    async def open(self):
+        """
+        Opens the shared socket, if it isn't already
+        :return: None
+        """
+        async with self.open_lock:
+            if self.transport is None:
+                loop = asyncio.get_running_loop()
+                self.transport, _ = await loop.create_datagram_endpoint(lambda: _MultiplexProtocol(self),
+                                                                        local_addr=('0.0.0.0', 0))
+                self.transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                                                   AsyncUDPTransport.RECEIVE_BUFFER)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        for task in self.in_flight.values():
+            task.cancel()
+        self.in_flight.clear()
+        self.tcp_pool.close()
+
+    def allocate_id(self):
+        """
+        Picks a random ID which no pending query is using
+        :return: The query ID
+        """
+        return allocate_id(self.pending)
+
+    async def upstreams(self, addr):
+        """
+        :param addr: A resolver address, or an UpstreamPool
+        :return: The UpstreamPool to send queries for addr to
+        """
+        if isinstance(addr, UpstreamPool):
+            return addr
+        pool = self.pools.get(addr)
+        if pool is None:
+            # Looked up once per address, without blocking the loop
+            infos = await asyncio.get_running_loop().getaddrinfo(addr[0], addr[1], family=socket.AF_INET,
+                                                                 type=socket.SOCK_DGRAM)
+            pool = self.pools.setdefault(addr, UpstreamPool([infos[0][4][:2]], rtt=self.rtt))
+        return pool
+
+    async def query(self, addr, domain_name, type):
+        """
+        Sends a query and waits for the answer, or waits on an identical query already in flight
+        :param addr: The resolver address, or an UpstreamPool
+        :param domain_name: The domain name to request
+        :param type: The type of record being requested
+        :return: The response packet, shared with everyone else who asked while it was in flight
+        :raises asyncio.TimeoutError: if no answer arrives within TIMEOUT seconds
+        """
+        pool = await self.upstreams(addr)
+        key = (pool, DomainName.get(domain_name), type)
+        task = self.in_flight.get(key)
+        if task is None:
+            task = self.in_flight[key] = asyncio.ensure_future(self.send_query(pool, domain_name, type))
+            task.add_done_callback(lambda finished: self.query_finished(key, finished))
+        else:
+            self.coalesced += 1
+        # One caller giving up mustn't cancel the query for everyone else waiting on it
+        return await asyncio.shield(task)
+
+    def query_finished(self, key, task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+        # Mark any error as seen, in case every caller was cancelled before it arrived
+        if not task.cancelled():
+            task.exception()
+
+    async def send_query(self, pool, domain_name, type):
+        """
+        Sends a query and waits for the answer, without coalescing. Each resolver tried gets its own copy of
+        the query with its own ID, and they all stay pending until one is answered
+        :param pool: The UpstreamPool to send to
+        :param domain_name: The domain name to request
+        :param type: The type of record being requested
+        :return: The response packet
+        :raises asyncio.TimeoutError: if no answer arrives after MAX_TRIES tries, or within TIMEOUT seconds
+        """
+        await self.open()
+        loop = asyncio.get_running_loop()
+        # Resolver address -> [query, future, number of times sent there, time last sent]
+        attempts = {}
+        # Resolvers which were waited on for their whole retransmission timeout
+        timed_out = set()
+        deadline = loop.time() + self.TIMEOUT
+        try:
+            for num_tries in range(1, self.MAX_TRIES + 1):
+                addr = pool.select(exclude=attempts)
+                if addr is None:
+                    addr = pool.select()
+                sent_at = self.send_attempt(attempts, addr, domain_name, type)
+                if num_tries == 1:
+                    probe = pool.probe(exclude=attempts)
+                    if probe is not None:
+                        # Not waited on, the retry delay stays that of the resolver picked above
+                        self.send_attempt(attempts, probe, domain_name, type)
+                # Waiting doesn't cancel the futures, so earlier copies of the query can still be answered
+                done, _ = await asyncio.wait([attempt[1] for attempt in attempts.values()],
+                                             timeout=min(pool.retry_delay(addr), deadline - sent_at),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if done:
+                    break
+                if loop.time() - sent_at >= pool.rtt[addr].rto:
+                    # Timed out, rather than hedged early
+                    pool.rtt[addr].backoff()
+                    timed_out.add(addr)
+                if num_tries == self.MAX_TRIES or loop.time() >= deadline:
+                    for addr in attempts:
+                        pool.failed(addr)
+                    raise asyncio.TimeoutError()
+                dprint("No response from {0}, sending again".format(addr))
+        finally:
+            for query, _, _, _ in attempts.values():
+                del self.pending[query.id]
+        addr = next(addr for addr, attempt in attempts.items() if attempt[1].done())
+        _, future, sends, sent_at = attempts[addr]
+        # Only answers to queries sent once are measured, as there's no telling which copy was answered
+        pool.answered(addr, loop.time() - sent_at if sends == 1 else None)
+        for other, attempt in attempts.items():
+            # A copy sent later can lose just by starting later. Only one left waiting its whole timeout failed
+            if other != addr and (other in timed_out or loop.time() - attempt[3] >= pool.rtt[other].rto):
+                pool.failed(other)
+        response = future.result()
+        if response is AsyncUDPTransport.TRUNCATED:
+            dprint("Packet was truncated, retrying over TCP")
+            return await self.tcp_pool.query(addr, domain_name, type)
+        return response
+
+    def send_attempt(self, attempts, addr, domain_name, type):
+        """
+        Sends one copy of a query to a resolver, reusing its ID if it was sent there before
+        :param attempts: Resolver address -> [query, future, number of times sent there, time last sent]
+        :param addr: The resolver address
+        :param domain_name: The domain name to request
+        :param type: The type of record being requested
+        :return: The time it was sent
+        """
+        loop = asyncio.get_running_loop()
+        attempt = attempts.get(addr)
+        if attempt is None:
+            packet_id = self.allocate_id()
+            query = DNSPacket.newQuery(domain_name, type, using_dnssec=True, packet_id=packet_id)
+            future = loop.create_future()
+            self.pending[packet_id] = (addr, query.name.lower(), type, future)
+            attempt = attempts[addr] = [query, future, 0, 0]
+        attempt[2] += 1
+        attempt[3] = loop.time()
+        self.transport.sendto(attempt[0].bytes, addr)
+        return attempt[3]
+
+    def dispatch(self, data, addr):
+        """
+        Routes a datagram to the query waiting on it. Late replies, replies from the wrong address
+        and replies to a different question are dropped
+        :param data: The datagram
+        :param addr: Address it came from
+        :return: None
+        """
+        if len(data) < DNSPacket.HEADER_LEN:
+            return
+        pending = self.pending.get(int.from_bytes(data[:2], 'big'))
+        if pending is None:
+            dprint("Dropping reply with unknown ID")
+            return
+        expected_addr, name, type, future = pending
+        if future.done() or addr[:2] != expected_addr:
+            return
+        if DNSPacket.is_truncated(data):
+            future.set_result(AsyncUDPTransport.TRUNCATED)
+            return
+        try:
+            packet = DNSPacket.newFromBytes(data, lazy=True)
+        except DNSError as error:
+            # Parsing stops at the header, so the error is matched by ID and address alone
+            future.set_exception(error)
+            return
+        except (ValueError, IndexError, struct.error):
+            # Corrupted. The query is sent again when its timeout passes
+            dprint("Dropping corrupted reply")
+            return
+        if packet and packet.name.lower() == name and packet.question_type == type:
+            future.set_result(packet)
+
+
+def zones_to_verify(domain_name, chain_cache):
+    """
+    Lists the zones from domain_name up towards the root, stopping at the first one already in the chain cache
+    :param domain_name: The domain name to begin at
+    :param chain_cache: The ChainCache
+    :return: Tuple of (list of zone names, expiry of the cached zone they stop at)
+    """
+    zones = []
+    for cur_domain in DomainName.get(domain_name).ancestors()[:-1]:
+        entry = chain_cache.get(cur_domain)
+        if entry is not None:
+            return zones, entry.expires
+        zones.append(cur_domain)
+    return zones, float('inf')
+
+
+def link_zone(zone, ds_response, dnskey_response):
+    """
+    Checks one link of the chain of trust
+    :param zone: The zone name
+    :param ds_response: The DS response for the zone
+    :param dnskey_response: The DNSKEY response for the zone
+    :return: A chain entry for ChainCache.put_chain, or None if no key matched a DS
+    """
+    ds_records = get_ds_records(ds_response)
+    keys = get_keys(dnskey_response)
+    if len(ds_records) == 0 or len(keys) == 0 or find_ds_match(zone, ds_records, keys) is None:
+        dprint("ERROR: Unable to validate any DNSKEY for {0} with parent zone".format(zone))
+        return None
+    return zone, keys, get_rrsigs(dnskey_response), ds_records, get_rrsigs(ds_response)
+
+
+async def async_verify_zone(domain_name, transport, resolver_address, chain_cache):
+    """
+    Verifies the chain of trust for a domain, with all of the queries in flight at once
+    :param domain_name: The domain name to begin at
+    :param transport: An AsyncUDPTransport
+    :param resolver_address: The address of the resolver, or an UpstreamPool
+    :param chain_cache: The ChainCache to check and fill in
+    :return: True if zone verified, false otherwise
+    """
+    zones, parent_expires = zones_to_verify(domain_name, chain_cache)
+    queries = []
+    for zone in zones:
+        queries.append(transport.query(resolver_address, zone, DNSPacket.RR_TYPE_DS))
+        queries.append(transport.query(resolver_address, zone, DNSPacket.RR_TYPE_DNSKEY))
+    responses = await asyncio.gather(*queries)
+
+    chain = []
+    for i, zone in enumerate(zones):
+        link = link_zone(zone, responses[2 * i], responses[2 * i + 1])
+        if link is None:
+            return False
+        chain.append(link)
+    chain.reverse()
+    chain_cache.put_chain(chain, parent_expires)
+    return True
+
+
+async def async_resolve(domain_name, query_type, transport, resolver_address, chain_cache=None):
+    """
+    Fetches and validates an RRset, verifying the chain of trust at the same time
+    :param domain_name: The domain name to query for
+    :param query_type: The record type (A, DNSKEY or DS)
+    :param transport: An AsyncUDPTransport, shared between lookups
+    :param resolver_address: The address of the resolver, or an UpstreamPool
+    :param chain_cache: Optional ChainCache to share between lookups
+    :return: Tuple of (chain verified, RRset, the RRSIG that validated it or None)
+    """
+    if chain_cache is None:
+        chain_cache = ChainCache()
+    # DS records are signed by the parent zone, everything else by the zone itself
+    signer_zone = domain_name
+    if query_type == DNSPacket.RR_TYPE_DS:
+        signer_zone = DomainName.get(domain_name).parent
+
+    chain_verified, response = await asyncio.gather(
+        async_verify_zone(domain_name, transport, resolver_address, chain_cache),
+        transport.query(resolver_address, domain_name, query_type))
+    if not chain_verified:
+        return False, [], None
+
+    entry = chain_cache.get(signer_zone)
+    if entry is not None:
+        keys = entry.keys
+    else:
+        keys = get_keys(await transport.query(resolver_address, signer_zone, DNSPacket.RR_TYPE_DNSKEY))
+    rr_set = get_rrset(response)
+    return True, rr_set, validate_RRSET(keys, get_rrsigs(response), rr_set, domain_name)
@@ -0,0 +1,501 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the validation path. Uses synthetic signed records, so no network is needed
+
+Usage: python3 bench.py [name ...]
+"""
+import asyncio
+import collections
+import importlib
+import io
+import itertools
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+
+import crypto
+from async_resolver import AsyncUDPTransport, async_resolve
+from cache import ChainCache
+from canonical import canonical_order
+from DNSPacket import DNSError, DNSPacket
+from network import RTTEstimator, UDPCommunication, UpstreamPool
+from records.Record import compact_record
+from stub_resolver import ResolverWorkers
+from test import (StubUpstream, add_signed_a_record, build_response, make_a_record, make_dnskey, make_signed_zones,
+                  sign_rrset)
+from validation import validate_RRSET
+from validator import Validator
+from verify_pool import VerificationExecutor
+
+dnsclient = importlib.import_module('351dnsclient')
+
+
+def timed(func, repeat=1):
+    """
+    Runs a function a number of times
+    :param func: The function to run
+    :param repeat: How many times to run it
+    :return: Average seconds per run
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def permutation_validate(keys, rrsig_set, rr_set, domain_name):
+    """
+    The old validate_RRSET, which tried every ordering of the RRset. Kept here only to compare against
+    """
+    for sig in rrsig_set:
+        for set_ordering in itertools.permutations(rr_set, len(rr_set)):
+            rrset_data = crypto.createRRSetData(set_ordering, sig, domain_name)
+            for key in keys:
+                if crypto.verify_signature(sig.signature, key, rrset_data):
+                    return sig
+    return None
+
+
+def concat_rrset_data(rr_set, rrsig_record, domain):
+    """
+    The old createRRSetData, which grew one bytes object by concatenation. Kept here only to compare against
+    """
+    data = rrsig_record.type_covered.to_bytes(2, 'big') + \
+        rrsig_record.algorithm.to_bytes(1, 'big') + rrsig_record.labels.to_bytes(1, 'big') + \
+        rrsig_record.orig_ttl.to_bytes(4, 'big') + rrsig_record.expiration + \
+        rrsig_record.inception + rrsig_record.tag.to_bytes(2, 'big') + \
+        crypto.canonical_wire_name(rrsig_record.signer_name)
+    for rr in rr_set:
+        data += crypto.RRSignableData(rr, domain, rrsig_record.orig_ttl)
+    return data
+
+
+def bench_rrset_size():
+    """
+    Verify time as the RRset grows, canonical ordering vs trying every permutation
+    """
+    rsa_key = RSA.generate(2048)
+    keys = [make_dnskey(rsa_key)]
+    print("RRset size vs verify time")
+    print("size\tcanonical (ms)\tpermutations (ms)")
+    for size in (1, 2, 4, 6, 8, 16, 64):
+        # Reverse so the canonical ordering is the last permutation tried, the worst case for the old search
+        rr_set = [make_a_record((192, 0, 2, i)) for i in range(size)]
+        sig = sign_rrset(rsa_key, keys[0], rr_set)
+        rr_set.reverse()
+        canonical_time = timed(lambda: validate_RRSET(keys, [sig], rr_set, 'example.com'), 20)
+        if size <= 6:
+            permutation_time = "{:.3f}".format(
+                1000 * timed(lambda: permutation_validate(keys, [sig], rr_set, 'example.com')))
+        else:
+            permutation_time = "skipped ({}! orderings)".format(size)
+        print("{}\t{:.3f}\t\t{}".format(size, 1000 * canonical_time, permutation_time))
+
+
+def bench_verifier_cache():
+    """
+    Verify throughput with the verifier cache cleared before every call (cold) vs left alone (warm)
+    """
+    rsa_key = RSA.generate(2048)
+    key = make_dnskey(rsa_key)
+    rr_set = [make_a_record((192, 0, 2, 1))]
+    sig = sign_rrset(rsa_key, key, rr_set)
+    data = crypto.createRRSetData(rr_set, sig, 'example.com')
+    repeat = 2000
+
+    def cold():
+        crypto.verifier_cache.clear()
+        crypto.verify_signature(sig.signature, key, data)
+
+    def warm():
+        crypto.verify_signature(sig.signature, key, data)
+
+    print("Verifier cache")
+    cold_time = timed(cold, repeat)
+    warm_time = timed(warm, repeat)
+    print("cold\t{:.0f} verifies/s".format(1 / cold_time))
+    print("warm\t{:.0f} verifies/s".format(1 / warm_time))
+    print("speedup\t{:.2f}x".format(cold_time / warm_time))
+
+
+def bench_parse():
+    """
+    Parse throughput of a large DNSKEY response, 4 keys with an RRSIG from each
+    """
+    rsa_keys = [RSA.generate(2048) for _ in range(4)]
+    keys = [make_dnskey(rsa_key) for rsa_key in rsa_keys]
+    answers = keys + [sign_rrset(rsa_key, key, keys) for rsa_key, key in zip(rsa_keys, keys)]
+    query = DNSPacket.newQuery('example.com', DNSPacket.RR_TYPE_DNSKEY, using_dnssec=True)
+    response = build_response(query.bytes, answers)
+    repeat = 5000
+    print("Parse throughput ({} byte DNSKEY response, {} records)".format(len(response), len(answers)))
+    for mode, lazy in (("eager", False), ("lazy", True)):
+        parse_time = timed(lambda: DNSPacket.newFromBytes(response, lazy=lazy), repeat)
+        print("{}\t{:.0f} packets/s\t{:.1f} MB/s".format(mode, 1 / parse_time, len(response) / parse_time / 1e6))
+
+
+def peak_bytes(func):
+    """
+    Measures the most memory a function has allocated at once while running
+    :param func: The function to run
+    :return: Peak bytes allocated
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_signed_data():
+    """
+    Hashing the signed data of large DNSKEY RRsets with several signatures, the old concatenated buffer
+    vs feeding the hash piece by piece
+    """
+    rsa_keys = [RSA.generate(1024) for _ in range(4)]
+    print("Signed data hashing (4 RRSIGs per RRset)")
+    print("keys\tconcat (ms)\tstreamed (ms)\tconcat peak (KB)\tstreamed peak (KB)")
+    for size in (4, 16, 64, 256):
+        # Only the first 4 keys sign, the rest just need distinct public keys, which is faster than generating them
+        keys = [make_dnskey(RSA.construct((rsa_keys[0].n + 2 * i, 65537)) if i >= 4 else rsa_keys[i])
+                for i in range(size)]
+        sigs = [sign_rrset(rsa_key, key, keys) for rsa_key, key in zip(rsa_keys, keys)]
+        ordered = canonical_order(keys)
+
+        def concat():
+            for sig in sigs:
+                SHA256.new(concat_rrset_data(ordered, sig, 'example.com'))
+
+        def streamed():
+            for sig in sigs:
+                crypto.hashRRSetData(ordered, sig, 'example.com')
+
+        print("{}\t{:.3f}\t\t{:.3f}\t\t{:.1f}\t\t\t{:.1f}".format(
+            size, 1000 * timed(concat, 20), 1000 * timed(streamed, 20),
+            peak_bytes(concat) / 1024, peak_bytes(streamed) / 1024))
+
+
+def bench_parallel():
+    """
+    Batch verify throughput, in process vs spread over a VerificationExecutor with 1 to N workers
+    """
+    rsa_keys = [RSA.generate(2048) for _ in range(8)]
+    keys = [make_dnskey(rsa_key) for rsa_key in rsa_keys]
+    checks = []
+    for i in range(800):
+        rr_set = [make_a_record((192, 0, 2, i % 256))]
+        sig = sign_rrset(rsa_keys[i % 8], keys[i % 8], rr_set)
+        checks.append((sig.signature, keys[i % 8], crypto.createRRSetData(rr_set, sig, 'example.com')))
+
+    print("Batch verify scaling ({} RSA-2048 checks, {} cores)".format(len(checks), os.cpu_count()))
+    print("workers\tverifies/s\tspeedup")
+    serial_time = timed(lambda: [crypto.verify_signature(*check) for check in checks])
+    print("inline\t{:.0f}\t\t1.00x".format(len(checks) / serial_time))
+    for workers in range(1, max(os.cpu_count() or 1, 2) + 1):
+        with VerificationExecutor(workers) as executor:
+            # Start the workers and warm their key caches before timing
+            executor.verify_many(checks[:8 * workers])
+            parallel_time = timed(lambda: executor.verify_many(checks))
+        print("{}\t{:.0f}\t\t{:.2f}x".format(workers, len(checks) / parallel_time, serial_time / parallel_time))
+
+
+def bench_batch():
+    """
+    Names validated per second against a local stub resolver, one process per name vs a single batch run
+    """
+    zones = ['com', 'example.com'] + ['host{}.example.com'.format(i) for i in range(50)]
+    answers = make_signed_zones(zones)
+    for zone in zones[2:]:
+        add_signed_a_record(answers, zone)
+    upstream = StubUpstream(answers)
+    server = '@{}:{}'.format(*upstream.address)
+    lines = ["{} A\n".format(zone) for zone in zones[2:]] * 4
+    try:
+        print("Batch throughput ({} lookups of {} names)".format(len(lines), len(zones) - 2))
+        spawn_count = 10
+
+        def spawn():
+            for line in lines[:spawn_count]:
+                subprocess.run([sys.executable, '351dnsclient.py', server] + line.split(), stdout=subprocess.DEVNULL)
+
+        print("process per name\t{:.1f} names/s".format(spawn_count / timed(spawn)))
+
+        def batch():
+            with Validator(upstream.address) as validator:
+                dnsclient.run_batch(lines, io.StringIO(), 'jsonl', validator)
+
+        print("batch\t\t\t{:.1f} names/s".format(len(lines) / timed(batch)))
+    finally:
+        upstream.close()
+
+
+def query_load(address, names, count, window=16):
+    """
+    Sends A queries to a resolver over UDP, keeping a window of them outstanding. Runs in a client process
+    :param address: The resolver address
+    :param names: The names to query, round robin
+    :param count: Number of queries to send
+    :param window: Number of queries to keep outstanding
+    :return: Number of answers received
+    """
+    packets = [DNSPacket.newQuery(name, DNSPacket.RR_TYPE_A, True).bytes for name in names]
+    answered = 0
+    sent = 0
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(1)
+        while sent < min(window, count):
+            sock.sendto(packets[sent % len(packets)], address)
+            sent += 1
+        while answered < sent:
+            try:
+                sock.recv(4096)
+            except socket.timeout:
+                # Lost under load. Count what came back
+                break
+            answered += 1
+            if sent < count:
+                sock.sendto(packets[sent % len(packets)], address)
+                sent += 1
+    return answered
+
+
+def bench_serve():
+    """
+    Queries per second answered by the local resolver, by number of worker processes
+    """
+    zones = ['com', 'example.com'] + ['host{}.example.com'.format(i) for i in range(20)]
+    answers = make_signed_zones(zones)
+    for zone in zones[2:]:
+        add_signed_a_record(answers, zone)
+    upstream = StubUpstream(answers)
+    names = zones[2:]
+    clients = 4
+    per_client = 2000
+    client_pool = multiprocessing.Pool(clients)
+    try:
+        print("Local resolver throughput ({} client processes, {} cores)".format(clients, os.cpu_count()))
+        print("workers\tqueries/s\tupstream DS queries")
+        for workers in (1, 2, 4):
+            upstream.queries.clear()
+            with ResolverWorkers(upstream.address, ('127.0.0.1', 0), workers) as pool:
+                # Warm every worker's answer cache, with a new source port per round so all workers get queries
+                client_pool.starmap(query_load, [(pool.address, names, len(names))] * clients * 4)
+                ds_queries = sum(qtype == DNSPacket.RR_TYPE_DS for _, qtype in upstream.queries)
+                start = time.perf_counter()
+                answered = sum(client_pool.starmap(query_load, [(pool.address, names, per_client)] * clients))
+                elapsed = time.perf_counter() - start
+            # Zones a worker picked up from the shared table don't show up as DS queries
+            print("{}\t{:.0f}\t\t{}".format(workers, answered / elapsed, ds_queries))
+    finally:
+        client_pool.close()
+        client_pool.join()
+        upstream.close()
+
+
+class UncoalescedTransport(AsyncUDPTransport):
+    """
+    AsyncUDPTransport without coalescing of identical queries. Kept here only to compare against
+    """
+
+    async def query(self, addr, domain_name, type):
+        return await self.send_query(await self.upstreams(addr), domain_name, type)
+
+
+def bench_coalesce():
+    """
+    Upstream queries for a cold cache thundering herd, each query sent separately vs identical ones coalesced
+    """
+    hosts = ['host{}.example.com'.format(i) for i in range(50)]
+    answers = make_signed_zones(['com', 'example.com'] + hosts)
+    for host in hosts:
+        add_signed_a_record(answers, host)
+    upstream = StubUpstream(answers)
+    # Every name asked for by several clients at once
+    lookups = hosts * 4
+    try:
+        print("Cold cache herd ({} lookups of {} names)".format(len(lookups), len(hosts)))
+        for mode, transport_class in (("separate", UncoalescedTransport), ("coalesced", AsyncUDPTransport)):
+            async def herd():
+                transport = transport_class()
+                chain_cache = ChainCache()
+                results = await asyncio.gather(*[async_resolve(host, DNSPacket.RR_TYPE_A, transport, upstream.address,
+                                                               chain_cache) for host in lookups],
+                                               return_exceptions=True)
+                transport.close()
+                # Bursts too big for the upstream's socket buffer get dropped, and end in a timeout
+                return sum(isinstance(result, Exception) for result in results)
+
+            upstream.queries.clear()
+            start = time.perf_counter()
+            failed = asyncio.run(herd())
+            elapsed = time.perf_counter() - start
+            print("{}\t{} upstream queries\t{} failed lookups\t{:.2f}s".format(mode, len(upstream.queries), failed,
+                                                                             elapsed))
+    finally:
+        upstream.close()
+
+
+class FixedTimeout(RTTEstimator):
+    """
+    The old fixed timeout, a single select for the whole budget. Kept here only to compare against
+    """
+
+    def __init__(self):
+        RTTEstimator.__init__(self)
+        self.rto = UDPCommunication.TIMEOUT
+
+    def sample(self, rtt):
+        pass
+
+    def backoff(self):
+        pass
+
+
+def bench_loss():
+    """
+    Query latency with packet loss, with a fixed timeout vs adaptive retransmission
+    """
+    answers = make_signed_zones(['com'])
+    loss = 0.05
+    count = 100
+    upstream = StubUpstream(answers, loss=loss)
+    try:
+        print("Latency with {:.0%} loss ({} queries)".format(loss, count))
+        for mode, estimator in (("fixed", FixedTimeout), ("adaptive", RTTEstimator)):
+            random.seed(1)
+            connection = UDPCommunication()
+            connection.rtt = collections.defaultdict(estimator)
+            latencies = []
+            failed = 0
+            for _ in range(count):
+                start = time.perf_counter()
+                connection.sendPacket(upstream.address, DNSPacket.newQuery('com', DNSPacket.RR_TYPE_DNSKEY, True))
+                try:
+                    connection.waitForPacket()
+                except DNSError:
+                    failed += 1
+                latencies.append(time.perf_counter() - start)
+            connection.close()
+            latencies.sort()
+            print("{}\tp50 {:.1f}ms\tp99 {:.1f}ms\tmax {:.1f}ms\t{} failed".format(
+                mode, latencies[count // 2] * 1000, latencies[count * 99 // 100] * 1000, latencies[-1] * 1000, failed))
+    finally:
+        upstream.close()
+
+
+def bench_upstreams():
+    """
+    Query latency when the usual resolver sometimes stalls, one resolver vs a pool of two, with and without hedging
+    """
+    answers = make_signed_zones(['com'])
+    stall = 0.05
+    count = 200
+    primary = StubUpstream(answers)
+    # Further away, so it is only the fallback
+    backup = StubUpstream(answers, delay=0.02)
+    try:
+        print("Latency with {:.0%} of queries stalled 500ms by the nearest resolver ({} queries)".format(stall, count))
+        for mode in ("single", "pool", "hedged"):
+            if mode == "single":
+                resolver = primary.address
+            else:
+                resolver = UpstreamPool([primary.address, backup.address], hedge=mode == "hedged")
+            connection = UDPCommunication()
+            # Warm up, so both resolvers are measured before any stalls
+            primary.delay = 0
+            for _ in range(UpstreamPool.HEDGE_SAMPLES * 2):
+                connection.sendPacket(resolver, DNSPacket.newQuery('com', DNSPacket.RR_TYPE_DNSKEY, True))
+                connection.waitForPacket()
+            random.seed(1)
+            primary.queries.clear()
+            backup.queries.clear()
+            latencies = []
+            for _ in range(count):
+                primary.delay = 0.5 if random.random() < stall else 0
+                start = time.perf_counter()
+                connection.sendPacket(resolver, DNSPacket.newQuery('com', DNSPacket.RR_TYPE_DNSKEY, True))
+                connection.waitForPacket()
+                latencies.append(time.perf_counter() - start)
+            connection.close()
+            latencies.sort()
+            print("{}\tp50 {:.1f}ms\tp99 {:.1f}ms\tmax {:.1f}ms\t{} upstream queries".format(
+                mode, latencies[count // 2] * 1000, latencies[count * 99 // 100] * 1000, latencies[-1] * 1000,
+                len(primary.queries) + len(backup.queries)))
+    finally:
+        primary.close()
+        backup.close()
+
+
+def retained_bytes(build):
+    """
+    Measures the memory held by whatever a function returns
+    :param build: Function building the objects to measure
+    :return: Tuple of (the objects, bytes still allocated once build returns)
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objects = build()
+        return objects, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+def bench_memory():
+    """
+    Bytes held per cached record, records as parsed vs in their compact form
+    """
+    rsa_key = RSA.generate(2048)
+    key = make_dnskey(rsa_key)
+    answers = [key, sign_rrset(rsa_key, key, [key])]
+    query = DNSPacket.newQuery('example.com', DNSPacket.RR_TYPE_DNSKEY, using_dnssec=True)
+    response = build_response(query.bytes, answers)
+    count = 2000
+
+    def parsed():
+        records = []
+        for _ in range(count):
+            records += DNSPacket.newFromBytes(response).answers
+        return records
+
+    def compact():
+        records = []
+        for _ in range(count):
+            records += [compact_record(record) for record in DNSPacket.newFromBytes(response).answers]
+        return records
+
+    print("Memory per cached record (DNSKEY + RRSIG, {} copies)".format(count))
+    for mode, build in (("parsed", parsed), ("compact", compact)):
+        records, size = retained_bytes(build)
+        print("{}\t{:.0f} bytes/record".format(mode, size / len(records)))
+
+
+BENCHMARKS = {
+    'rrset_size': bench_rrset_size,
+    'verifier_cache': bench_verifier_cache,
+    'parse': bench_parse,
+    'memory': bench_memory,
+    'signed_data': bench_signed_data,
+    'parallel': bench_parallel,
+    'batch': bench_batch,
+    'serve': bench_serve,
+    'coalesce': bench_coalesce,
+    'loss': bench_loss,
+    'upstreams': bench_upstreams,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+        print()
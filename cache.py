@@ -0,0 +1,238 @@
+"""
+In memory caches for validation results, so work already done isn't repeated until it expires
+"""
+
+import struct
+import time
+from collections import OrderedDict
+
+# DNSPacket has to be imported before records.Record, which imports it back
+from DNSPacket import DNSPacket  # noqa: F401
+from domain_name import DomainName
+from records.Record import compact_record
+
+
+def rrsig_expiration(rrsig):
+    """
+    Gets the expiration time of an RRSIG as a unix timestamp
+    :param rrsig: The RRSIG record
+    :return: Seconds since the epoch
+    """
+    return struct.unpack("!I", rrsig.expiration)[0]
+
+
+def expiry_time(records, rrsigs, now):
+    """
+    Works out when data stops being trustworthy, the lower of the record TTLs and the RRSIG expirations
+    :param records: The records (any type, including RRSIGs)
+    :param rrsigs: The RRSIG records which validated them
+    :param now: The current time
+    :return: Unix timestamp the data expires at
+    """
+    expires = float('inf')
+    for record in records:
+        expires = min(expires, now + record.ttl)
+    for rrsig in rrsigs:
+        expires = min(expires, rrsig_expiration(rrsig))
+    return expires
+
+
+class ZoneEntry:
+    """
+    A zone whose DNSKEYs have been matched against a DS in its parent, all the way up the chain.
+    Records are kept in their compact form (see records.Record.CompactRecord)
+    """
+    __slots__ = ('zone', 'keys', 'key_rrsigs', 'ds_records', 'expires')
+
+    def __init__(self, zone, keys, key_rrsigs, ds_records, expires):
+        self.zone = DomainName.get(zone)
+        self.keys = [compact_record(key) for key in keys]
+        self.key_rrsigs = [compact_record(rrsig) for rrsig in key_rrsigs]
+        self.ds_records = [compact_record(ds) for ds in ds_records]
+        self.expires = expires
+
+
+class ChainCache:
+    """
+    Remembers which zones have a validated chain of trust. An entry never outlives the entries of its
+    ancestors, so finding a zone here means the whole chain above it is still good
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.zones = {}
+
+    def get(self, zone):
+        """
+        Looks up a zone, dropping it if it has expired
+        :param zone: The zone name (EX: 'example.com'), or a DomainName
+        :return: The ZoneEntry, or None if not cached
+        """
+        key = DomainName.get(zone)
+        entry = self.zones.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= self.clock():
+            del self.zones[key]
+            return None
+        return entry
+
+    def put_chain(self, chain, parent_expires=float('inf')):
+        """
+        Stores the zones of a chain which validated successfully
+        :param chain: A list of (zone, keys, key_rrsigs, ds_records, ds_rrsigs), ordered from the
+                      zone closest to the root down to the leaf zone
+        :param parent_expires: Expiry of the cached zone above the chain, if the walk stopped at one
+        :return: None
+        """
+        now = self.clock()
+        for zone, keys, key_rrsigs, ds_records, ds_rrsigs in chain:
+            expires = min(parent_expires, expiry_time(keys + ds_records, key_rrsigs + ds_rrsigs, now))
+            if expires <= now:
+                # Nothing below an expired zone can be trusted either
+                break
+            self.zones[DomainName.get(zone)] = ZoneEntry(zone, keys, key_rrsigs, ds_records, expires)
+            parent_expires = expires
+
+    def put(self, entry):
+        """
+        Stores a single zone entry, unless the zone is already cached for longer
+        :param entry: The ZoneEntry
+        :return: None
+        """
+        key = entry.zone
+        current = self.zones.get(key)
+        if current is None or current.expires < entry.expires:
+            self.zones[key] = entry
+
+    def entries(self):
+        """
+        :return: A list of every unexpired ZoneEntry
+        """
+        now = self.clock()
+        return [entry for entry in self.zones.values() if entry.expires > now]
+
+    def clear(self):
+        self.zones.clear()
+
+    def __len__(self):
+        return len(self.zones)
+
+
+class Answer:
+    """
+    A validated RRset, the RRSIG which validated it and whether it was valid.
+    Records are kept in their compact form (see records.Record.CompactRecord)
+    """
+    __slots__ = ('rr_set', 'rrsig', 'valid', 'expires', 'size')
+
+    def __init__(self, rr_set, rrsig, valid, expires, size):
+        self.rr_set = [compact_record(rr) for rr in rr_set]
+        self.rrsig = compact_record(rrsig) if rrsig is not None else None
+        self.valid = valid
+        self.expires = expires
+        self.size = size
+
+
+class AnswerCache:
+    """
+    A final answer cache keyed by (name, type), with LRU eviction once the cached records pass max_bytes.
+    An answer expires at the lowest of the record TTLs, the RRSIG original TTL and the RRSIG expiration
+    """
+    DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+    # Rough cost of the python objects around each answer, on top of the raw record bytes.
+    # Cached records are compact, see "python3 bench.py memory"
+    ENTRY_OVERHEAD = 512
+    RECORD_OVERHEAD = 128
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, clock=time.time):
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.answers = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def answer_size(rr_set, rrsig):
+        """
+        Estimates the memory held by an answer
+        :param rr_set: The RRset
+        :param rrsig: The RRSIG, or None
+        :return: Size in bytes
+        """
+        size = AnswerCache.ENTRY_OVERHEAD
+        for rr in rr_set:
+            size += AnswerCache.RECORD_OVERHEAD + len(rr.rdata)
+        if rrsig is not None:
+            size += AnswerCache.RECORD_OVERHEAD + len(rrsig.rdata)
+        return size
+
+    def get(self, name, rr_type):
+        """
+        Looks up an answer, dropping it if it has expired
+        :param name: The domain name, a string or DomainName
+        :param rr_type: The record type
+        :return: The Answer, or None if not cached
+        """
+        key = (DomainName.get(name), rr_type)
+        answer = self.answers.get(key)
+        if answer is None:
+            self.misses += 1
+            return None
+        if answer.expires <= self.clock():
+            self.remove(key)
+            self.misses += 1
+            return None
+        self.answers.move_to_end(key)
+        self.hits += 1
+        return answer
+
+    def put(self, name, rr_type, rr_set, rrsig, valid):
+        """
+        Stores an answer
+        :param name: The domain name, a string or DomainName
+        :param rr_type: The record type
+        :param rr_set: The RRset
+        :param rrsig: The RRSIG which validated it, or None if nothing did
+        :param valid: The validation verdict
+        :return: None
+        """
+        now = self.clock()
+        if rrsig is not None:
+            expires = min(expiry_time(rr_set, [rrsig], now), now + rrsig.orig_ttl)
+        else:
+            expires = expiry_time(rr_set, [], now)
+        if expires <= now:
+            return
+        key = (DomainName.get(name), rr_type)
+        self.remove(key)
+        answer = Answer(rr_set, rrsig, valid, expires, AnswerCache.answer_size(rr_set, rrsig))
+        if answer.size > self.max_bytes:
+            return
+        self.answers[key] = answer
+        self.size += answer.size
+        while self.size > self.max_bytes:
+            _, evicted = self.answers.popitem(last=False)
+            self.size -= evicted.size
+            self.evictions += 1
+
+    def remove(self, key):
+        answer = self.answers.pop(key, None)
+        if answer is not None:
+            self.size -= answer.size
+
+    def clear(self):
+        """
+        Drops every cached answer and resets the counters
+        :return: None
+        """
+        self.answers.clear()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.answers)
@@ -0,0 +1,60 @@
+"""
+Canonical form and ordering of RRsets, so an RRSIG can be checked with a single signing buffer
+https://tools.ietf.org/html/rfc4034#section-6
+"""
+
+
+def canonical_name(name):
+    """
+    Puts a domain name into canonical wire form: uncompressed, with every letter lowercased
+    https://tools.ietf.org/html/rfc4034#section-6.2
+    :param name: A domain name string (EX: 'Example.COM' or 'example.com.')
+    :return: The name as wire format bytes
+    """
+    data = bytearray()
+    for label in name.strip('.').split('.'):
+        if label == '':
+            continue
+        label_bytes = label.lower().encode('utf-8', 'strict')
+        data.append(len(label_bytes))
+        data += label_bytes
+    data.append(0)
+    return bytes(data)
+
+
+def canonical_wire_name(wire_name):
+    """
+    Lowercases a name which is already in (uncompressed) wire form. The length octets are never touched
+    by this, since a label can be at most 63 bytes long and uppercase ASCII starts at 65
+    :param wire_name: The name as wire format bytes
+    :return: The canonical wire format name
+    """
+    return bytes(wire_name).lower()
+
+
+def canonical_rdata(rr):
+    """
+    Returns the RDATA of a record in canonical form. None of the record types we handle (A, DNSKEY, DS)
+    carry domain names inside their RDATA, so it is already canonical as received
+    :param rr: The resource record
+    :return: The canonical RDATA bytes
+    """
+    return bytes(rr.rdata)
+
+
+def canonical_order(rr_set):
+    """
+    Sorts an RRset into canonical order. Records are sorted by their canonical RDATA, treated as a left
+    justified unsigned octet sequence, which is exactly how python compares bytes. Duplicate records are dropped.
+    https://tools.ietf.org/html/rfc4034#section-6.3
+    :param rr_set: The RRset, in any order
+    :return: A new list holding the RRset in canonical order
+    """
+    ordered = []
+    seen = set()
+    for rdata, rr in sorted(((canonical_rdata(rr), rr) for rr in rr_set), key=lambda pair: pair[0]):
+        if rdata in seen:
+            continue
+        seen.add(rdata)
+        ordered.append(rr)
+    return ordered
@@ -3,66 +3,215 @@
 The hashing and sha stuff
 
 """
+import struct
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 
-from Crypto.Hash import SHA256
-from Crypto.PublicKey import RSA
-from Crypto.Signature import PKCS1_v1_5
+from Crypto.Hash import SHA1, SHA256, SHA384, SHA512
+from Crypto.PublicKey import ECC, RSA
+from Crypto.Signature import DSS, PKCS1_v1_5, eddsa
 
-from util import insertBytes
+from canonical import canonical_wire_name
+from domain_name import DomainName
+
+# The RRSIG RDATA up to the signer name, and the fixed part of each RR after the owner name
+RRSIG_PREFIX = struct.Struct('!HBBI4s4sH')
+RR_FIXED = struct.Struct('!HHIH')
+
+
+def signedDataChunks(rr_set, rrsig_record, domain):
+    """
+    Generates the data an RRSIG signs, piece by piece, so it can be hashed or joined without building
+    up intermediate buffers
+    https://tools.ietf.org/html/rfc4034#section-3.1.8.1
+    :param rr_set: The RRset, already in canonical order (see canonical.canonical_order)
+    :param rrsig_record: The RRSIG record
+    :param domain: The domain name of the RRSIG
+    :return: A generator of bytes-like chunks
+    """
+    yield RRSIG_PREFIX.pack(rrsig_record.type_covered, rrsig_record.algorithm, rrsig_record.labels,
+                            rrsig_record.orig_ttl, rrsig_record.expiration, rrsig_record.inception, rrsig_record.tag)
+    yield canonical_wire_name(rrsig_record.signer_name)
+
+    owner = formatName(domain)
+    for rr in rr_set:
+        yield owner
+        yield RR_FIXED.pack(rr.type, rr.clazz, rrsig_record.orig_ttl, rr.rdata_len)
+        yield rr.rdata
 
 
 def createRRSetData(rr_set, rrsig_record, domain):
     """
-    Puts together data for an RRSet and computes hash
+    Puts together data for an RRSet, as one buffer
     https://tools.ietf.org/html/rfc4034#section-3.1.8.1
-    :param rr_set: The RRset
+    :param rr_set: The RRset, already in canonical order (see canonical.canonical_order)
     :param rrsig_record: The RRSIG record
     :param domain: The domain name of the RRSIG
     :return: The data ready for verification
     """
-    data = rrsig_record.type_covered.to_bytes(2, 'big') + \
-           rrsig_record.algorithm.to_bytes(1, 'big') + rrsig_record.labels.to_bytes(1, 'big') + \
-           rrsig_record.orig_ttl.to_bytes(4, 'big') + rrsig_record.expiration + \
-           rrsig_record.inception + rrsig_record.tag.to_bytes(2, 'big') + \
-           rrsig_record.signer_name
+    return b''.join(signedDataChunks(rr_set, rrsig_record, domain))
 
-    for rr in rr_set:
-        data += RRSignableData(rr, domain, rrsig_record.orig_ttl)
 
-    return data
+def hashRRSetData(rr_set, rrsig_record, domain):
+    """
+    Hashes the data for an RRSet, feeding each piece straight into the hash the RRSIG's algorithm uses.
+    The result can be passed to verify_signature for every candidate key, since checking a signature doesn't
+    change the hash state
+    :param rr_set: The RRset, already in canonical order (see canonical.canonical_order)
+    :param rrsig_record: The RRSIG record
+    :param domain: The domain name of the RRSIG
+    :return: A hash object over the data
+    :raises KeyError: if the RRSIG algorithm is not supported
+    """
+    hasher = ALGORITHMS[rrsig_record.algorithm].new_hash()
+    for chunk in signedDataChunks(rr_set, rrsig_record, domain):
+        hasher.update(chunk)
+    return hasher
 
 
-def createDSRecord(dnskey, domain):
+def createDSRecord(dnskey, domain, digest_type=2):
     """
-    A DS record is just the hash of a public key. Uses SHA256
+    A DS record is just the hash of a public key
+    https://tools.ietf.org/html/rfc4034#section-5.1.4
     :param dnskey: The DNSKEY record
     :param domain: The domain name
-    :return: The SHA256 hash of the DNSKEY record
+    :param digest_type: The DS digest type, SHA256 by default (see DIGEST_TYPES)
+    :return: The hash of the DNSKEY record
+    :raises KeyError: if the digest type is not supported
     """
-    data = formatName(domain)
+    hasher = DIGEST_TYPES[digest_type].new(formatName(domain))
+    hasher.update(dnskey.rdata)
+    return hasher.digest()
 
-    data += dnskey.rdata
 
-    hasher = SHA256.new()
-    hasher.update(data)
-    return hasher.digest()
+class LRUCache:
+    """
+    A bounded cache which builds what it doesn't have, dropping the least recently used entry once full
+    """
+
+    def __init__(self, max_size):
+        """
+        :param max_size: Most entries to keep
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, cache_key, build, *args):
+        """
+        Returns the cached value for a key, building and caching it if it hasn't been used recently
+        :param cache_key: The key
+        :param build: Function making the value on a miss
+        :param args: Arguments for build
+        :return: The value
+        """
+        value = self.entries.get(cache_key)
+        if value is not None:
+            self.hits += 1
+            self.entries.move_to_end(cache_key)
+            return value
+        self.misses += 1
+        value = self.entries[cache_key] = build(*args)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return value
+
+    def clear(self):
+        """
+        Drops every entry and resets the counters
+        :return: None
+        """
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class FingerprintCache(LRUCache):
+    """
+    A bounded LRU cache of DNSKEY digests, keyed by (owner, digest type, DNSKEY rdata). Each key is hashed
+    once however many DS records it gets checked against, like during a key rollover
+    """
+    DEFAULT_MAX_SIZE = 1024
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        LRUCache.__init__(self, max_size)
+
+    def get(self, dnskey, domain, digest_type):
+        """
+        Returns the digest of a DNSKEY, hashing it if it hasn't been seen recently
+        :param dnskey: The DNSKEY record
+        :param domain: The owner of the DNSKEY, a string or DomainName
+        :param digest_type: The DS digest type
+        :return: The digest bytes
+        :raises KeyError: if the digest type is not supported
+        """
+        cache_key = (DomainName.get(domain), digest_type, bytes(dnskey.rdata))
+        return self.lookup(cache_key, createDSRecord, dnskey, domain, digest_type)
+
+    def fingerprints(self, keys, domain, digest_type):
+        """
+        Builds a lookup table of a zone's DNSKEYs, so a DS can be matched with a single dict lookup
+        :param keys: The DNSKEY records
+        :param domain: The owner of the DNSKEYs
+        :param digest_type: The DS digest type
+        :return: A dict of (key tag, algorithm, digest) -> DNSKEY record
+        """
+        return {(key.key_tag, key.algorithm, self.get(key, domain, digest_type)): key for key in keys}
+
+
+# DS digest type -> hash module
+# https://www.iana.org/assignments/ds-rr-types/ds-rr-types.xhtml
+DIGEST_TYPES = {1: SHA1, 2: SHA256, 4: SHA384}
+
+# Shared by every DS match
+fingerprint_cache = FingerprintCache()
+
+
+def compute_key_tag(rdata, algorithm):
+    """
+    Computes the key tag of a DNSKEY, which RRSIG and DS records use to say which key they refer to
+    https://tools.ietf.org/html/rfc4034#appendix-B
+    :param rdata: The DNSKEY RDATA
+    :param algorithm: The DNSKEY algorithm
+    :return: The 16 bit key tag
+    """
+    if algorithm == 1:
+        # RSA/MD5 keys use the 3rd and 2nd to last bytes of the modulus instead
+        return int.from_bytes(rdata[-3:-1], 'big')
+    # Sum the RDATA as big endian 16 bit words, then fold the carry back in
+    total = sum(rdata[0::2]) << 8
+    total += sum(rdata[1::2])
+    total += (total >> 16) & 0xFFFF
+    return total & 0xFFFF
+
+
+def index_keys(keys):
+    """
+    Groups DNSKEYs by (key tag, algorithm), so an RRSIG or DS only needs to be checked against the keys it names
+    :param keys: A list of DNSKEY records
+    :return: A dict of (key tag, algorithm) -> list of DNSKEY records
+    """
+    index = {}
+    for key in keys:
+        index.setdefault((key.key_tag, key.algorithm), []).append(key)
+    return index
 
 
 def formatName(name):
     """
-    Puts a domain name into that form DNS loves so much
-    :param name: A domain name string
+    Puts a domain name into that form DNS loves so much. Names used in signatures and digests
+    must be in canonical (lowercase) form
+    :param name: A domain name string or DomainName
     :return: The name formatting for verification use
     """
-    name_bytes = bytearray(len(name) + 2)
-    i = 0
-    for domain in name.split('.'):
-        name_bytes[i] = len(domain)
-        i += 1
-        insertBytes(name_bytes, domain.encode('utf-8', 'strict'), i)
-        i += len(domain)
-    name_bytes[i] = 0
-    return name_bytes
+    return DomainName.get(name).canonical
 
 
 def RRSignableData(rr, owner, orig_ttl):
@@ -73,13 +222,193 @@ def RRSignableData(rr, owner, orig_ttl):
     owner is the domain owner (EX: 'example.com', 'com'). This TECHNICALLY should
     be in the rr, but we never figured out the pointer name storage thing
     :param rr: The Resource record
-    :param owner: The owner of the RR
+    :param owner: The owner of the RR, a string or DomainName
     :param orig_ttl: original TTL from RRSIG record
     :return: The data set for verification
     """
-    formatted_owner = formatName(owner)
-    return formatted_owner + rr.type.to_bytes(2, 'big') + rr.clazz.to_bytes(2, 'big') + \
-           orig_ttl.to_bytes(4, 'big') + rr.rdata_len.to_bytes(2, 'big') + rr.rdata
+    return formatName(owner) + RR_FIXED.pack(rr.type, rr.clazz, orig_ttl, rr.rdata_len) + rr.rdata
+
+
+class VerifierCache(LRUCache):
+    """
+    A bounded LRU cache of ready to use signature verifiers, keyed by DNSKEY rdata. Parsing a key and building
+    the key object costs far more than the verify itself, and the same few keys sign almost everything
+    """
+    DEFAULT_MAX_SIZE = 256
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, build=None):
+        """
+        :param max_size: Most verifiers to keep
+        :param build: Function turning a DNSKEY into a verifier. Defaults to an RSA PKCS#1 v1.5 verifier
+        """
+        LRUCache.__init__(self, max_size)
+        self.build = build if build is not None else build_rsa_verifier
+
+    def get(self, dnskey):
+        """
+        Returns the verifier for a DNSKEY, building and caching it if this key hasn't been seen recently
+        :param dnskey: The DNSKEY record
+        :return: The verifier for the key
+        """
+        return self.lookup(bytes(dnskey.rdata), self.build, dnskey)
+
+
+def build_rsa_verifier(dnskey):
+    """
+    :param dnskey: An RSA DNSKEY record
+    :return: A PKCS1_v1_5 verifier for the key
+    """
+    expo, mod = get_expo_and_mod(dnskey)
+    return PKCS1_v1_5.new(RSA.construct((mod, expo)))
+
+
+class _MessageBuffer:
+    """
+    Stands in for a hash object for algorithms which sign the whole message rather than a digest of it
+    """
+
+    def __init__(self, data=b''):
+        self.data = bytearray(data)
+
+    def update(self, data):
+        self.data += data
+
+
+class Algorithm(ABC):
+    """
+    A DNSSEC signing algorithm. Knows which hash the signed data goes through, and how to check a signature
+    with a DNSKEY. Each algorithm keeps its own cache of key objects. Subclasses must provide build_verifier
+    and verify
+    https://www.iana.org/assignments/dns-sec-alg-numbers/dns-sec-alg-numbers.xhtml
+    """
+
+    def __init__(self, number, name, hash_module):
+        self.number = number
+        self.name = name
+        self.hash_module = hash_module
+        self.cache = VerifierCache(build=self.build_verifier)
+
+    def new_hash(self, data=b''):
+        """
+        :param data: Data to start the hash with
+        :return: A hash object to feed the signed data into
+        """
+        return self.hash_module.new(data)
+
+    @abstractmethod
+    def build_verifier(self, dnskey):
+        """
+        Turns a DNSKEY into a verifier object
+        :param dnskey: The DNSKEY record
+        :return: The verifier
+        """
+
+    @abstractmethod
+    def verify(self, verifier, hasher, signature):
+        """
+        Checks a signature
+        :param verifier: The verifier from build_verifier
+        :param hasher: The hash object from new_hash, holding the signed data
+        :param signature: The signature from the RRSIG
+        :return: True if the signature is good, false otherwise
+        """
+
+
+class RSAAlgorithm(Algorithm):
+    """
+    RSA with PKCS#1 v1.5 padding
+    https://tools.ietf.org/html/rfc3110 https://tools.ietf.org/html/rfc5702
+    """
+
+    def build_verifier(self, dnskey):
+        return build_rsa_verifier(dnskey)
+
+    def verify(self, verifier, hasher, signature):
+        return verifier.verify(hasher, signature)
+
+
+class ECDSAAlgorithm(Algorithm):
+    """
+    ECDSA. Keys are the raw X and Y coordinates, and signatures the raw r and s values
+    https://tools.ietf.org/html/rfc6605
+    """
+
+    def __init__(self, number, name, hash_module, curve, size):
+        Algorithm.__init__(self, number, name, hash_module)
+        self.curve = curve
+        # Length of one coordinate in bytes
+        self.size = size
+
+    def build_verifier(self, dnskey):
+        key = bytes(dnskey.key)
+        if len(key) != 2 * self.size:
+            raise ValueError("Bad {0} key length {1}".format(self.name, len(key)))
+        point = ECC.construct(curve=self.curve, point_x=int.from_bytes(key[:self.size], 'big'),
+                              point_y=int.from_bytes(key[self.size:], 'big'))
+        return DSS.new(point, 'fips-186-3')
+
+    def verify(self, verifier, hasher, signature):
+        try:
+            verifier.verify(hasher, signature)
+            return True
+        except ValueError:
+            return False
+
+
+class EdDSAAlgorithm(Algorithm):
+    """
+    Pure EdDSA, which signs the whole message, so the signed data is buffered instead of hashed
+    https://tools.ietf.org/html/rfc8080
+    """
+
+    def __init__(self, number, name):
+        Algorithm.__init__(self, number, name, None)
+
+    def new_hash(self, data=b''):
+        return _MessageBuffer(data)
+
+    def build_verifier(self, dnskey):
+        return eddsa.new(eddsa.import_public_key(bytes(dnskey.key)), 'rfc8032')
+
+    def verify(self, verifier, hasher, signature):
+        try:
+            verifier.verify(bytes(hasher.data), signature)
+            return True
+        except ValueError:
+            return False
+
+
+# Algorithm number -> Algorithm. The numbers match DNSPacket.ALGO_TYPE_*, which can't be imported here
+ALGORITHMS = {}
+
+
+def register_algorithm(algorithm):
+    """
+    Adds support for an algorithm, replacing any already registered under its number
+    :param algorithm: The Algorithm
+    :return: None
+    """
+    ALGORITHMS[algorithm.number] = algorithm
+
+
+def get_algorithm(number):
+    """
+    :param number: The algorithm number from a DNSKEY or RRSIG
+    :return: The Algorithm, or None if it isn't supported
+    """
+    return ALGORITHMS.get(number)
+
+
+register_algorithm(RSAAlgorithm(5, 'RSASHA1', SHA1))
+register_algorithm(RSAAlgorithm(7, 'RSASHA1-NSEC3-SHA1', SHA1))
+register_algorithm(RSAAlgorithm(8, 'RSASHA256', SHA256))
+register_algorithm(RSAAlgorithm(10, 'RSASHA512', SHA512))
+register_algorithm(ECDSAAlgorithm(13, 'ECDSAP256SHA256', SHA256, 'P-256', 32))
+register_algorithm(ECDSAAlgorithm(14, 'ECDSAP384SHA384', SHA384, 'P-384', 48))
+register_algorithm(EdDSAAlgorithm(15, 'ED25519'))
+
+# The RSASHA256 key cache, by far the most used
+verifier_cache = ALGORITHMS[8].cache
 
 
 def verify_signature(signature, key, recordset):
@@ -87,13 +416,20 @@ def verify_signature(signature, key, recordset):
     Verifies a signature
     :param signature:  The signature
     :param key: The key
-    :param recordset: The recordset to verify
-    :return: True if verified, false otherwise
+    :param recordset: The recordset to verify, as bytes or as a hash object from hashRRSetData
+    :return: True if verified, false otherwise (including when the key's algorithm isn't supported)
     """
-    expo, mod = get_expo_and_mod(key)
-    constructed_key = RSA.construct((mod, expo))
-    cipher = PKCS1_v1_5.new(constructed_key)
-    return cipher.verify(SHA256.new(recordset), signature)
+    algorithm = ALGORITHMS.get(key.algorithm)
+    if algorithm is None:
+        return False
+    if isinstance(recordset, (bytes, bytearray, memoryview)):
+        recordset = algorithm.new_hash(recordset)
+    try:
+        verifier = algorithm.cache.get(key)
+    except ValueError:
+        # A malformed key can't verify anything
+        return False
+    return algorithm.verify(verifier, recordset, signature)
 
 
 def get_expo_and_mod(dnskey):
@@ -0,0 +1,99 @@
+"""
+One shared object per domain name, holding every form of the name the resolver needs, worked out once
+"""
+
+import weakref
+
+from canonical import canonical_name
+
+
+class DomainName:
+    """
+    An interned domain name. Get one with DomainName.get, which hands back the same object for every spelling
+    of a name ('Example.COM', 'example.com.'), so names compare by identity and hash in constant time.
+    Names only live as long as something uses them
+    """
+    __slots__ = ('text', 'wire', 'canonical', 'label_count', '_hash', '_ancestors', '__weakref__')
+
+    # Canonical text -> DomainName
+    _interned = weakref.WeakValueDictionary()
+
+    def __init__(self, text):
+        labels = [label for label in text.split('.') if label != '']
+        self.text = '.'.join(labels)
+        wire = bytearray()
+        for label in labels:
+            label_bytes = label.encode('utf-8', 'strict')
+            wire.append(len(label_bytes))
+            wire += label_bytes
+        wire.append(0)
+        self.wire = bytes(wire)
+        self.canonical = canonical_name(self.text)
+        self.label_count = len(labels)
+        self._hash = hash(self.canonical)
+        self._ancestors = None
+
+    @classmethod
+    def get(cls, name):
+        """
+        Looks up the interned DomainName for a name
+        :param name: A domain name string (EX: 'example.com'), or a DomainName
+        :return: The DomainName
+        """
+        if isinstance(name, DomainName):
+            return name
+        key = name.lower().strip('.')
+        domain = cls._interned.get(key)
+        if domain is None:
+            domain = cls._interned.setdefault(key, cls(name))
+        return domain
+
+    @classmethod
+    def from_wire(cls, wire):
+        """
+        Looks up the interned DomainName for an uncompressed wire format name
+        :param wire: The name bytes, as returned by util.read_name
+        :return: The DomainName
+        :raises ValueError: if a label isn't valid UTF-8 or has a '.' in it
+        """
+        labels = []
+        i = 0
+        while wire[i] != 0:
+            label = bytes(wire[i + 1:i + 1 + wire[i]]).decode('utf-8', 'strict')
+            if '.' in label:
+                raise ValueError("Label {0!r} has a '.' in it".format(label))
+            labels.append(label)
+            i += 1 + wire[i]
+        return cls.get('.'.join(labels))
+
+    @property
+    def parent(self):
+        """
+        :return: The DomainName one label up, or None for the root
+        """
+        ancestors = self.ancestors()
+        return ancestors[1] if len(ancestors) > 1 else None
+
+    def ancestors(self):
+        """
+        Lists the name and every name above it
+        :return: A tuple of DomainNames from this one up to and including the root
+        """
+        if self._ancestors is None:
+            labels = self.text.split('.') if self.label_count > 0 else []
+            self._ancestors = (self,) + tuple(DomainName.get('.'.join(labels[i:])) for i in range(1, len(labels) + 1))
+        return self._ancestors
+
+    def __eq__(self, other):
+        if isinstance(other, DomainName):
+            return self.canonical == other.canonical
+        return NotImplemented
+
+    def __hash__(self):
+        return self._hash
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return "DomainName({0!r})".format(self.text)
@@ -1,58 +1,469 @@
 """
 A file for networking functions
 
-We will be using UDP to send and receive packets.
+We will be using UDP to send and receive packets, and TCP when an answer is too big for UDP.
+Queries can go to a pool of resolvers, picking the fastest one that is up (see UpstreamPool).
 """
 
 import socket
 import select
-from DNSPacket import DNSPacket
+import struct
+import time
+from collections import defaultdict, deque
+
+from DNSPacket import DNSError, DNSPacket
+from util import dprint
+
+
+class RTTEstimator:
+    """
+    Smoothed round trip time to one resolver, and the retransmission timeout worked out from it
+    https://tools.ietf.org/html/rfc6298
+    """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+    # Clock granularity, the G of RFC 6298
+    GRANULARITY = 0.001
+    # Before the first answer, as RFC 6298 says
+    INITIAL_RTO = 1.0
+    # RFC 6298 rounds the RTO up to 1s, which is far too long for a single datagram to a nearby resolver.
+    # Like other DNS resolvers, a much lower floor is used instead
+    MIN_RTO = 0.05
+    MAX_RTO = 5.0
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = RTTEstimator.INITIAL_RTO
+
+    def sample(self, rtt):
+        """
+        Updates the estimate with a measured round trip. Only answers to queries sent once should be
+        measured, as there's no telling which copy of a retransmitted query was answered (Karn's algorithm)
+        :param rtt: Seconds from sending the query to getting the answer
+        :return: None
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTTEstimator.BETA) * self.rttvar + RTTEstimator.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTTEstimator.ALPHA) * self.srtt + RTTEstimator.ALPHA * rtt
+        rto = self.srtt + max(RTTEstimator.GRANULARITY, RTTEstimator.K * self.rttvar)
+        self.rto = min(max(rto, RTTEstimator.MIN_RTO), RTTEstimator.MAX_RTO)
+
+    def backoff(self):
+        """
+        Doubles the timeout after a query went unanswered. The next measured answer resets it
+        :return: None
+        """
+        self.rto = min(self.rto * 2, RTTEstimator.MAX_RTO)
+
+
+class Upstream:
+    """
+    Health of one resolver in an UpstreamPool
+    """
+    __slots__ = ('address', 'failures', 'down_until', 'probe_at', 'probe_interval', 'latencies')
+
+    def __init__(self, address):
+        self.address = address
+        # Queries in a row it didn't answer within its retransmission timeout
+        self.failures = 0
+        # When it may next be probed, or None while it is up
+        self.down_until = None
+        # When it may next be probed while it is up but hasn't been measured yet
+        self.probe_at = 0
+        self.probe_interval = UpstreamPool.PROBE_INTERVAL
+        # Recent round trip times
+        self.latencies = deque(maxlen=UpstreamPool.LATENCY_WINDOW)
+
+
+class UpstreamPool:
+    """
+    A set of resolvers to send queries to. Each query goes to the fastest one which is up, by smoothed
+    round trip time. Resolvers never measured yet, and down resolvers due a probe, are sent a copy of the
+    query alongside it (see probe), so a resolver which turns out to be dead never holds a query up.
+    A resolver which doesn't answer DOWN_AFTER queries in a row within its retransmission timeout is marked
+    down. Being beaten by another resolver before then doesn't count against it. Down resolvers are skipped,
+    except for one probe every probe interval, which doubles each time the probe fails.
+
+    With hedging on, a query not answered within the HEDGE_PERCENTILE latency of the resolver's recent
+    answers is sent to a second resolver as well, and whichever answers first wins. Without it, the query only moves to
+    another resolver once its retransmission timeout passes
+    """
+    DOWN_AFTER = 3
+    PROBE_INTERVAL = 5
+    MAX_PROBE_INTERVAL = 60
+    HEDGE_PERCENTILE = 0.95
+    # Answers needed before the percentile is trusted
+    HEDGE_SAMPLES = 20
+    LATENCY_WINDOW = 200
+
+    def __init__(self, addresses, hedge=False, rtt=None, clock=time.monotonic):
+        """
+        :param addresses: The (host, port) of each resolver
+        :param hedge: Send slow queries to a second resolver as well
+        :param rtt: Dict of address -> RTTEstimator to keep round trip times in. A new one if not given
+        :param clock: Function returning the current time
+        """
+        self.upstreams = {}
+        for host, port in addresses:
+            address = (socket.gethostbyname(host), int(port))
+            self.upstreams[address] = Upstream(address)
+        self.hedge = hedge
+        self.rtt = rtt if rtt is not None else defaultdict(RTTEstimator)
+        self.clock = clock
+
+    @property
+    def addresses(self):
+        return list(self.upstreams)
+
+    def is_down(self, address):
+        return self.upstreams[address].down_until is not None
+
+    def select(self, exclude=()):
+        """
+        Picks the resolver to send a query to next. Measured resolvers come before ones never measured
+        :param exclude: Addresses already tried for this query
+        :return: The address, or None if every resolver was excluded
+        """
+        candidates = [upstream for upstream in self.upstreams.values() if upstream.address not in exclude]
+        if len(candidates) == 0:
+            return None
+        up = [upstream for upstream in candidates if upstream.down_until is None]
+        if len(up) == 0:
+            # Everything left is down. Try the one due a probe soonest rather than nothing
+            return min(candidates, key=lambda upstream: upstream.down_until).address
+        return min(up, key=lambda upstream: (self.rtt[upstream.address].srtt is None,
+                                             self.rtt[upstream.address].srtt or 0)).address
+
+    def probe(self, exclude=()):
+        """
+        Picks a resolver to send an extra copy of a query to, alongside the one from select: a down
+        resolver due a probe, or one never measured yet. Nothing waits on the copy, but an answer to it
+        brings the resolver back up or measures it. Each is probed at most once per probe interval
+        :param exclude: Addresses the query is already going to
+        :return: The address, or None if nothing needs probing
+        """
+        now = self.clock()
+        for upstream in self.upstreams.values():
+            if upstream.address in exclude:
+                continue
+            if upstream.down_until is not None:
+                if upstream.down_until <= now:
+                    # Hold off any other probes until this one has had its chance
+                    upstream.down_until = now + upstream.probe_interval
+                    dprint("Probing {0}".format(upstream.address))
+                    return upstream.address
+            elif self.rtt[upstream.address].srtt is None and upstream.probe_at <= now:
+                upstream.probe_at = now + upstream.probe_interval
+                return upstream.address
+        return None
+
+    def retry_delay(self, address):
+        """
+        How long to wait for an answer from a resolver before sending the query again, to it or elsewhere
+        :param address: The resolver address
+        :return: Seconds
+        """
+        rto = self.rtt[address].rto
+        latencies = self.upstreams[address].latencies
+        if not self.hedge or len(self.upstreams) < 2 or len(latencies) < UpstreamPool.HEDGE_SAMPLES:
+            return rto
+        latencies = sorted(latencies)
+        return min(rto, latencies[int(UpstreamPool.HEDGE_PERCENTILE * (len(latencies) - 1))])
+
+    def answered(self, address, rtt=None):
+        """
+        Records that a resolver answered a query first
+        :param address: The resolver address
+        :param rtt: The measured round trip, or None if the query was sent to it more than once
+        :return: None
+        """
+        upstream = self.upstreams[address]
+        upstream.failures = 0
+        if upstream.down_until is not None:
+            dprint("{0} is back up".format(address))
+            upstream.down_until = None
+            upstream.probe_interval = UpstreamPool.PROBE_INTERVAL
+        if rtt is not None:
+            self.rtt[address].sample(rtt)
+            upstream.latencies.append(rtt)
+
+    def failed(self, address):
+        """
+        Records that a resolver didn't answer a query within its retransmission timeout
+        :param address: The resolver address
+        :return: None
+        """
+        upstream = self.upstreams[address]
+        upstream.failures += 1
+        if upstream.down_until is not None:
+            # The probe failed too
+            upstream.probe_interval = min(upstream.probe_interval * 2, UpstreamPool.MAX_PROBE_INTERVAL)
+            upstream.down_until = self.clock() + upstream.probe_interval
+        elif upstream.failures >= UpstreamPool.DOWN_AFTER:
+            dprint("{0} is down".format(address))
+            upstream.down_until = self.clock() + upstream.probe_interval
+
+    def __len__(self):
+        return len(self.upstreams)
+
+
+class TCPConnection:
+    """
+    A persistent DNS over TCP connection to one resolver. Queries are pipelined, and answers may
+    come back in any order, so they are matched to queries by ID
+    https://tools.ietf.org/html/rfc7766#section-6.2.1
+    """
+    TIMEOUT = 5
+    # Close the connection ourselves after this long unused, before the server does it for us
+    IDLE_TIMEOUT = 10
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.sock = None
+        self.last_used = 0
+        # Answers which arrived while waiting on a different query, by ID
+        self.responses = {}
+
+    def connect(self):
+        self.close()
+        self.sock = socket.create_connection((self.addr[0], int(self.addr[1])), UDPCommunication.TIMEOUT)
+        self.last_used = time.monotonic()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.responses.clear()
+
+    def is_idle(self):
+        return time.monotonic() - self.last_used > TCPConnection.IDLE_TIMEOUT
+
+    def recv_exact(self, length):
+        """
+        Reads exactly length bytes from the connection
+        :param length: Number of bytes to read
+        :return: The bytes
+        """
+        data = bytearray()
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                raise ConnectionError("Connection closed by resolver")
+            data += chunk
+        return bytes(data)
+
+    def exchange(self, packets):
+        """
+        Sends every query down the connection, then reads answers until each query has one
+        :param packets: The query packets
+        :return: The raw answers, in the same order as packets
+        """
+        self.sock.sendall(b''.join(len(packet.bytes).to_bytes(2, 'big') + packet.bytes for packet in packets))
+        answers = []
+        for packet in packets:
+            while packet.id not in self.responses:
+                length = int.from_bytes(self.recv_exact(2), 'big')
+                data = self.recv_exact(length)
+                self.responses[int.from_bytes(data[:2], 'big')] = data
+            answers.append(self.responses.pop(packet.id))
+        self.last_used = time.monotonic()
+        return answers
+
+    def query_many(self, packets):
+        """
+        Sends pipelined queries, reconnecting if the connection has gone idle or the server dropped it
+        :param packets: The query packets. Their IDs must all be different
+        :return: The response packets, in the same order as packets
+        """
+        if self.sock is None or self.is_idle():
+            self.connect()
+        try:
+            answers = self.exchange(packets)
+        except (OSError, ConnectionError):
+            # Servers may close idle connections at any time. Try once more on a fresh one
+            dprint("TCP connection to {0} lost, reconnecting".format(self.addr))
+            self.connect()
+            answers = self.exchange(packets)
+        return [DNSPacket.newFromBytes(data, packet.id) for data, packet in zip(answers, packets)]
+
+
+class TCPConnectionPool:
+    """
+    Keeps one persistent TCP connection per resolver
+    """
+
+    def __init__(self):
+        self.connections = {}
+
+    def query(self, addr, packet):
+        """
+        Sends one query over TCP
+        :param addr: The resolver address
+        :param packet: The query packet
+        :return: The response packet
+        """
+        return self.query_many(addr, [packet])[0]
+
+    def query_many(self, addr, packets):
+        """
+        Sends several queries over one TCP connection without waiting for each answer
+        :param addr: The resolver address
+        :param packets: The query packets
+        :return: The response packets, in the same order as packets
+        """
+        connection = self.connections.get(addr)
+        if connection is None:
+            connection = self.connections[addr] = TCPConnection(addr)
+        return connection.query_many(packets)
+
+    def close_idle(self):
+        for connection in self.connections.values():
+            if connection.is_idle():
+                connection.close()
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections.clear()
 
 
 class UDPCommunication:
+    """
+    Sends queries over UDP, one at a time. Lost queries are sent again after a timeout that adapts to how
+    quickly each resolver usually answers, doubling on every retry. Given an UpstreamPool instead of an
+    address, retries go to the next best resolver in the pool, and the first answer from any of them wins
+    """
+    # Most time spent on one query, retries included
     TIMEOUT = 5
+    # Most times one query is sent
+    MAX_TRIES = 4
 
     def __init__(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind(('', 0))
         self.port = self.sock.getsockname()[1]
+        self.tcp_pool = TCPConnectionPool()
+        # Resolver address -> RTTEstimator
+        self.rtt = defaultdict(RTTEstimator)
+        # Single resolver address -> UpstreamPool of just that one
+        self.pools = {}
+
+    def upstreams(self, addr):
+        """
+        :param addr: A resolver address, or an UpstreamPool
+        :return: The UpstreamPool to send queries for addr to
+        """
+        if isinstance(addr, UpstreamPool):
+            return addr
+        pool = self.pools.get(addr)
+        if pool is None:
+            pool = self.pools[addr] = UpstreamPool([addr], rtt=self.rtt)
+        return pool
 
     def sendPacket(self, addr, packet):
         """
         Sends a packet to addr
-        :param addr: The address to send to
+        :param addr: The address to send to, or an UpstreamPool to pick one from
         :param packet: The packet to send
         :return: None
         """
-        self.addr = addr
+        self.pool = self.upstreams(addr)
+        self.packet = packet
         self.data = packet.bytes
+        self.packet_id = packet.id
+        self.started_at = time.monotonic()
+        # Resolver address -> (number of times sent there, time last sent)
+        self.attempts = {}
+        # Resolvers which were waited on for their whole retransmission timeout
+        self.timed_out = set()
+        self.send_to(self.pool.select())
+        probe = self.pool.probe(exclude=self.attempts)
+        if probe is not None:
+            # Not waited on, the retry delay stays that of the resolver picked above
+            self.attempts[probe] = (1, time.monotonic())
+            self.sock.sendto(self.data, probe)
+
+    def send_to(self, addr):
+        sends = self.attempts[addr][0] if addr in self.attempts else 0
+        self.addr = addr
+        self.sent_at = time.monotonic()
+        self.attempts[addr] = (sends + 1, self.sent_at)
         self.sock.sendto(self.data, addr)
 
+    def close(self):
+        self.sock.close()
+        self.tcp_pool.close()
+
+    def answered_by(self, addr):
+        """
+        Records which resolver won the query, and which other ones tried timed out
+        :param addr: The address the answer came from
+        :return: None
+        """
+        now = time.monotonic()
+        sends, sent_at = self.attempts[addr]
+        # Only answers to queries sent once are measured, as there's no telling which copy was answered
+        self.pool.answered(addr, now - sent_at if sends == 1 else None)
+        for other, (_, other_sent_at) in self.attempts.items():
+            # A copy sent later can lose just by starting later. Only one left waiting its whole timeout failed
+            if other != addr and (other in self.timed_out or now - other_sent_at >= self.pool.rtt[other].rto):
+                self.pool.failed(other)
+
     def waitForPacket(self):
         """
-        Waits for a response and returns the packet
+        Waits for a response and returns the packet. Each time the retry delay passes (the resolver's
+        retransmission timeout, or sooner when hedging) the query is sent again, to the next best resolver
+        if there is one. At most MAX_TRIES times, and TIMEOUT seconds in all
         :return: The packet
+        :raises DNSError: if the response code is an error, or no usable response arrives
         """
-        packet_id = 1
-        num_tries = 0
+        deadline = self.started_at + UDPCommunication.TIMEOUT
+        retry_at = min(self.sent_at + self.pool.retry_delay(self.addr), deadline)
+        num_tries = 1
         while True:
-            ready = select.select([self.sock], [], [], UDPCommunication.TIMEOUT)
-            if ready[0]:
-                data, addr = self.sock.recvfrom(4096)
-                packet = DNSPacket.newFromBytes(data, packet_id)
-                if not packet:
-                    print("Response Corrupted, retrying...")
-                    self.sock.sendto(self.data, self.addr)
-                    num_tries += 1
-                    if num_tries >= 3:
-                        print("Max tries reached")
-                        exit(0)
-                elif packet.tc:
-                    print("ERROR: Packet was truncated")
-                    break
-                else:
-                    return packet
-            else:
-                print("NORESPONSE")
-                exit(1)
+            now = time.monotonic()
+            if now >= retry_at:
+                if now - self.sent_at >= self.pool.rtt[self.addr].rto:
+                    # Timed out, rather than hedged early
+                    self.pool.rtt[self.addr].backoff()
+                    self.timed_out.add(self.addr)
+                if num_tries >= UDPCommunication.MAX_TRIES or now >= deadline:
+                    for addr in self.attempts:
+                        self.pool.failed(addr)
+                    raise DNSError('NORESPONSE', "No response after {0} tries".format(num_tries))
+                next_addr = self.pool.select(exclude=self.attempts)
+                self.send_to(next_addr if next_addr is not None else self.pool.select())
+                num_tries += 1
+                dprint("No response, sent again to {0}".format(self.addr))
+                retry_at = min(now + self.pool.retry_delay(self.addr), deadline)
+                continue
+            ready = select.select([self.sock], [], [], retry_at - now)
+            if not ready[0]:
+                continue
+            data, addr = self.sock.recvfrom(4096)
+            if int.from_bytes(data[:2], 'big') != self.packet_id or addr[:2] not in self.attempts:
+                # A late reply to an earlier query, or junk. Keep waiting for ours
+                continue
+            if DNSPacket.is_truncated(data):
+                self.answered_by(addr[:2])
+                dprint("Packet was truncated, retrying over TCP")
+                return self.tcp_pool.query(addr[:2], self.packet)
+            try:
+                packet = DNSPacket.newFromBytes(data, self.packet_id)
+            except DNSError:
+                self.answered_by(addr[:2])
+                raise
+            except (ValueError, IndexError, struct.error):
+                packet = None
+            if packet:
+                self.answered_by(addr[:2])
+                return packet
+            # Sending again straight away would just get the same answer. Wait for the timeout instead,
+            # in case the real answer is still on its way
+            dprint("Response Corrupted, waiting for another")
 
@@ -3,11 +3,22 @@ Contains Record types and methods for manipulating records
 """
 import binascii
 import struct
+import weakref
 import DNSPacket
-from datetime import datetime
+from crypto import compute_key_tag
 from base64 import b64encode
 
-from util import parse_name, skip_name, ts_to_dt
+from util import read_name, skip_name, ts_to_dt
+
+
+# ! = indicates "network" byte order and int sizes
+# I = unsigned int, 4 bytes
+# H = unisigned short, 2 bytes
+# B = unsigned char, 1 byte
+RECORD_HEADER = struct.Struct("!HHIH")
+DNSKEY_HEADER = struct.Struct("!2sBB")
+RRSIG_HEADER = struct.Struct("!HBBI4s4sH")
+DS_HEADER = struct.Struct("!HBB")
 
 
 class Record:
@@ -19,15 +30,35 @@ class Record:
         self.rdata_len = rdata_len
         self.rdata = rdata
 
+    @staticmethod
+    def decode_fields(data, start, end, names):
+        """
+        Decodes the type specific fields out of the RDATA
+        :param data: The bytes (or memoryview) of the packet
+        :param start: Index of the start of the RDATA
+        :param end: Index just past the end of the RDATA
+        :param names: The packet's name table
+        :return: A dict of field name -> value, matching the extra constructor arguments
+        """
+        return {}
+
 
 class ARecord(Record):
+    # Same as DNSPacket.RR_TYPE_A, which can't be used here because DNSPacket imports this module
+    TYPE = 1
+
     def __init__(self, name, type, clazz, ttl, rdata_len, rdata,
                  ip_addr, auth):
-        assert rdata_len == 4
+        if rdata_len != 4:
+            raise ValueError("A record RDATA is {0} bytes, not 4".format(rdata_len))
         Record.__init__(self, name, type, clazz, ttl, rdata_len, rdata)
         self.ip_addr = ip_addr
         self.auth = auth
 
+    @staticmethod
+    def decode_fields(data, start, end, names):
+        return {'ip_addr': bytes(data[start:end]), 'auth': "noauth"}
+
     def __str__(self):
         return "IP\t{0}.{1}.{2}.{3}".format(self.ip_addr[0],
                                             self.ip_addr[1],
@@ -36,13 +67,24 @@ class ARecord(Record):
 
 
 class DNSKeyRecord(Record):
+    # Same as DNSPacket.RR_TYPE_DNSKEY, which can't be used here because DNSPacket imports this module
+    TYPE = 48
+
     def __init__(self, name, type, clazz, ttl, rdata_len, rdata,
-                 flags, protocol, algorithm, key):
+                 flags, protocol, algorithm, key, key_tag=None):
         Record.__init__(self, name, type, clazz, ttl, rdata_len, rdata)
         self.flags = flags
         self.protocol = protocol
         self.algorithm = algorithm
         self.key = key
+        self.key_tag = key_tag if key_tag is not None else compute_key_tag(rdata, algorithm)
+
+    @staticmethod
+    def decode_fields(data, start, end, names):
+        flags, protocol, algorithm = DNSKEY_HEADER.unpack_from(data, start)
+        return {'flags': flags, 'protocol': protocol, 'algorithm': algorithm,
+                'key': bytes(data[start + DNSKEY_HEADER.size:end]),
+                'key_tag': compute_key_tag(data[start:end], algorithm)}
 
     def is_sep(self):
         return int.from_bytes(self.flags, 'big') >> 31 == 1
@@ -55,6 +97,9 @@ class DNSKeyRecord(Record):
 
 
 class RRSigRecord(Record):
+    # Same as DNSPacket.RR_TYPE_RRSIG, which can't be used here because DNSPacket imports this module
+    TYPE = 46
+
     def __init__(self, name, type, clazz, ttl, rdata_len, rdata,
                  type_covered, algorithm, labels, orig_ttl, expiration, inception, tag, signer_name, signature):
         super().__init__(name, type, clazz, ttl, rdata_len, rdata)
@@ -63,13 +108,22 @@ class RRSigRecord(Record):
         self.labels = labels
         self.orig_ttl = orig_ttl
         self.expiration = expiration
-        assert ts_to_dt(expiration) > datetime.today()
         self.inception = inception
-        assert ts_to_dt(inception) < datetime.today()
         self.tag = tag
         self.signer_name = signer_name
         self.signature = signature
 
+    @staticmethod
+    def decode_fields(data, start, end, names):
+        (type_covered, algorithm, labels, orig_ttl, expiration, inception,
+         tag) = RRSIG_HEADER.unpack_from(data, start)
+        count = start + RRSIG_HEADER.size
+        name_len, signer_name = read_name(data, count, names)
+        count += name_len
+        return {'type_covered': type_covered, 'algorithm': algorithm, 'labels': labels, 'orig_ttl': orig_ttl,
+                'expiration': expiration, 'inception': inception, 'tag': tag, 'signer_name': signer_name,
+                'signature': bytes(data[count:end])}
+
     def printable_signature(self):
         return str(b64encode(self.signature), encoding="utf-8")
 
@@ -80,6 +134,9 @@ class RRSigRecord(Record):
 
 
 class DSRecord(Record):
+    # Same as DNSPacket.RR_TYPE_DS, which can't be used here because DNSPacket imports this module
+    TYPE = 43
+
     def __init__(self, name, type, clazz, ttl, rdata_len, rdata,
                  key_id, algorithm, digest_type, digest):
         super().__init__(name, type, clazz, ttl, rdata_len, rdata)
@@ -88,6 +145,12 @@ class DSRecord(Record):
         self.digest_type = digest_type
         self.digest = digest
 
+    @staticmethod
+    def decode_fields(data, start, end, names):
+        key_id, algorithm, digest_type = DS_HEADER.unpack_from(data, start)
+        return {'key_id': key_id, 'algorithm': algorithm, 'digest_type': digest_type,
+                'digest': bytes(data[start + DS_HEADER.size:end])}
+
     def printable_digest(self):
         return str(binascii.hexlify(self.digest), 'utf-8').upper()
 
@@ -95,71 +158,206 @@ class DSRecord(Record):
         return "DS\t{}\t{}\t{}\t".format(self.key_id, self.algorithm, self.digest_type, self.printable_digest())
 
 
-def parse_record(bytes):
+class LazyRecord:
     """
-    Parses a record
-    :param bytes: The bytes starting at a record
-    :return: a record
+    Mixin for records parsed in lazy mode. Parsing only reads the fixed header and keeps the RDATA as a view
+    of the packet. The type specific fields are decoded the first time any of them is used
     """
-    i, name = parse_name(bytes)
-
-    # ! = indicates "network" byte order and int sizes
-    # I = unsigned int, 4 bytes
-    # H = unisigned short, 2 bytes
-    # B = unsigned char, 1 byte
-    (type, clazz, ttl, rdata_len) = struct.unpack("!HHIH", bytes[i:i + 10])
-    i += 10
-    rdata = bytes[i: i + rdata_len]
-
-    if type == DNSPacket.DNSPacket.RR_TYPE_A:
-        if rdata_len == 4:
-            ip_addr = bytes[i:i + 4]
-            return i + rdata_len, ARecord(name, type, clazz, ttl, rdata_len, rdata, ip_addr, "noauth")
-        else:
-            print("Error\tINVALID RDATA LEN FOR A RECORD")
-            return
-    elif type == DNSPacket.DNSPacket.RR_TYPE_DNSKEY:
-        count = i
-        flags = bytes[count:count + 2]
-        count += 2
-        protocol = ord(bytes[count:count + 1])
-        count += 1
-        algorithm = ord(bytes[count:count + 1])
-        count += 1
-        key = bytes[count:i + rdata_len]
-        return i + rdata_len, DNSKeyRecord(name, type, clazz, ttl, rdata_len, rdata, flags, protocol, algorithm, key)
-    elif type == DNSPacket.DNSPacket.RR_TYPE_RRSIG:
-        count = i + 2
-        type_covered = struct.unpack("!H", bytes[i:count])[0]
-        algorithm = ord(bytes[count:count + 1])
-        count += 1
-        labels = ord(bytes[count:count + 1])
-        count += 1
-        orig_ttl = struct.unpack("!I", bytes[count:count + 4])[0]
-        count += 4
-        expiration = bytes[count:count + 4]
-        count += 4
-        inception = bytes[count:count + 4]
-        count += 4
-        tag = struct.unpack("!H", bytes[count:count + 2])[0]
-        count += 2
-        name_len = skip_name(bytes[count:])  # TODO: Get signer's name
-        signer_name = bytes[count:count+name_len]
-        count += name_len
-        signature = bytes[count:i + rdata_len]
-        return i + rdata_len, RRSigRecord(name, type, clazz, ttl, rdata_len, rdata, type_covered, algorithm, labels,
-                                          orig_ttl, expiration, inception, tag, signer_name, signature)
-    elif type == DNSPacket.DNSPacket.RR_TYPE_DS:
-        count = i + 2
-        key_id = int(struct.unpack("!H", bytes[i:count])[0])
-        algorithm = ord(bytes[count:count + 1])
-        count += 1
-        digest_type = ord(bytes[count:count + 1])
-        count += 1
-        digest = bytes[count:i + rdata_len]
-        return i + rdata_len, DSRecord(name, type, clazz, ttl, rdata_len, rdata, key_id, algorithm, digest_type, digest)
-    else:
-        return i + rdata_len, None
+
+    def __getattr__(self, attr):
+        # Only called for attributes which aren't set, which are the undecoded fields
+        fields = self.__dict__
+        if attr.startswith('__') or 'packet' not in fields:
+            raise AttributeError(attr)
+        start = fields['rdata_start']
+        decoded = self.decode_fields(fields['packet'], start, start + self.rdata_len, fields['names'])
+        # Only stored once decoding succeeds, so a record that fails to decode fails on every access
+        del fields['packet'], fields['rdata_start'], fields['names']
+        fields.update(decoded)
+        return getattr(self, attr)
+
+
+class LazyARecord(LazyRecord, ARecord):
+    pass
+
+
+class LazyDNSKeyRecord(LazyRecord, DNSKeyRecord):
+    pass
+
+
+class LazyRRSigRecord(LazyRecord, RRSigRecord):
+    pass
+
+
+class LazyDSRecord(LazyRecord, DSRecord):
+    pass
+
+
+# Record type -> (record class, lazy record class)
+RECORD_CLASSES = {record_class.TYPE: (record_class, lazy_class) for record_class, lazy_class in (
+    (ARecord, LazyARecord), (DNSKeyRecord, LazyDNSKeyRecord), (RRSigRecord, LazyRRSigRecord), (DSRecord, LazyDSRecord))}
+
+
+def parse_record(data, offset=0, names=None, lazy=False):
+    """
+    Parses a record. Works on offsets into data, and only copies out the fields that make up the record
+    :param data: The bytes (or memoryview) of the packet holding the record
+    :param offset: Index of the start of the record
+    :param names: The packet's name table, for decompressing names (see util.read_name)
+    :param lazy: Leave the RDATA as a view of the packet and decode its fields on first use
+    :return: a tuple of (length of the record, record)
+    """
+    if names is None:
+        names = {}
+    name_len, name = read_name(data, offset, names)
+    i = offset + name_len
+
+    (type, clazz, ttl, rdata_len) = RECORD_HEADER.unpack_from(data, i)
+    i += RECORD_HEADER.size
+    end = i + rdata_len
+    length = end - offset
+
+    if type not in RECORD_CLASSES:
+        return length, None
+    if type == ARecord.TYPE and rdata_len != 4:
+        print("Error\tINVALID RDATA LEN FOR A RECORD")
+        return length, None
+
+    record_class, lazy_class = RECORD_CLASSES[type]
+    if lazy:
+        record = lazy_class.__new__(lazy_class)
+        Record.__init__(record, name, type, clazz, ttl, rdata_len, memoryview(data)[i:end])
+        record.packet = data
+        record.rdata_start = i
+        record.names = names
+        return length, record
+    fields = record_class.decode_fields(data, i, end, names)
+    return length, record_class(name, type, clazz, ttl, rdata_len, bytes(data[i:end]), **fields)
+
+
+class SharedName:
+    """
+    A wire format name shared between records. Holds the bytes, since bytes can't be weakly referenced
+    """
+    __slots__ = ('wire', '__weakref__')
+
+    def __init__(self, wire):
+        self.wire = wire
+
+
+# Names are repeated across thousands of cached records, so each distinct one is only kept once, and only
+# for as long as some record still has it
+_interned_names = weakref.WeakValueDictionary()
+
+
+def intern_name(name):
+    """
+    Returns the one shared copy of a wire format name
+    :param name: The name bytes
+    :return: The SharedName, shared by every record with this name
+    """
+    name = bytes(name)
+    shared = _interned_names.get(name)
+    if shared is None:
+        shared = _interned_names.setdefault(name, SharedName(name))
+    return shared
+
+
+class CompactRecord:
+    """
+    A small record for long lived caches. Uses __slots__ instead of a dict, shares its owner name
+    with every other record of the same name, and keeps only the RDATA. The type specific fields are
+    read out of the RDATA when asked for, instead of being stored a second time
+    """
+    __slots__ = ('_name', 'type', 'clazz', 'ttl', 'rdata')
+
+    def __init__(self, name, type, clazz, ttl, rdata):
+        self._name = intern_name(name)
+        self.type = type
+        self.clazz = clazz
+        self.ttl = ttl
+        self.rdata = bytes(rdata)
+
+    name = property(lambda self: self._name.wire)
+
+    @property
+    def rdata_len(self):
+        return len(self.rdata)
+
+
+class CompactARecord(CompactRecord):
+    __slots__ = ()
+    ip_addr = property(lambda self: self.rdata)
+    auth = "noauth"
+    __str__ = ARecord.__str__
+
+
+class CompactDNSKeyRecord(CompactRecord):
+    # The key tag is looked up constantly, so it is worth a slot
+    __slots__ = ('key_tag',)
+
+    def __init__(self, name, type, clazz, ttl, rdata):
+        CompactRecord.__init__(self, name, type, clazz, ttl, rdata)
+        self.key_tag = compute_key_tag(self.rdata, self.algorithm)
+
+    flags = property(lambda self: self.rdata[0:2])
+    protocol = property(lambda self: self.rdata[2])
+    algorithm = property(lambda self: self.rdata[3])
+    key = property(lambda self: self.rdata[DNSKEY_HEADER.size:])
+    is_sep = DNSKeyRecord.is_sep
+    printable_key = DNSKeyRecord.printable_key
+    __str__ = DNSKeyRecord.__str__
+
+
+class CompactRRSigRecord(CompactRecord):
+    # Signer names are shared between records just like owner names
+    __slots__ = ('_signer_name',)
+
+    def __init__(self, name, type, clazz, ttl, rdata, signer_name=None):
+        CompactRecord.__init__(self, name, type, clazz, ttl, rdata)
+        if signer_name is None:
+            signer_name = read_name(self.rdata, RRSIG_HEADER.size)[1]
+        self._signer_name = intern_name(signer_name)
+
+    signer_name = property(lambda self: self._signer_name.wire)
+    type_covered = property(lambda self: RRSIG_HEADER.unpack_from(self.rdata)[0])
+    algorithm = property(lambda self: self.rdata[2])
+    labels = property(lambda self: self.rdata[3])
+    orig_ttl = property(lambda self: RRSIG_HEADER.unpack_from(self.rdata)[3])
+    expiration = property(lambda self: self.rdata[8:12])
+    inception = property(lambda self: self.rdata[12:16])
+    tag = property(lambda self: RRSIG_HEADER.unpack_from(self.rdata)[6])
+    signature = property(lambda self: self.rdata[RRSIG_HEADER.size + skip_name(self.rdata, RRSIG_HEADER.size):])
+    printable_signature = RRSigRecord.printable_signature
+    __str__ = RRSigRecord.__str__
+
+
+class CompactDSRecord(CompactRecord):
+    __slots__ = ()
+    key_id = property(lambda self: DS_HEADER.unpack_from(self.rdata)[0])
+    algorithm = property(lambda self: self.rdata[2])
+    digest_type = property(lambda self: self.rdata[3])
+    digest = property(lambda self: self.rdata[DS_HEADER.size:])
+    printable_digest = DSRecord.printable_digest
+    __str__ = DSRecord.__str__
+
+
+COMPACT_CLASSES = {ARecord.TYPE: CompactARecord, DNSKeyRecord.TYPE: CompactDNSKeyRecord,
+                   RRSigRecord.TYPE: CompactRRSigRecord, DSRecord.TYPE: CompactDSRecord}
+
+
+def compact_record(record):
+    """
+    Converts a record into its compact form, for storing in a cache
+    :param record: Any record, including one already compact
+    :return: The compact record
+    """
+    if isinstance(record, CompactRecord):
+        return record
+    compact_class = COMPACT_CLASSES[record.type]
+    if compact_class is CompactRRSigRecord:
+        return CompactRRSigRecord(record.name, record.type, record.clazz, record.ttl, record.rdata, record.signer_name)
+    return compact_class(record.name, record.type, record.clazz, record.ttl, record.rdata)
 
 
 def print_record(record, rrsig, valid):
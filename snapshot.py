@@ -0,0 +1,318 @@
+"""
+Saves the chain cache to disk between runs, so short lived runs start with zones that are already validated
+
+File layout (all big endian):
+    header:  magic "DSCC", version (1 byte), number of zones (4 bytes)
+    zone:    expiry (8 byte double), number of DNSKEYs, DNSKEY RRSIGs and DS records (2 bytes each),
+             zone name length (1 byte), zone name
+    record:  type (2 bytes), ttl (4 bytes), rdata length (2 bytes), rdata
+Each zone is followed by its records, DNSKEYs first, then RRSIGs, then DS records.
+
+Zones added since the snapshot was last written are appended to a log next to it (the snapshot path plus
+'.log'), each as a block length (4 bytes) followed by the zone laid out as above. Loading reads both, and
+writing a snapshot folds the log back in.
+
+The same files double as a table of validated zones shared between live processes, see SharedChainCache.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from cache import ChainCache, ZoneEntry
+from domain_name import DomainName
+from records.Record import COMPACT_CLASSES
+
+MAGIC = b'DSCC'
+VERSION = 1
+
+HEADER = struct.Struct('!4sBI')
+ZONE = struct.Struct('!dHHHB')
+RECORD = struct.Struct('!HIH')
+LOG_BLOCK = struct.Struct('!I')
+
+# Where shared chain tables go by default. /dev/shm is memory backed, so the table never touches the disk
+MEMORY_DIR = '/dev/shm'
+SHARED_DIR = MEMORY_DIR if os.path.isdir(MEMORY_DIR) else tempfile.gettempdir()
+
+
+def record_from_rdata(owner, type, ttl, rdata):
+    """
+    Rebuilds a record object from its RDATA
+    :param owner: The owner name of the record
+    :param type: The record type
+    :param ttl: The record TTL
+    :param rdata: The RDATA bytes
+    :return: The compact record
+    """
+    return COMPACT_CLASSES[type](DomainName.get(owner).canonical, type, 1, ttl, rdata)
+
+
+def load_snapshot(path, chain_cache):
+    """
+    Loads zones from a snapshot file and its log into a chain cache. Expired zones are dropped. A missing or
+    unreadable file just loads nothing
+    :param path: The snapshot file
+    :param chain_cache: The ChainCache to load into
+    :return: Number of zones loaded
+    """
+    return _load_file(path, chain_cache) + read_log(path, chain_cache)[1]
+
+
+def _load_file(path, chain_cache):
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                return 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return _read_zones(data, chain_cache)
+    except (OSError, ValueError, KeyError, IndexError, struct.error):
+        return 0
+
+
+def _read_zones(data, chain_cache):
+    magic, version, num_zones = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        return 0
+    now = chain_cache.clock()
+    loaded = 0
+    offset = HEADER.size
+    for _ in range(num_zones):
+        offset, entry = _read_zone(data, offset, now)
+        if entry is not None:
+            chain_cache.put(entry)
+            loaded += 1
+    return loaded
+
+
+def _read_zone(data, offset, now):
+    """
+    Reads one zone
+    :param data: The file contents
+    :param offset: Index of the start of the zone
+    :param now: The current time
+    :return: Tuple of (index just past the zone, ZoneEntry or None if it has expired)
+    """
+    expires, num_keys, num_rrsigs, num_ds, name_len = ZONE.unpack_from(data, offset)
+    offset += ZONE.size
+    zone = bytes(data[offset:offset + name_len]).decode('utf-8')
+    offset += name_len
+    if expires <= now:
+        # Skip over the records without building them
+        for _ in range(num_keys + num_rrsigs + num_ds):
+            offset += RECORD.size + RECORD.unpack_from(data, offset)[2]
+        return offset, None
+    records = []
+    for _ in range(num_keys + num_rrsigs + num_ds):
+        type, ttl, rdata_len = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        records.append(record_from_rdata(zone, type, ttl, data[offset:offset + rdata_len]))
+        offset += rdata_len
+    keys = records[:num_keys]
+    key_rrsigs = records[num_keys:num_keys + num_rrsigs]
+    ds_records = records[num_keys + num_rrsigs:]
+    return offset, ZoneEntry(zone, keys, key_rrsigs, ds_records, expires)
+
+
+def _zone_bytes(entry):
+    zone = entry.zone.text.encode('utf-8')
+    parts = [ZONE.pack(entry.expires, len(entry.keys), len(entry.key_rrsigs), len(entry.ds_records), len(zone)),
+             zone]
+    for record in entry.keys + entry.key_rrsigs + entry.ds_records:
+        parts.append(RECORD.pack(record.type, record.ttl, len(record.rdata)))
+        parts.append(bytes(record.rdata))
+    return b''.join(parts)
+
+
+def _write_zones(f, entries):
+    f.write(HEADER.pack(MAGIC, VERSION, len(entries)))
+    for entry in entries:
+        f.write(_zone_bytes(entry))
+
+
+def read_log(path, chain_cache, offset=0):
+    """
+    Loads the zones appended to a snapshot's log. A block still being written is left for next time
+    :param path: The snapshot file
+    :param chain_cache: The ChainCache to load into
+    :param offset: Where in the log to start, from an earlier call
+    :return: Tuple of (offset to start from next time, number of zones loaded)
+    """
+    try:
+        with open(path + '.log', 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+    except OSError:
+        return offset, 0
+    now = chain_cache.clock()
+    loaded = 0
+    start = 0
+    while start + LOG_BLOCK.size <= len(data):
+        end = start + LOG_BLOCK.size + LOG_BLOCK.unpack_from(data, start)[0]
+        if end > len(data):
+            break
+        try:
+            entry = _read_zone(data, start + LOG_BLOCK.size, now)[1]
+        except (ValueError, KeyError, IndexError, struct.error):
+            entry = None
+        if entry is not None:
+            chain_cache.put(entry)
+            loaded += 1
+        start = end
+    return offset + start, loaded
+
+
+def append_log(path, entries):
+    """
+    Appends zones to a snapshot's log, without touching what is already there. Each call is a single
+    write to a file opened for appending, so blocks from different processes never interleave
+    :param path: The snapshot file
+    :param entries: The ZoneEntrys to add
+    :return: Size of the log afterwards
+    """
+    blocks = []
+    for entry in entries:
+        zone = _zone_bytes(entry)
+        blocks.append(LOG_BLOCK.pack(len(zone)))
+        blocks.append(zone)
+    # Shared, so appends go ahead side by side, but never while save_snapshot is folding the log away
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_SH)
+        try:
+            fd = os.open(path + '.log', os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, b''.join(blocks))
+                return os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def in_memory(path):
+    """
+    :param path: A file path
+    :return: True if the file lives in memory rather than on a disk
+    """
+    return os.path.dirname(os.path.abspath(path)) == MEMORY_DIR
+
+
+def save_snapshot(path, chain_cache):
+    """
+    Writes the chain cache to a snapshot file, merged with whatever other processes have written there,
+    and empties the log. Writers take turns using a lock file, and the new snapshot is renamed into place
+    so readers never see a half written file. Only snapshots on a disk are synced
+    :param path: The snapshot file
+    :param chain_cache: The ChainCache to save
+    :return: Number of zones written
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            merged = ChainCache(clock=chain_cache.clock)
+            load_snapshot(path, merged)
+            for entry in chain_cache.entries():
+                merged.put(entry)
+            entries = merged.entries()
+
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.dnscache-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    _write_zones(f, entries)
+                    if not in_memory(path):
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.replace(temp_path, path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+            # Everything in the log is in the snapshot now. Readers notice the log is gone and start over
+            if os.path.exists(path + '.log'):
+                os.unlink(path + '.log')
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+    return len(entries)
+
+
+class SharedChainCache(ChainCache):
+    """
+    A ChainCache shared between processes through a snapshot file and its log, so a zone validated by one
+    process isn't validated again by the others. Zones validated here are appended to the log straight away,
+    and a miss reads whatever other processes have appended since the last look. Once the log passes
+    COMPACT_BYTES it is folded into the snapshot. Kept under SHARED_DIR the files are a table in shared memory
+    """
+    COMPACT_BYTES = 1024 * 1024
+
+    def __init__(self, path, clock=time.time):
+        """
+        :param path: The shared snapshot file
+        :param clock: Function returning the current time
+        """
+        ChainCache.__init__(self, clock)
+        self.path = path
+        self.loaded_version = None
+        # Inode of the log, and how far into it has been read
+        self.log_inode = None
+        self.log_offset = 0
+        self.reload()
+
+    def file_version(self):
+        """
+        :return: Something which changes every time the snapshot is written, or None if there is no snapshot
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        # Writers rename a new file into place, so the inode changes even within one mtime tick
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def reload(self):
+        """
+        Loads the snapshot again if it has been written since it was last loaded, and anything appended
+        to the log since it was last read
+        :return: True if anything was read
+        """
+        changed = False
+        version = self.file_version()
+        if version is not None and version != self.loaded_version:
+            self.loaded_version = version
+            _load_file(self.path, self)
+            # Folding the log in always writes the snapshot first, so whatever log is there now may be a new
+            # one, even if it got the old one's inode back
+            self.log_inode = None
+            self.log_offset = 0
+            changed = True
+        try:
+            log = os.stat(self.path + '.log')
+        except OSError:
+            # Folded into the snapshot
+            self.log_inode = None
+            self.log_offset = 0
+            return changed
+        if log.st_ino != self.log_inode:
+            self.log_inode = log.st_ino
+            self.log_offset = 0
+        if log.st_size > self.log_offset:
+            self.log_offset = read_log(self.path, self, self.log_offset)[0]
+            changed = True
+        return changed
+
+    def get(self, zone):
+        entry = ChainCache.get(self, zone)
+        if entry is None and self.reload():
+            entry = ChainCache.get(self, zone)
+        return entry
+
+    def put_chain(self, chain, parent_expires=float('inf')):
+        ChainCache.put_chain(self, chain, parent_expires)
+        entries = [ChainCache.get(self, link[0]) for link in chain]
+        entries = [entry for entry in entries if entry is not None]
+        if len(entries) == 0:
+            return
+        if append_log(self.path, entries) > SharedChainCache.COMPACT_BYTES:
+            save_snapshot(self.path, self)
@@ -0,0 +1,492 @@
+"""
+A local validating stub resolver. Listens for plain DNS queries over UDP and TCP, validates each answer through
+an upstream resolver with async_resolve, and answers with the AD bit set, or with SERVFAIL when validation fails.
+The chain cache and answer cache live as long as the server, so the validation work for a name is only done
+once per cache lifetime, however many applications look it up.
+
+Only A, DNSKEY and DS queries can be validated, anything else gets NOTIMP. Denial of existence isn't validated,
+so NXDOMAIN and empty answers are passed on with the AD bit clear.
+
+One process is held to one core by the GIL. ResolverWorkers runs several on the same port instead, with
+SO_REUSEPORT spreading the queries between them, sharing validated zones through a SharedChainCache.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import tempfile
+
+import util
+from async_resolver import AsyncUDPTransport, async_resolve
+from cache import AnswerCache, ChainCache
+from DNSPacket import HEADER_STRUCT, QUESTION_TAIL_STRUCT, DNSError, DNSPacket
+from domain_name import DomainName
+from records.Record import RECORD_HEADER
+from snapshot import SHARED_DIR, SharedChainCache, load_snapshot, save_snapshot
+from util import dprint, read_name, skip_name
+from validator import INVALID_RRSIG, MISSING_DS, NORESPONSE, NOTFOUND, RECORD_TYPES, VALID, ValidationResult
+
+RR_TYPE_OPT = 41
+# name (root), type, UDP payload size, extended rcode/version/flags, RDATA length
+OPT_RECORD = struct.Struct('!BHHIH')
+
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RCODE_NOTIMP = 4
+
+FLAG_QR = 0x8000
+FLAG_OPCODE = 0x7800
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+FLAG_AD = 0x0020
+EDNS_FLAG_DO = 0x8000
+
+# Largest UDP answer for a client that didn't send an OPT record
+# https://tools.ietf.org/html/rfc1035#section-4.2.1
+CLASSIC_UDP_SIZE = 512
+
+# Status of a lookup whose name exists but has no records of the type asked for
+NODATA = 'NODATA'
+
+
+class Query:
+    """
+    The parts of a client's query needed to answer it
+    """
+    __slots__ = ('id', 'flags', 'name', 'type', 'clazz', 'question', 'edns', 'dnssec_ok', 'payload_size')
+
+    def __init__(self, id, flags, name, type, clazz, question):
+        """
+        :param id: The query ID
+        :param flags: The flags field of the header
+        :param name: The question name, a DomainName
+        :param type: The question type
+        :param clazz: The question class
+        :param question: The question section as it was sent, to copy into the answer
+        """
+        self.id = id
+        self.flags = flags
+        self.name = name
+        self.type = type
+        self.clazz = clazz
+        self.question = question
+        self.edns = False
+        self.dnssec_ok = False
+        self.payload_size = CLASSIC_UDP_SIZE
+
+    @property
+    def opcode(self):
+        return (self.flags & FLAG_OPCODE) >> 11
+
+
+def parse_query(data):
+    """
+    Parses a query from a client, along with its OPT record if it has one
+    :param data: The query bytes
+    :return: The Query
+    :raises ValueError: if it isn't a query with exactly one question
+    """
+    packet_id, flags, num_questions, num_answers, num_authority, num_additional = HEADER_STRUCT.unpack_from(data, 0)
+    if flags & FLAG_QR or num_questions != 1:
+        raise ValueError("Not a query with one question")
+    name_len, wire = read_name(data, DNSPacket.HEADER_LEN)
+    offset = DNSPacket.HEADER_LEN + name_len
+    type, clazz = QUESTION_TAIL_STRUCT.unpack_from(data, offset)
+    offset += QUESTION_TAIL_STRUCT.size
+    query = Query(packet_id, flags, DomainName.from_wire(wire), type, clazz, bytes(data[DNSPacket.HEADER_LEN:offset]))
+
+    # Walk past any other records, looking for the OPT record in the additional section
+    for i in range(num_answers + num_authority + num_additional):
+        offset += skip_name(data, offset)
+        type, clazz, ttl, rdata_len = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size + rdata_len
+        if type == RR_TYPE_OPT and i >= num_answers + num_authority:
+            # The class field is the client's UDP payload size, and the DO bit is in the TTL field
+            # https://tools.ietf.org/html/rfc6891#section-6.1.2
+            query.edns = True
+            query.dnssec_ok = ttl & EDNS_FLAG_DO != 0
+            query.payload_size = max(clazz, CLASSIC_UDP_SIZE)
+    if offset > len(data):
+        raise ValueError("Query is cut short")
+    return query
+
+
+def build_response(query, rcode, records=(), authenticated=False, ttl=None, truncated=False):
+    """
+    Builds the answer to a client's query
+    :param query: The Query
+    :param rcode: The response code
+    :param records: The records for the answer section
+    :param authenticated: Set the AD bit, the records were validated
+    :param ttl: Upper bound for the record TTLs, or None to send them as they are
+    :param truncated: Set the TC bit, the answer didn't fit
+    :return: The response bytes
+    """
+    flags = FLAG_QR | (query.flags & (FLAG_OPCODE | FLAG_RD)) | FLAG_RA | rcode
+    if authenticated:
+        flags |= FLAG_AD
+    if truncated:
+        flags |= FLAG_TC
+    data = bytearray(HEADER_STRUCT.pack(query.id, flags, 1, len(records), 0, 1 if query.edns else 0))
+    data += query.question
+    for rr in records:
+        rr_ttl = rr.ttl if ttl is None else max(0, min(rr.ttl, ttl))
+        data += rr.name + RECORD_HEADER.pack(rr.type, rr.clazz, rr_ttl, len(rr.rdata)) + rr.rdata
+    if query.edns:
+        data += OPT_RECORD.pack(0, RR_TYPE_OPT, DNSPacket.EDNS_PAYLOAD_SIZE, EDNS_FLAG_DO if query.dnssec_ok else 0, 0)
+    return bytes(data)
+
+
+def build_error(data, rcode):
+    """
+    Builds a header only answer to a query which couldn't be parsed
+    :param data: The query bytes
+    :param rcode: The response code
+    :return: The response bytes, or None if there isn't even a header to answer
+    """
+    if len(data) < DNSPacket.HEADER_LEN or data[2] & 0x80:
+        return None
+    flags = FLAG_QR | ((data[2] << 8) & (FLAG_OPCODE | FLAG_RD)) | FLAG_RA | rcode
+    return HEADER_STRUCT.pack(int.from_bytes(data[:2], 'big'), flags, 0, 0, 0, 0)
+
+
+class _ServerProtocol(asyncio.DatagramProtocol):
+    """
+    Hands every query on the listening socket to the server
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.server.spawn(self.server.answer_udp(data, addr, self.transport))
+
+    def error_received(self, exc):
+        dprint("Socket error:", exc)
+
+
+class StubResolver:
+    """
+    Serves validated answers to local clients over UDP and TCP, on the same port
+    """
+    # Close client TCP connections after this long without a query
+    IDLE_TIMEOUT = 10
+
+    def __init__(self, resolver_address, listen_address=('127.0.0.1', 53), chain_cache=None, answer_cache=None,
+                 reuse_port=False):
+        """
+        :param resolver_address: The (host, port) of the upstream resolver, or an UpstreamPool
+        :param listen_address: The (host, port) to listen on. Port 0 picks a free port
+        :param chain_cache: The ChainCache to use. An empty one if not given
+        :param answer_cache: The AnswerCache to use. An empty one if not given
+        :param reuse_port: Listen with SO_REUSEPORT, so other processes can listen on the same port
+        """
+        self.resolver_address = resolver_address
+        self.listen_address = listen_address
+        self.reuse_port = reuse_port
+        self.chain_cache = chain_cache if chain_cache is not None else ChainCache()
+        self.answer_cache = answer_cache if answer_cache is not None else AnswerCache()
+        self.transport = AsyncUDPTransport()
+        self.address = None
+        self.udp_server = None
+        self.tcp_server = None
+        self.tasks = set()
+        # Writers of the open client TCP connections
+        self.clients = set()
+
+    async def start(self):
+        """
+        Starts listening. Once this returns, address is the (host, port) actually listened on
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        self.udp_server, _ = await loop.create_datagram_endpoint(lambda: _ServerProtocol(self),
+                                                                 local_addr=self.listen_address,
+                                                                 reuse_port=self.reuse_port)
+        self.address = self.udp_server.get_extra_info('sockname')[:2]
+        self.tcp_server = await asyncio.start_server(self.handle_tcp, self.address[0], self.address[1],
+                                                     reuse_port=self.reuse_port)
+        dprint("Listening on {0}:{1}".format(*self.address))
+
+    async def serve_forever(self):
+        """
+        Serves until cancelled, then closes everything down
+        :return: None
+        """
+        try:
+            if self.tcp_server is None:
+                await self.start()
+            await self.tcp_server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.udp_server is not None:
+            self.udp_server.close()
+            self.udp_server = None
+        if self.tcp_server is not None:
+            self.tcp_server.close()
+            self.tcp_server = None
+        for writer in self.clients:
+            writer.close()
+        for task in self.tasks:
+            task.cancel()
+        self.transport.close()
+
+    def spawn(self, coroutine):
+        """
+        Runs a coroutine in the background, holding on to it so it isn't garbage collected while it runs
+        :param coroutine: The coroutine
+        :return: The task
+        """
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def lookup(self, domain_name, query_type):
+        """
+        Fetches and validates an RRset, from the answer cache if it's there
+        :param domain_name: The domain name, a DomainName
+        :param query_type: The record type
+        :return: Tuple of (ValidationResult, upper bound for the record TTLs or None)
+        """
+        answer = self.answer_cache.get(domain_name, query_type)
+        if answer is not None:
+            # Count the TTLs down from when the answer was cached
+            ttl = int(answer.expires - self.answer_cache.clock())
+            return ValidationResult(domain_name, query_type, VALID if answer.valid else INVALID_RRSIG,
+                                    answer.rr_set, answer.rrsig), ttl
+        try:
+            verified, rr_set, rrsig = await async_resolve(domain_name, query_type, self.transport,
+                                                          self.resolver_address, self.chain_cache)
+        except DNSError as error:
+            return ValidationResult(domain_name, query_type, error.status), None
+        except (asyncio.TimeoutError, OSError) as error:
+            dprint("Lookup of {0} failed: {1!r}".format(domain_name, error))
+            return ValidationResult(domain_name, query_type, NORESPONSE), None
+        if not verified:
+            return ValidationResult(domain_name, query_type, MISSING_DS), None
+        if len(rr_set) == 0:
+            return ValidationResult(domain_name, query_type, NODATA), None
+        self.answer_cache.put(domain_name, query_type, rr_set, rrsig, rrsig is not None)
+        return ValidationResult(domain_name, query_type, VALID if rrsig is not None else INVALID_RRSIG,
+                                rr_set, rrsig), None
+
+    async def respond(self, data, udp=False):
+        """
+        Answers one query from a client
+        :param data: The query bytes
+        :param udp: The answer goes back over UDP, so has to fit in the client's payload size
+        :return: The response bytes, or None if the query should be dropped
+        """
+        try:
+            query = parse_query(data)
+        except (ValueError, IndexError, struct.error):
+            return build_error(data, RCODE_FORMERR)
+        if query.opcode != 0 or query.clazz != 1 or query.type not in RECORD_TYPES.values():
+            return build_response(query, RCODE_NOTIMP)
+
+        try:
+            result, ttl = await self.lookup(query.name, query.type)
+        except Exception as error:
+            # Malformed upstream responses and the like. The client still gets an answer
+            dprint("Lookup of {0} failed: {1!r}".format(query.name, error))
+            return build_response(query, RCODE_SERVFAIL)
+        dprint("{0} {1}: {2}".format(query.name, DNSPacket.record_type_name[query.type], result.status))
+
+        if result.status == NOTFOUND:
+            return build_response(query, RCODE_NXDOMAIN)
+        if result.status == NODATA:
+            return build_response(query, RCODE_NOERROR)
+        if not result.valid:
+            return build_response(query, RCODE_SERVFAIL)
+        records = list(result.rr_set)
+        if query.dnssec_ok:
+            records.append(result.rrsig)
+        response = build_response(query, RCODE_NOERROR, records, authenticated=True, ttl=ttl)
+        if udp and len(response) > query.payload_size:
+            # The client will ask again over TCP
+            response = build_response(query, RCODE_NOERROR, authenticated=True, truncated=True)
+        return response
+
+    async def answer_udp(self, data, addr, transport):
+        response = await self.respond(data, udp=True)
+        if response is not None and not transport.is_closing():
+            transport.sendto(response, addr)
+
+    async def answer_tcp(self, data, writer):
+        response = await self.respond(data)
+        if response is not None and not writer.is_closing():
+            writer.write(len(response).to_bytes(2, 'big') + response)
+
+    async def handle_tcp(self, reader, writer):
+        """
+        Serves one client TCP connection. Queries are answered concurrently, so answers may go back in a
+        different order than the queries came in
+        https://tools.ietf.org/html/rfc7766#section-6.2.1.1
+        """
+        answers = set()
+        self.clients.add(writer)
+        try:
+            while True:
+                length = await asyncio.wait_for(reader.readexactly(2), StubResolver.IDLE_TIMEOUT)
+                data = await reader.readexactly(int.from_bytes(length, 'big'))
+                answer = self.spawn(self.answer_tcp(data, writer))
+                answers.add(answer)
+                answer.add_done_callback(answers.discard)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            if answers:
+                await asyncio.gather(*answers, return_exceptions=True)
+            self.clients.discard(writer)
+            writer.close()
+
+
+def _run_worker(resolver_address, listen_address, shared_file, ready, debug):
+    """
+    The body of a ResolverWorkers process
+    :param resolver_address: The (host, port) of the upstream resolver, or an UpstreamPool
+    :param listen_address: The (host, port) to listen on, shared with the other workers
+    :param shared_file: The SharedChainCache file
+    :param ready: Semaphore released once the worker is listening
+    :param debug: Turn on debug printing, which a spawned process doesn't inherit
+    :return: None
+    """
+    util.debug_print_enabled = debug
+    server = StubResolver(resolver_address, listen_address, SharedChainCache(shared_file), reuse_port=True)
+
+    async def run():
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        await server.start()
+        ready.release()
+        await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        pass
+
+
+class ResolverWorkers:
+    """
+    Runs StubResolvers in several processes, all listening on one port with SO_REUSEPORT, so the kernel
+    spreads queries across them and each gets a core of its own. Validated zones are shared through a
+    SharedChainCache file, answers are cached by each worker separately
+    """
+    # Seconds to wait for the workers to start listening
+    START_TIMEOUT = 10
+
+    def __init__(self, resolver_address, listen_address, workers=None, shared_file=None):
+        """
+        :param resolver_address: The (host, port) of the upstream resolver, or an UpstreamPool
+        :param listen_address: The (host, port) to listen on. Port 0 picks a free port
+        :param workers: Number of worker processes, one per core by default
+        :param shared_file: The file to share validated zones through. A temporary one under SHARED_DIR,
+                            removed again by close, if not given
+        """
+        self.resolver_address = resolver_address
+        self.listen_address = listen_address
+        self.workers = workers or os.cpu_count() or 1
+        self.shared_file = shared_file
+        self.own_file = shared_file is None
+        self.processes = []
+        self.address = None
+
+    def start(self):
+        """
+        Starts the workers and waits until they are all listening
+        :return: None
+        """
+        if self.own_file:
+            fd, self.shared_file = tempfile.mkstemp(dir=SHARED_DIR, prefix='dnscache-')
+            os.close(fd)
+        # Hold the port while the workers start, so with port 0 they all end up on the same one
+        placeholder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            placeholder.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            placeholder.bind(self.listen_address)
+            self.address = placeholder.getsockname()[:2]
+            # Spawned, not forked, so the workers don't inherit the placeholder. Queries the kernel handed to
+            # a copy of it would never be read
+            context = multiprocessing.get_context('spawn')
+            ready = context.Semaphore(0)
+            for _ in range(self.workers):
+                process = context.Process(target=_run_worker, daemon=True,
+                                          args=(self.resolver_address, self.address, self.shared_file, ready,
+                                                util.debug_print_enabled))
+                process.start()
+                self.processes.append(process)
+            for _ in range(self.workers):
+                if not ready.acquire(timeout=ResolverWorkers.START_TIMEOUT):
+                    raise RuntimeError("Resolver workers did not start")
+        except BaseException:
+            self.close()
+            raise
+        finally:
+            placeholder.close()
+        dprint("{0} workers listening on {1}:{2}".format(self.workers, *self.address))
+
+    def join(self):
+        for process in self.processes:
+            process.join()
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        if self.own_file and self.shared_file is not None:
+            for path in (self.shared_file, self.shared_file + '.log', self.shared_file + '.lock'):
+                if os.path.exists(path):
+                    os.unlink(path)
+            self.shared_file = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def serve(resolver_address, listen_address, cache_file=None, workers=1):
+    """
+    Runs a StubResolver until interrupted
+    :param resolver_address: The (host, port) of the upstream resolver, or an UpstreamPool
+    :param listen_address: The (host, port) to listen on
+    :param cache_file: Optional snapshot file to load the chain cache from, and save it to on exit. With more
+                       than one worker this is the file they share validated zones through
+    :param workers: Number of processes to serve from
+    :return: None
+    """
+    if workers > 1:
+        with ResolverWorkers(resolver_address, listen_address, workers, cache_file) as pool:
+            try:
+                pool.join()
+            except KeyboardInterrupt:
+                pass
+        return
+
+    server = StubResolver(resolver_address, listen_address)
+    if cache_file:
+        dprint("Loaded {0} zones from {1}".format(load_snapshot(cache_file, server.chain_cache), cache_file))
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if cache_file:
+            save_snapshot(cache_file, server.chain_cache)
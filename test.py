@@ -2,8 +2,292 @@
 A few unit tests
 """
 
+import asyncio
+import base64
+import contextlib
+import importlib
+import io
+import json
+import os
+import random
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
 import unittest
-from DNSPacket import DNSPacket
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import ECC, RSA
+from Crypto.Signature import DSS, PKCS1_v1_5, eddsa
+
+import crypto
+import util
+from async_resolver import AsyncUDPTransport, async_resolve
+from cache import AnswerCache, ChainCache
+from canonical import canonical_name, canonical_order
+from DNSPacket import DNSError, DNSPacket
+from domain_name import DomainName
+from network import RTTEstimator, TCPConnection, UDPCommunication, UpstreamPool
+from records.Record import ARecord, CompactRecord, CompactRRSigRecord, DNSKeyRecord, DSRecord, RRSigRecord, \
+	_interned_names, compact_record
+from snapshot import SharedChainCache, append_log, load_snapshot, read_log, save_snapshot
+from stub_resolver import ResolverWorkers, StubResolver
+from validation import find_ds_match, validate_RRSET, verify_zone
+from validator import Validator
+from verify_pool import VerificationExecutor
+
+dnsclient = importlib.import_module('351dnsclient')
+
+
+def make_dnskey(rsa_key, owner='example.com', flags=257, algorithm=DNSPacket.ALGO_TYPE_RSASHA256):
+	"""
+	Builds a DNSKEY record holding the public half of a key
+	:param rsa_key: A pycryptodome RSA key, or an ECC key for the ECDSA and Ed25519 algorithms
+	:param owner: The owner name of the record
+	:param flags: The DNSKEY flags
+	:param algorithm: The DNSKEY algorithm
+	:return: The DNSKEY record
+	"""
+	if isinstance(rsa_key, RSA.RsaKey):
+		expo = rsa_key.e.to_bytes((rsa_key.e.bit_length() + 7) // 8, 'big')
+		key = bytes([len(expo)]) + expo + rsa_key.n.to_bytes((rsa_key.n.bit_length() + 7) // 8, 'big')
+	elif algorithm == DNSPacket.ALGO_TYPE_ED25519:
+		key = rsa_key.public_key().export_key(format='raw')
+	else:
+		# Raw X and Y, without the leading 0x04 uncompressed point marker
+		key = rsa_key.public_key().export_key(format='raw')[1:]
+	rdata = struct.pack('!HBB', flags, 3, algorithm) + key
+	return DNSKeyRecord(canonical_name(owner), DNSPacket.RR_TYPE_DNSKEY, 1, 3600, len(rdata), rdata,
+						flags.to_bytes(2, 'big'), 3, algorithm, key)
+
+
+def make_a_record(ip, owner='example.com'):
+	"""
+	Builds an A record
+	:param ip: The address as a tuple of 4 ints
+	:param owner: The owner name of the record
+	:return: The A record
+	"""
+	rdata = bytes(ip)
+	return ARecord(canonical_name(owner), DNSPacket.RR_TYPE_A, 1, 300, 4, rdata, rdata, "noauth")
+
+
+def sign_rrset(rsa_key, dnskey, rr_set, owner='example.com', signer='example.com', signed_at=None):
+	"""
+	Signs an RRset the way a zone signer would, over the canonical ordering
+	:param rsa_key: The private key, RSA or ECC to match the DNSKEY algorithm
+	:param dnskey: The DNSKEY record for rsa_key, used for the key tag and algorithm
+	:param rr_set: The RRset
+	:param owner: The owner name of the RRset
+	:param signer: The signer name
+	:param signed_at: Unix time to sign at, now by default. The signature is valid from a day before to a day after
+	:return: The RRSIG record
+	"""
+	tag = dnskey.key_tag
+	now = int(signed_at if signed_at is not None else time.time())
+	expiration = (now + 86400).to_bytes(4, 'big')
+	inception = (now - 86400).to_bytes(4, 'big')
+	signer_name = canonical_name(signer)
+	labels = len([label for label in owner.split('.') if label])
+	algorithm = dnskey.algorithm
+	fixed = struct.pack('!HBBI', rr_set[0].type, algorithm, labels, rr_set[0].ttl) + \
+			expiration + inception + struct.pack('!H', tag) + signer_name
+	sig = RRSigRecord(canonical_name(owner), DNSPacket.RR_TYPE_RRSIG, 1, rr_set[0].ttl, len(fixed), fixed,
+					  rr_set[0].type, algorithm, labels, rr_set[0].ttl, expiration, inception,
+					  tag, signer_name, b'')
+	data = crypto.createRRSetData(canonical_order(rr_set), sig, owner)
+	if algorithm == DNSPacket.ALGO_TYPE_ED25519:
+		sig.signature = eddsa.new(rsa_key, 'rfc8032').sign(data)
+	elif isinstance(rsa_key, RSA.RsaKey):
+		sig.signature = PKCS1_v1_5.new(rsa_key).sign(crypto.get_algorithm(algorithm).new_hash(data))
+	else:
+		sig.signature = DSS.new(rsa_key, 'fips-186-3').sign(crypto.get_algorithm(algorithm).new_hash(data))
+	sig.rdata = fixed + sig.signature
+	sig.rdata_len = len(sig.rdata)
+	return sig
+
+
+def make_ds(dnskey, owner='example.com', digest_type=2):
+	"""
+	Builds the DS record a parent zone would publish for a DNSKEY
+	:param dnskey: The DNSKEY record
+	:param owner: The owner name of the DNSKEY
+	:param digest_type: The DS digest type
+	:return: The DS record
+	"""
+	digest = bytes(crypto.createDSRecord(dnskey, owner, digest_type))
+	rdata = struct.pack('!HBB', dnskey.key_tag, dnskey.algorithm, digest_type) + digest
+	return DSRecord(canonical_name(owner), DNSPacket.RR_TYPE_DS, 1, 3600, len(rdata), rdata,
+					dnskey.key_tag, dnskey.algorithm, digest_type, digest)
+
+
+def parse_question(query):
+	"""
+	Pulls the question out of a query
+	:param query: The query bytes
+	:return: Tuple of (name, type, index just past the question)
+	"""
+	i = DNSPacket.HEADER_LEN
+	labels = []
+	while query[i] != 0:
+		labels.append(bytes(query[i + 1:i + 1 + query[i]]).decode())
+		i += 1 + query[i]
+	qtype = struct.unpack('!H', query[i + 1:i + 3])[0]
+	return '.'.join(labels), qtype, i + 5
+
+
+def build_response(query, answers, rcode=0):
+	"""
+	Builds the wire format response to a query
+	:param query: The query bytes
+	:param answers: The answer records
+	:param rcode: The response code
+	:return: The response bytes
+	"""
+	_, _, question_end = parse_question(query)
+	data = bytearray(query[:2])
+	data += struct.pack('!HHHHH', 0x8180 | rcode, 1, len(answers), 0, 0)
+	data += query[DNSPacket.HEADER_LEN:question_end]
+	for rr in answers:
+		data += rr.name + struct.pack('!HHIH', rr.type, rr.clazz, rr.ttl, len(rr.rdata)) + rr.rdata
+	return bytes(data)
+
+
+class StubUpstream:
+	"""
+	A local stand-in for an upstream resolver. Answers queries from a dict of (name, type) -> answer records,
+	each after an optional delay, and counts the queries it sees. Queries for types in truncate get a
+	truncated answer over UDP, and the full answer over TCP on the same port. Names in rcodes get an
+	empty response with that response code instead. The next drop UDP queries, and a loss fraction of
+	the rest, are ignored as if they were lost
+	"""
+
+	def __init__(self, answers, delay=0, truncate=(), rcodes=None, drop=0, loss=0):
+		self.answers = answers
+		self.delay = delay
+		self.truncate = truncate
+		self.rcodes = rcodes or {}
+		self.drop = drop
+		self.loss = loss
+		self.queries = []
+		self.tcp_queries = []
+		self.tcp_connections = 0
+		upstream = self
+
+		class UDPHandler(socketserver.BaseRequestHandler):
+			def handle(self):
+				data, sock = self.request
+				name, qtype, _ = parse_question(data)
+				upstream.queries.append((name, qtype))
+				if upstream.drop > 0 or random.random() < upstream.loss:
+					upstream.drop = max(upstream.drop - 1, 0)
+					return
+				time.sleep(upstream.delay)
+				if qtype in upstream.truncate:
+					response = bytearray(build_response(data, []))
+					response[2] |= 0x02
+				else:
+					response = upstream.respond(data)
+				sock.sendto(response, self.client_address)
+
+		class TCPHandler(socketserver.BaseRequestHandler):
+			def handle(self):
+				upstream.tcp_connections += 1
+				lock = threading.Lock()
+				responders = []
+				while True:
+					length = self.request.recv(2)
+					if len(length) < 2:
+						break
+					data = self.request.recv(int.from_bytes(length, 'big'), socket.MSG_WAITALL)
+					upstream.tcp_queries.append(parse_question(data)[:2])
+					# Answer each query on its own thread, so later queries can be answered first
+					responder = threading.Thread(target=self.answer, args=(data, lock, len(responders)))
+					responder.start()
+					responders.append(responder)
+				for responder in responders:
+					responder.join()
+
+			def answer(self, data, lock, index):
+				time.sleep(upstream.delay / (index + 1))
+				response = upstream.respond(data)
+				with lock:
+					self.request.sendall(len(response).to_bytes(2, 'big') + response)
+
+		self.server = socketserver.ThreadingUDPServer(('127.0.0.1', 0), UDPHandler)
+		self.server.daemon_threads = True
+		self.address = self.server.server_address
+		self.tcp_server = socketserver.ThreadingTCPServer(self.address, TCPHandler)
+		self.tcp_server.daemon_threads = True
+		for server in (self.server, self.tcp_server):
+			threading.Thread(target=server.serve_forever, daemon=True).start()
+
+	def respond(self, data):
+		name, qtype, _ = parse_question(data)
+		if name in self.rcodes:
+			return build_response(data, [], rcode=self.rcodes[name])
+		return build_response(data, self.answers.get((name, qtype), []))
+
+	def close(self):
+		for server in (self.server, self.tcp_server):
+			server.shutdown()
+			server.server_close()
+
+
+class FakeConnection:
+	"""
+	Stands in for UDPCommunication, answering queries from a dict of (name, type) -> answer records
+	"""
+
+	def __init__(self, answers):
+		self.answers = answers
+		self.queries = []
+
+	def sendPacket(self, addr, packet):
+		name, qtype, _ = parse_question(packet.bytes)
+		self.queries.append((name, qtype))
+
+	def waitForPacket(self):
+		response = DNSPacket()
+		response.answers = list(self.answers.get(self.queries[-1], []))
+		return response
+
+
+# zone -> (RSA key, DNSKEY) for the zones built by make_signed_zones
+zone_keys = {}
+
+
+def make_signed_zones(zones):
+	"""
+	Builds DS and DNSKEY answers, with RRSIGs, for a list of zones
+	:param zones: The zone names
+	:return: A dict of (name, type) -> answer records, for FakeConnection
+	"""
+	answers = {}
+	for zone in zones:
+		rsa_key = RSA.generate(1024)
+		key = make_dnskey(rsa_key, zone)
+		zone_keys[zone] = (rsa_key, key)
+		ds = make_ds(key, zone)
+		answers[(zone, DNSPacket.RR_TYPE_DNSKEY)] = [key, sign_rrset(rsa_key, key, [key], zone, zone)]
+		answers[(zone, DNSPacket.RR_TYPE_DS)] = [ds, sign_rrset(rsa_key, key, [ds], zone, zone)]
+	return answers
+
+
+def add_signed_a_record(answers, zone, ip=(192, 0, 2, 1)):
+	"""
+	Adds a signed A record to answers from make_signed_zones, signed with the zone's key
+	:param answers: The dict of (name, type) -> answer records
+	:param zone: A zone already in answers
+	:param ip: The address as a tuple of 4 ints
+	:return: None
+	"""
+	rsa_key, key = zone_keys[zone]
+	rr_set = [make_a_record(ip, zone)]
+	answers[(zone, DNSPacket.RR_TYPE_A)] = rr_set + [sign_rrset(rsa_key, key, rr_set, zone, zone)]
+
 
 class TestDNSPacket(unittest.TestCase):
 
@@ -33,5 +317,1374 @@ class TestDNSPacket(unittest.TestCase):
 	def test_test(self):
 		pass
 
+
+class TestCanonical(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.rsa_key = RSA.generate(1024)
+
+	def test_canonicalName(self):
+		self.assertEqual(canonical_name('Example.COM'), b'\x07example\x03com\x00')
+		self.assertEqual(canonical_name('example.com.'), b'\x07example\x03com\x00')
+		self.assertEqual(canonical_name(''), b'\x00')
+
+	def test_canonicalOrder(self):
+		rr_set = [make_a_record((10, 0, 0, 2)), make_a_record((9, 0, 0, 1)), make_a_record((10, 0, 0, 2))]
+		ordered = canonical_order(rr_set)
+		self.assertEqual([rr.rdata for rr in ordered], [bytes((9, 0, 0, 1)), bytes((10, 0, 0, 2))])
+
+	def test_validateShuffledRRSet(self):
+		key = make_dnskey(self.rsa_key)
+		rr_set = [make_a_record((192, 0, 2, i)) for i in range(8)]
+		sig = sign_rrset(self.rsa_key, key, rr_set)
+		random.shuffle(rr_set)
+		self.assertIs(validate_RRSET([key], [sig], rr_set, 'Example.com'), sig)
+		rr_set[0] = make_a_record((198, 51, 100, 1))
+		self.assertIsNone(validate_RRSET([key], [sig], rr_set, 'example.com'))
+
+
+class TestKeyTag(unittest.TestCase):
+
+	def test_rootKeyTag(self):
+		# The 2017 root KSK, published with key tag 20326
+		key = base64.b64decode(
+			'AwEAAaz/tAm8yTn4Mfeh5eyI96WSVexTBAvkMgJzkKTOiW1vkIbzxeF3+/4RgWOq7HrxRixHlFlExOLAJr5emLvN7SWXgnLh4+B5xQlNVz8'
+			'Og8kvArMtNROxVQuCaSnIDdD5LKyWbRd2n9WGe2R8PzgCmr3EgVLrjyBxWezF0jLHwVN8efS3rCj/EWgvIWgb9tarpVUDK/b58Da+sqqls3'
+			'eNbuv7pr+eoZG+SrDK6nWeL3c6H5Apxz7LjVc1uTIdsIXxuOLYA4/ilBmSVIzuDWfdRUfhHdY6+cn8HFRm+2hM8AnXGXws9555KrUB5qihy'
+			'lGa8subX2Nn6UwNR1AkUTV74bU=')
+		rdata = struct.pack('!HBB', 257, 3, 8) + key
+		self.assertEqual(crypto.compute_key_tag(rdata, 8), 20326)
+
+	def test_onlyMatchingKeysTried(self):
+		rsa_keys = [RSA.generate(1024) for _ in range(3)]
+		keys = [make_dnskey(rsa_key) for rsa_key in rsa_keys]
+		rr_set = [make_a_record((192, 0, 2, 1))]
+		sig = sign_rrset(rsa_keys[2], keys[2], rr_set)
+		tried = []
+		original = crypto.verify_signature
+
+		def counting_verify(signature, key, recordset):
+			tried.append(key)
+			return original(signature, key, recordset)
+
+		crypto.verify_signature = counting_verify
+		try:
+			self.assertIs(validate_RRSET(keys, [sig], rr_set, 'example.com'), sig)
+		finally:
+			crypto.verify_signature = original
+		self.assertEqual(tried, [keys[2]])
+
+
+class TestVerifierCache(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.rsa_keys = [RSA.generate(1024) for _ in range(3)]
+		cls.keys = [make_dnskey(rsa_key) for rsa_key in cls.rsa_keys]
+
+	def test_hitsAndMisses(self):
+		cache = crypto.VerifierCache()
+		first = cache.get(self.keys[0])
+		self.assertIs(cache.get(self.keys[0]), first)
+		self.assertEqual((cache.hits, cache.misses), (1, 1))
+		cache.clear()
+		self.assertEqual((len(cache), cache.hits, cache.misses), (0, 0, 0))
+
+	def test_evictsLeastRecentlyUsed(self):
+		cache = crypto.VerifierCache(max_size=2)
+		cache.get(self.keys[0])
+		cache.get(self.keys[1])
+		cache.get(self.keys[0])
+		cache.get(self.keys[2])
+		self.assertEqual(cache.evictions, 1)
+		self.assertEqual(len(cache), 2)
+		cache.get(self.keys[0])
+		self.assertEqual(cache.misses, 3)
+		cache.get(self.keys[1])
+		self.assertEqual(cache.misses, 4)
+
+	def test_verifyUsesCache(self):
+		rr_set = [make_a_record((192, 0, 2, 1))]
+		sig = sign_rrset(self.rsa_keys[0], self.keys[0], rr_set)
+		data = crypto.createRRSetData(rr_set, sig, 'example.com')
+		crypto.verifier_cache.clear()
+		self.assertTrue(crypto.verify_signature(sig.signature, self.keys[0], data))
+		self.assertTrue(crypto.verify_signature(sig.signature, self.keys[0], data))
+		self.assertEqual((crypto.verifier_cache.hits, crypto.verifier_cache.misses), (1, 1))
+
+
+class TestChainCache(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.answers = make_signed_zones(['com', 'example.com', 'www.example.com'])
+
+	def setUp(self):
+		self.now = time.time()
+		self.chain_cache = ChainCache(clock=lambda: self.now)
+		self.connection = FakeConnection(self.answers)
+
+	def test_cachedZonesSkipQueries(self):
+		self.assertTrue(verify_zone('example.com', self.connection, None, self.chain_cache))
+		self.assertEqual(len(self.connection.queries), 4)
+		self.assertEqual(len(self.chain_cache), 2)
+		self.assertTrue(verify_zone('example.com', self.connection, None, self.chain_cache))
+		self.assertEqual(len(self.connection.queries), 4)
+		self.assertTrue(verify_zone('www.example.com', self.connection, None, self.chain_cache))
+		self.assertEqual(self.connection.queries[4:], [('www.example.com', DNSPacket.RR_TYPE_DS),
+													   ('www.example.com', DNSPacket.RR_TYPE_DNSKEY)])
+
+	def test_entriesExpireWithTTL(self):
+		self.assertTrue(verify_zone('example.com', self.connection, None, self.chain_cache))
+		self.now += 3600
+		self.assertIsNone(self.chain_cache.get('com'))
+		self.assertTrue(verify_zone('example.com', self.connection, None, self.chain_cache))
+		self.assertEqual(len(self.connection.queries), 8)
+
+	def test_failedChainNotCached(self):
+		answers = dict(self.answers)
+		del answers[('com', DNSPacket.RR_TYPE_DS)]
+		connection = FakeConnection(answers)
+		self.assertFalse(verify_zone('example.com', connection, None, self.chain_cache))
+		self.assertEqual(len(self.chain_cache), 0)
+
+
+
+class TestAnswerCache(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.rsa_key = RSA.generate(1024)
+		cls.key = make_dnskey(cls.rsa_key)
+
+	def setUp(self):
+		self.now = time.time()
+
+	def make_cache(self, max_bytes=AnswerCache.DEFAULT_MAX_BYTES):
+		return AnswerCache(max_bytes=max_bytes, clock=lambda: self.now)
+
+	def test_expiryBoundedByOrigTTL(self):
+		rr_set = [make_a_record((192, 0, 2, 1))]
+		sig = sign_rrset(self.rsa_key, self.key, rr_set)
+		sig.orig_ttl = 60
+		cache = self.make_cache()
+		cache.put('Example.com', DNSPacket.RR_TYPE_A, rr_set, sig, True)
+		answer = cache.get('example.com', DNSPacket.RR_TYPE_A)
+		self.assertEqual(bytes(answer.rrsig.rdata), bytes(sig.rdata))
+		self.assertTrue(answer.valid)
+		self.now += 60
+		self.assertIsNone(cache.get('example.com', DNSPacket.RR_TYPE_A))
+		self.assertEqual(len(cache), 0)
+
+	def test_evictsLeastRecentlyUsed(self):
+		rr_set = [make_a_record((192, 0, 2, 1))]
+		size = AnswerCache.answer_size(rr_set, None)
+		cache = self.make_cache(max_bytes=2 * size)
+		cache.put('a.example.com', DNSPacket.RR_TYPE_A, rr_set, None, False)
+		cache.put('b.example.com', DNSPacket.RR_TYPE_A, rr_set, None, False)
+		cache.get('a.example.com', DNSPacket.RR_TYPE_A)
+		cache.put('c.example.com', DNSPacket.RR_TYPE_A, rr_set, None, False)
+		self.assertEqual(cache.evictions, 1)
+		self.assertIsNone(cache.get('b.example.com', DNSPacket.RR_TYPE_A))
+		self.assertIsNotNone(cache.get('a.example.com', DNSPacket.RR_TYPE_A))
+		self.assertLessEqual(cache.size, 2 * size)
+
+	def test_clearResetsCounters(self):
+		cache = self.make_cache()
+		cache.put('example.com', DNSPacket.RR_TYPE_A, [make_a_record((192, 0, 2, 1))], None, False)
+		cache.get('example.com', DNSPacket.RR_TYPE_A)
+		cache.get('missing.example.com', DNSPacket.RR_TYPE_A)
+		cache.clear()
+		self.assertEqual((len(cache), cache.size, cache.hits, cache.misses, cache.evictions), (0, 0, 0, 0, 0))
+
+
+
+class TestSnapshot(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.answers = make_signed_zones(['com', 'org', 'example.com', 'example.org'])
+
+	def setUp(self):
+		self.now = time.time()
+		self.directory = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.directory.name, 'cache')
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def make_cache(self):
+		return ChainCache(clock=lambda: self.now)
+
+	def test_roundTrip(self):
+		chain_cache = self.make_cache()
+		verify_zone('example.com', FakeConnection(self.answers), None, chain_cache)
+		self.assertEqual(save_snapshot(self.path, chain_cache), 2)
+
+		loaded = self.make_cache()
+		self.assertEqual(load_snapshot(self.path, loaded), 2)
+		entry = loaded.get('example.com')
+		self.assertEqual(entry.expires, chain_cache.get('example.com').expires)
+		self.assertEqual(entry.keys[0].key_tag, chain_cache.get('example.com').keys[0].key_tag)
+		self.assertEqual(entry.ds_records[0].digest, chain_cache.get('example.com').ds_records[0].digest)
+		self.assertEqual(len(entry.key_rrsigs), 1)
+
+		connection = FakeConnection(self.answers)
+		self.assertTrue(verify_zone('example.com', connection, None, loaded))
+		self.assertEqual(connection.queries, [])
+
+	def test_writersMerge(self):
+		first = self.make_cache()
+		verify_zone('example.com', FakeConnection(self.answers), None, first)
+		save_snapshot(self.path, first)
+		second = self.make_cache()
+		verify_zone('example.org', FakeConnection(self.answers), None, second)
+		self.assertEqual(save_snapshot(self.path, second), 4)
+
+	def test_expiredDroppedOnLoad(self):
+		chain_cache = self.make_cache()
+		verify_zone('example.com', FakeConnection(self.answers), None, chain_cache)
+		save_snapshot(self.path, chain_cache)
+		self.now += 3600
+		self.assertEqual(load_snapshot(self.path, self.make_cache()), 0)
+
+	def test_badFileIgnored(self):
+		with open(self.path, 'wb') as f:
+			f.write(b'not a snapshot')
+		self.assertEqual(load_snapshot(self.path, self.make_cache()), 0)
+		self.assertEqual(load_snapshot(self.path + '.missing', self.make_cache()), 0)
+
+	def test_sharedChainCache(self):
+		first = SharedChainCache(self.path, clock=lambda: self.now)
+		second = SharedChainCache(self.path, clock=lambda: self.now)
+		verify_zone('example.com', FakeConnection(self.answers), None, first)
+		connection = FakeConnection(self.answers)
+		self.assertTrue(verify_zone('example.com', connection, None, second))
+		self.assertEqual(connection.queries, [])
+		# And the other way round
+		verify_zone('example.org', FakeConnection(self.answers), None, second)
+		self.assertEqual(first.get('example.org').keys[0].key_tag, second.get('example.org').keys[0].key_tag)
+
+	def test_sharedZonesAppended(self):
+		first = SharedChainCache(self.path, clock=lambda: self.now)
+		verify_zone('example.com', FakeConnection(self.answers), None, first)
+		save_snapshot(self.path, first)
+		snapshot = os.stat(self.path)
+		self.assertFalse(os.path.exists(self.path + '.log'))
+
+		verify_zone('example.org', FakeConnection(self.answers), None, first)
+		# The new zones went to the log, the snapshot was left alone
+		self.assertEqual(os.stat(self.path).st_ino, snapshot.st_ino)
+		self.assertEqual(os.stat(self.path).st_size, snapshot.st_size)
+		log_size = os.path.getsize(self.path + '.log')
+		self.assertGreater(log_size, 0)
+
+		second = SharedChainCache(self.path, clock=lambda: self.now)
+		connection = FakeConnection(self.answers)
+		self.assertTrue(verify_zone('example.org', connection, None, second))
+		self.assertEqual(connection.queries, [])
+		self.assertEqual(load_snapshot(self.path, self.make_cache()), 4)
+
+		# A block still being written is left until it is complete
+		with open(self.path + '.log', 'ab') as f:
+			f.write(b'\x00\x00\x10\x00\x00')
+		self.assertEqual(read_log(self.path, self.make_cache(), log_size), (log_size, 0))
+
+	def test_snapshotFoldsInLog(self):
+		first = SharedChainCache(self.path, clock=lambda: self.now)
+		second = SharedChainCache(self.path, clock=lambda: self.now)
+		verify_zone('example.com', FakeConnection(self.answers), None, first)
+		self.assertEqual(save_snapshot(self.path, first), 2)
+		self.assertFalse(os.path.exists(self.path + '.log'))
+		loaded = self.make_cache()
+		self.assertEqual(load_snapshot(self.path, loaded), 2)
+		self.assertIsNotNone(second.get('example.com'))
+
+		# Appends after the log was folded away start a new one, which the other cache still picks up
+		verify_zone('example.org', FakeConnection(self.answers), None, first)
+		self.assertIsNotNone(second.get('example.org'))
+
+	def test_refoldedLogReadFromStart(self):
+		writer = self.make_cache()
+		verify_zone('example.com', FakeConnection(self.answers), None, writer)
+		verify_zone('example.org', FakeConnection(self.answers), None, writer)
+		entries = writer.entries()
+		append_log(self.path, entries[:2])
+		reader = SharedChainCache(self.path, clock=lambda: self.now)
+		self.assertGreater(reader.log_offset, 0)
+		# Folded away, and a new log which may well get the same inode number back
+		save_snapshot(self.path, self.make_cache())
+		append_log(self.path, entries[2:])
+		reader.log_inode = os.stat(self.path + '.log').st_ino
+		for entry in entries:
+			self.assertIsNotNone(reader.get(entry.zone))
+
+
+
+class TestAsyncResolver(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.answers = make_signed_zones(['com', 'example.com', 'www.example.com'])
+		add_signed_a_record(cls.answers, 'www.example.com')
+
+	def setUp(self):
+		self.upstream = StubUpstream(self.answers, delay=0.2)
+
+	def tearDown(self):
+		self.upstream.close()
+
+	def test_resolveConcurrently(self):
+		chain_cache = ChainCache()
+
+		async def resolve():
+			transport = AsyncUDPTransport()
+			result = await async_resolve('www.example.com', DNSPacket.RR_TYPE_A, transport, self.upstream.address,
+										 chain_cache)
+			transport.close()
+			return result
+
+		start = time.perf_counter()
+		verified, rr_set, rrsig = asyncio.run(resolve())
+		elapsed = time.perf_counter() - start
+		self.assertTrue(verified)
+		self.assertEqual([rr.rdata for rr in rr_set], [bytes((192, 0, 2, 1))])
+		self.assertIsNotNone(rrsig)
+		# 7 queries, each answered after 0.2s. One after the other would take 1.4s
+		self.assertEqual(len(self.upstream.queries), 7)
+		self.assertLess(elapsed, 0.7)
+		self.assertEqual(len(chain_cache), 3)
+
+	def test_cachedChainOnlyQueriesTarget(self):
+		chain_cache = ChainCache()
+
+		async def resolve_twice():
+			transport = AsyncUDPTransport()
+			for _ in range(2):
+				await async_resolve('www.example.com', DNSPacket.RR_TYPE_A, transport, self.upstream.address, chain_cache)
+			transport.close()
+
+		asyncio.run(resolve_twice())
+		self.assertEqual(self.upstream.queries[7:], [('www.example.com', DNSPacket.RR_TYPE_A)])
+
+
+	def test_multiplexOnOneSocket(self):
+		self.upstream.delay = 0
+		names = ['com', 'example.com', 'www.example.com']
+
+		async def query_all():
+			transport = AsyncUDPTransport()
+			# Looked up once, without blocking the loop
+			pool = await transport.upstreams(('localhost', self.upstream.address[1]))
+			self.assertIs(await transport.upstreams(('localhost', self.upstream.address[1])), pool)
+			self.assertEqual(pool.addresses, [self.upstream.address])
+			# Sent without coalescing, so every one of them is on the socket at once
+			queries = [transport.send_query(pool, name, DNSPacket.RR_TYPE_DNSKEY) for name in names * 100]
+			responses = await asyncio.gather(*queries)
+			sockets = {transport.transport.get_extra_info('sockname')}
+			transport.close()
+			return responses, sockets
+
+		responses, sockets = asyncio.run(query_all())
+		self.assertEqual(len(sockets), 1)
+		self.assertGreaterEqual(len(self.upstream.queries), len(names) * 100)
+		for name, response in zip(names * 100, responses):
+			self.assertEqual(response.answers[0].key_tag, self.answers[(name, DNSPacket.RR_TYPE_DNSKEY)][0].key_tag)
+
+	def test_lateAndForeignRepliesDropped(self):
+		transport = AsyncUDPTransport()
+		query = DNSPacket.newQuery('example.com', DNSPacket.RR_TYPE_A, packet_id=7)
+		loop = asyncio.new_event_loop()
+		self.addCleanup(loop.close)
+		future = loop.create_future()
+		transport.pending[7] = (('127.0.0.1', 53), query.name, DNSPacket.RR_TYPE_A, future)
+		transport.dispatch(build_response(DNSPacket.newQuery('example.com', DNSPacket.RR_TYPE_A, packet_id=8).bytes,
+										  []), ('127.0.0.1', 53))
+		transport.dispatch(build_response(query.bytes, []), ('127.0.0.2', 53))
+		transport.dispatch(build_response(DNSPacket.newQuery('example.org', DNSPacket.RR_TYPE_A, packet_id=7).bytes,
+										  []), ('127.0.0.1', 53))
+		self.assertFalse(future.done())
+		transport.dispatch(build_response(query.bytes, []), ('127.0.0.1', 53))
+		self.assertTrue(future.done())
+
+	def test_identicalQueriesCoalesced(self):
+		self.upstream.delay = 0
+		hosts = ['host{0}.example.com'.format(i) for i in range(20)]
+		answers = make_signed_zones(['com', 'example.com'] + hosts)
+		for host in hosts:
+			add_signed_a_record(answers, host)
+		self.upstream.answers = answers
+
+		async def resolve_all():
+			transport = AsyncUDPTransport()
+			chain_cache = ChainCache()
+			results = await asyncio.gather(*[async_resolve(host, DNSPacket.RR_TYPE_A, transport, self.upstream.address,
+														   chain_cache) for host in hosts])
+			transport.close()
+			return results, transport.coalesced
+
+		results, coalesced = asyncio.run(resolve_all())
+		self.assertTrue(all(verified and rrsig is not None for verified, _, rrsig in results))
+		# Every name needs the DS and DNSKEY of com and example.com, but they were only asked for once
+		for zone in ('com', 'example.com'):
+			for type in (DNSPacket.RR_TYPE_DS, DNSPacket.RR_TYPE_DNSKEY):
+				self.assertEqual(self.upstream.queries.count((zone, type)), 1)
+		self.assertEqual(coalesced, 4 * (len(hosts) - 1))
+
+	def test_coalescedCallersShareErrorsNotCancellation(self):
+		self.upstream.rcodes = {'gone.example.com': 3}
+
+		async def query_three():
+			transport = AsyncUDPTransport()
+			queries = [asyncio.ensure_future(transport.query(self.upstream.address, 'gone.example.com',
+															 DNSPacket.RR_TYPE_A)) for _ in range(3)]
+			await asyncio.sleep(0)
+			queries[0].cancel()
+			results = await asyncio.gather(*queries, return_exceptions=True)
+			transport.close()
+			return results
+
+		results = asyncio.run(query_three())
+		self.assertIsInstance(results[0], asyncio.CancelledError)
+		self.assertEqual([result.status for result in results[1:]], ['NOTFOUND', 'NOTFOUND'])
+		self.assertEqual(len(self.upstream.queries), 1)
+
+	def test_coalescedCallersAllRejectBadRRSIG(self):
+		self.upstream.delay = 0
+		answers = make_signed_zones(['com', 'example.com', 'www.example.com'])
+		rsa_key, key = zone_keys['www.example.com']
+		rr_set = [make_a_record((192, 0, 2, 1), 'www.example.com')]
+		expired = sign_rrset(rsa_key, key, rr_set, 'www.example.com', 'www.example.com',
+							 signed_at=time.time() - 3 * 86400)
+		forged = sign_rrset(rsa_key, key, rr_set, 'www.example.com', 'www.example.com')
+		forged.rdata = forged.rdata[:-1] + bytes((forged.rdata[-1] ^ 1,))
+		self.upstream.answers = answers
+
+		async def resolve_all():
+			transport = AsyncUDPTransport()
+			chain_cache = ChainCache()
+			results = await asyncio.gather(*[async_resolve('www.example.com', DNSPacket.RR_TYPE_A, transport,
+														   self.upstream.address, chain_cache) for _ in range(5)])
+			transport.close()
+			return results, transport.coalesced
+
+		for rrsig in (expired, forged):
+			answers[('www.example.com', DNSPacket.RR_TYPE_A)] = rr_set + [rrsig]
+			del self.upstream.queries[:]
+			results, coalesced = asyncio.run(resolve_all())
+			# All five callers share one response, and every one of them rejects its RRSIG
+			self.assertEqual(self.upstream.queries.count(('www.example.com', DNSPacket.RR_TYPE_A)), 1)
+			self.assertGreater(coalesced, 0)
+			self.assertEqual([rrsig for _, _, rrsig in results], [None] * 5)
+
+	def test_allocateIdAvoidsPending(self):
+		transport = AsyncUDPTransport()
+		transport.pending = dict.fromkeys(range(DNSPacket.MAX_ID))
+		self.assertEqual(transport.allocate_id(), DNSPacket.MAX_ID)
+		transport.pending[DNSPacket.MAX_ID] = None
+		self.assertRaises(RuntimeError, transport.allocate_id)
+
+
+
+class TestTCPFallback(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.answers = make_signed_zones(['com', 'example.com'])
+
+	def setUp(self):
+		self.upstream = StubUpstream(self.answers, truncate=(DNSPacket.RR_TYPE_DNSKEY,))
+
+	def tearDown(self):
+		self.upstream.close()
+
+	def test_truncatedRetriedOverTCP(self):
+		connection = UDPCommunication()
+		for zone in ('com', 'example.com'):
+			connection.sendPacket(self.upstream.address, DNSPacket.newQuery(zone, DNSPacket.RR_TYPE_DNSKEY, True))
+			response = connection.waitForPacket()
+			self.assertEqual(response.answers[0].key_tag, self.answers[(zone, DNSPacket.RR_TYPE_DNSKEY)][0].key_tag)
+		connection.close()
+		self.assertEqual(len(self.upstream.tcp_queries), 2)
+		self.assertEqual(self.upstream.tcp_connections, 1)
+
+	def test_pipelinedOutOfOrder(self):
+		self.upstream.delay = 0.3
+		connection = TCPConnection(self.upstream.address)
+		packets = [DNSPacket.newQuery(zone, DNSPacket.RR_TYPE_DNSKEY, True) for zone in ('com', 'example.com')]
+		start = time.perf_counter()
+		responses = connection.query_many(packets)
+		self.assertLess(time.perf_counter() - start, 0.5)
+		self.assertEqual([response.id for response in responses], [packet.id for packet in packets])
+		connection.close()
+
+	def test_reconnectAfterIdle(self):
+		connection = TCPConnection(self.upstream.address)
+		connection.query_many([DNSPacket.newQuery('com', DNSPacket.RR_TYPE_DNSKEY, True)])
+		connection.last_used -= TCPConnection.IDLE_TIMEOUT + 1
+		connection.query_many([DNSPacket.newQuery('com', DNSPacket.RR_TYPE_DNSKEY, True)])
+		connection.close()
+		self.assertEqual(self.upstream.tcp_connections, 2)
+
+	def test_asyncTruncatedRetriedOverTCP(self):
+		async def query_both():
+			transport = AsyncUDPTransport()
+			responses = await asyncio.gather(
+				transport.query(self.upstream.address, 'com', DNSPacket.RR_TYPE_DNSKEY),
+				transport.query(self.upstream.address, 'example.com', DNSPacket.RR_TYPE_DNSKEY))
+			transport.close()
+			return responses
+
+		responses = asyncio.run(query_both())
+		self.assertEqual(responses[1].answers[0].key_tag,
+						 self.answers[('example.com', DNSPacket.RR_TYPE_DNSKEY)][0].key_tag)
+		self.assertEqual(self.upstream.tcp_connections, 1)
+
+
+
+class TestNameCompression(unittest.TestCase):
+
+	def test_pointersFollowed(self):
+		# Question for www.example.com, then an A record whose owner is a pointer to it,
+		# and a name which is 'mail' followed by a pointer to example.com
+		query = DNSPacket.newQuery('www.example.com', DNSPacket.RR_TYPE_A, packet_id=1).bytes
+		data = bytearray(query[:2]) + struct.pack('!HHHHH', 0x8180, 1, 2, 0, 0) + query[12:33]
+		data += b'\xc0\x0c' + struct.pack('!HHIH', DNSPacket.RR_TYPE_A, 1, 300, 4) + bytes((192, 0, 2, 1))
+		data += b'\x04mail\xc0\x10' + struct.pack('!HHIH', DNSPacket.RR_TYPE_A, 1, 300, 4) + bytes((192, 0, 2, 2))
+		packet = DNSPacket.newFromBytes(bytes(data))
+		self.assertEqual(packet.name, canonical_name('www.example.com'))
+		self.assertEqual(packet.answers[0].name, canonical_name('www.example.com'))
+		self.assertEqual(packet.answers[1].name, canonical_name('mail.example.com'))
+		self.assertEqual(packet.names[16], canonical_name('example.com'))
+
+	def test_memoizedSuffix(self):
+		data = b'\x07example\x03com\x00\xc0\x00'
+		names = {0: b'\x07cached\x00'}
+		self.assertEqual(util.read_name(data, 13, names), (2, b'\x07cached\x00'))
+
+	def test_loopsRejected(self):
+		# A pointer to itself, a pointer forwards, and labels which lead back to the same pointer
+		self.assertRaises(ValueError, util.read_name, b'\xc0\x00', 0)
+		self.assertRaises(ValueError, util.read_name, b'\x01a\xc0\x05\x00\x00', 0)
+		self.assertRaises(ValueError, util.read_name, b'\x01a\xc0\x00', 2)
+		self.assertRaises(ValueError, util.read_name, b'\x3f' + b'a' * 63 + b'\xc0\x00', 0)
+
+
+
+class TestLazyRecords(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		rsa_key = RSA.generate(1024)
+		key = make_dnskey(rsa_key)
+		cls.answers = [key, sign_rrset(rsa_key, key, [key]), make_ds(key)]
+		query = DNSPacket.newQuery('example.com', DNSPacket.RR_TYPE_DNSKEY, packet_id=1)
+		cls.response = build_response(query.bytes, cls.answers)
+
+	def test_matchesEager(self):
+		eager = DNSPacket.newFromBytes(self.response)
+		lazy = DNSPacket.newFromBytes(self.response, lazy=True)
+		fields = [('flags', 'protocol', 'algorithm', 'key', 'key_tag'),
+				  ('type_covered', 'labels', 'orig_ttl', 'expiration', 'inception', 'tag', 'signer_name', 'signature'),
+				  ('key_id', 'algorithm', 'digest_type', 'digest')]
+		for eager_record, lazy_record, names in zip(eager.answers, lazy.answers, fields):
+			self.assertIsInstance(lazy_record, type(eager_record))
+			self.assertEqual(bytes(lazy_record.rdata), eager_record.rdata)
+			for field in names:
+				self.assertEqual(getattr(lazy_record, field), getattr(eager_record, field))
+
+	def test_decodedOnFirstUse(self):
+		record = DNSPacket.newFromBytes(self.response, lazy=True).answers[0]
+		self.assertNotIn('key', record.__dict__)
+		self.assertEqual(record.key_tag, self.answers[0].key_tag)
+		self.assertIn('key', record.__dict__)
+		self.assertRaises(AttributeError, getattr, record, 'missing')
+
+	def test_expiredSignatureCheckedOnUse(self):
+		rsa_key = RSA.generate(1024)
+		key = make_dnskey(rsa_key)
+		# Expired two days ago, but otherwise a good signature
+		expired = sign_rrset(rsa_key, key, [key], signed_at=time.time() - 3 * 86400)
+		query = DNSPacket.newQuery('example.com', DNSPacket.RR_TYPE_DNSKEY, packet_id=1)
+		response = DNSPacket.newFromBytes(build_response(query.bytes, [key, expired]), lazy=True)
+		key, sig = response.answers
+		# Decoding an expired RRSIG is fine. Using it never is, however many times it is tried
+		for _ in range(2):
+			self.assertIsNone(validate_RRSET([key], [sig], [key], 'example.com'))
+		self.assertEqual(sig.signature, expired.signature)
+		not_yet_valid = sign_rrset(rsa_key, key, [key], signed_at=time.time() + 3 * 86400)
+		self.assertIsNone(validate_RRSET([key], [not_yet_valid], [key], 'example.com'))
+		current = sign_rrset(rsa_key, key, [key])
+		self.assertIs(validate_RRSET([key], [current], [key], 'example.com'), current)
+
+	def test_failedDecodeFailsEveryTime(self):
+		data = bytearray(self.response)
+		# Point the RRSIG signer name past the end of the packet
+		signer = data.index(b'\x07example\x03com\x00', data.index(self.answers[1].expiration))
+		data[signer:signer + 2] = b'\xc0\xff'
+		record = DNSPacket.newFromBytes(bytes(data), lazy=True).answers[1]
+		for _ in range(2):
+			self.assertRaises((ValueError, IndexError), getattr, record, 'signature')
+
+
+class TestCompactRecords(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		rsa_key = RSA.generate(1024)
+		cls.key = make_dnskey(rsa_key)
+		cls.records = [make_a_record((192, 0, 2, 1)), cls.key, sign_rrset(rsa_key, cls.key, [cls.key]), make_ds(cls.key)]
+
+	def test_matchesOriginal(self):
+		fields = [('ip_addr',),
+				  ('flags', 'protocol', 'algorithm', 'key', 'key_tag'),
+				  ('type_covered', 'labels', 'orig_ttl', 'expiration', 'inception', 'tag', 'signer_name', 'signature'),
+				  ('key_id', 'algorithm', 'digest_type', 'digest')]
+		for record, names in zip(self.records, fields):
+			compact = compact_record(record)
+			self.assertFalse(hasattr(compact, '__dict__'))
+			self.assertEqual(str(compact), str(record))
+			for field in ('name', 'type', 'clazz', 'ttl', 'rdata', 'rdata_len') + names:
+				self.assertEqual(getattr(compact, field), getattr(record, field))
+
+	def test_namesInterned(self):
+		first = compact_record(make_a_record((192, 0, 2, 1), owner='Example.com'))
+		second = compact_record(make_a_record((192, 0, 2, 2), owner='Example.com'))
+		self.assertIs(first.name, second.name)
+		sig = compact_record(self.records[2])
+		self.assertIs(sig.signer_name, compact_record(self.records[2]).signer_name)
+
+	def test_internedNamesFreed(self):
+		before = len(_interned_names)
+		cache = AnswerCache(max_bytes=10000)
+		for i in range(2000):
+			name = 'host{0}.example.com'.format(i)
+			cache.put(name, DNSPacket.RR_TYPE_A, [make_a_record((192, 0, 2, 1), owner=name)], None, True)
+		# Only the names of the records still cached are kept
+		self.assertLess(len(_interned_names) - before, 100)
+		cache.clear()
+		self.assertEqual(len(_interned_names), before)
+
+	def test_signerReadFromRdata(self):
+		sig = self.records[2]
+		compact = CompactRRSigRecord(sig.name, sig.type, sig.clazz, sig.ttl, sig.rdata)
+		self.assertEqual(compact.signer_name, sig.signer_name)
+		self.assertEqual(compact.signature, sig.signature)
+
+	def test_cachesHoldCompactRecords(self):
+		cache = AnswerCache()
+		cache.put('example.com', DNSPacket.RR_TYPE_DNSKEY, [self.key], self.records[2], True)
+		answer = cache.get('example.com', DNSPacket.RR_TYPE_DNSKEY)
+		self.assertIsInstance(answer.rr_set[0], CompactRecord)
+		self.assertIsInstance(answer.rrsig, CompactRecord)
+		self.assertIs(compact_record(answer.rrsig), answer.rrsig)
+
+
+class TestDomainName(unittest.TestCase):
+
+	def test_interned(self):
+		name = DomainName.get('Example.COM.')
+		self.assertIs(DomainName.get('example.com'), name)
+		self.assertIs(DomainName.get(name), name)
+		self.assertEqual(hash(name), hash(DomainName.get('EXAMPLE.com')))
+
+	def test_forms(self):
+		# The first spelling seen is the one kept
+		name = DomainName.get('www.Forms.test')
+		self.assertEqual(name.text, 'www.Forms.test')
+		self.assertEqual(name.wire, b'\x03www\x05Forms\x04test\x00')
+		self.assertEqual(name.canonical, canonical_name('www.forms.test'))
+		self.assertEqual(name.label_count, 3)
+
+	def test_parents(self):
+		name = DomainName.get('www.example.com')
+		self.assertEqual([str(zone) for zone in name.ancestors()], ['www.example.com', 'example.com', 'com', ''])
+		self.assertIs(name.parent, DomainName.get('example.com'))
+		root = DomainName.get('.')
+		self.assertIs(name.ancestors()[-1], root)
+		self.assertEqual(root.wire, b'\x00')
+		self.assertEqual(root.label_count, 0)
+		self.assertIsNone(root.parent)
+
+	def test_queryUsesWireName(self):
+		query = DNSPacket.newQuery('example.com', DNSPacket.RR_TYPE_A, packet_id=1)
+		self.assertEqual(query.bytes[DNSPacket.HEADER_LEN:], b'\x07example\x03com\x00\x00\x01\x00\x01')
+		self.assertEqual(query.name, b'\x07example\x03com\x00')
+
+
+class TestSignedData(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.rsa_key = RSA.generate(1024)
+		cls.key = make_dnskey(cls.rsa_key)
+		cls.rr_set = canonical_order([make_a_record((192, 0, 2, i), owner='Example.com') for i in range(3)])
+		cls.sig = sign_rrset(cls.rsa_key, cls.key, cls.rr_set)
+
+	def test_matchesRFC4034Layout(self):
+		sig = self.sig
+		expected = sig.rdata[:18] + sig.signer_name
+		for rr in self.rr_set:
+			expected += b'\x07example\x03com\x00' + struct.pack('!HHIH', rr.type, rr.clazz, sig.orig_ttl, 4) + rr.rdata
+		self.assertEqual(crypto.createRRSetData(self.rr_set, sig, 'Example.COM'), expected)
+
+	def test_hashMatchesBuffer(self):
+		data = crypto.createRRSetData(self.rr_set, self.sig, 'example.com')
+		hasher = crypto.hashRRSetData(self.rr_set, self.sig, 'example.com')
+		self.assertEqual(hasher.digest(), SHA256.new(data).digest())
+
+	def test_hashReusedAcrossKeys(self):
+		other_key = make_dnskey(RSA.generate(1024))
+		hasher = crypto.hashRRSetData(self.rr_set, self.sig, 'example.com')
+		self.assertFalse(crypto.verify_signature(self.sig.signature, other_key, hasher))
+		self.assertTrue(crypto.verify_signature(self.sig.signature, self.key, hasher))
+		self.assertTrue(crypto.verify_signature(self.sig.signature, self.key, hasher))
+
+
+class TestAlgorithms(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		rsa_key = RSA.generate(1024)
+		cls.signing_keys = {
+			DNSPacket.ALGO_TYPE_RSASHA1: rsa_key,
+			DNSPacket.ALGO_TYPE_RSASHA256: rsa_key,
+			DNSPacket.ALGO_TYPE_RSASHA512: rsa_key,
+			DNSPacket.ALGO_TYPE_ECDSAP256SHA256: ECC.generate(curve='P-256'),
+			DNSPacket.ALGO_TYPE_ECDSAP384SHA384: ECC.generate(curve='P-384'),
+			DNSPacket.ALGO_TYPE_ED25519: ECC.generate(curve='Ed25519'),
+		}
+		cls.rr_set = [make_a_record((192, 0, 2, 1)), make_a_record((192, 0, 2, 2))]
+
+	def test_validatesEachAlgorithm(self):
+		for algorithm, signing_key in self.signing_keys.items():
+			key = make_dnskey(signing_key, algorithm=algorithm)
+			sig = sign_rrset(signing_key, key, self.rr_set)
+			self.assertIs(validate_RRSET([key], [sig], self.rr_set, 'example.com'), sig, algorithm)
+			sig.signature = bytes([sig.signature[0] ^ 1]) + sig.signature[1:]
+			self.assertIsNone(validate_RRSET([key], [sig], self.rr_set, 'example.com'), algorithm)
+
+	def test_unknownAlgorithmSkipped(self):
+		signing_key = self.signing_keys[DNSPacket.ALGO_TYPE_ED25519]
+		key = make_dnskey(signing_key, algorithm=DNSPacket.ALGO_TYPE_ED25519)
+		sig = sign_rrset(signing_key, key, self.rr_set)
+		unknown = sign_rrset(signing_key, key, self.rr_set)
+		unknown.algorithm = 253
+		self.assertIsNone(crypto.get_algorithm(253))
+		self.assertIs(validate_RRSET([key], [unknown, sig], self.rr_set, 'example.com'), sig)
+
+	def test_separateKeyCaches(self):
+		ecdsa = crypto.get_algorithm(DNSPacket.ALGO_TYPE_ECDSAP256SHA256)
+		ecdsa.cache.clear()
+		crypto.verifier_cache.clear()
+		signing_key = self.signing_keys[DNSPacket.ALGO_TYPE_ECDSAP256SHA256]
+		key = make_dnskey(signing_key, algorithm=DNSPacket.ALGO_TYPE_ECDSAP256SHA256)
+		sig = sign_rrset(signing_key, key, self.rr_set)
+		validate_RRSET([key], [sig], self.rr_set, 'example.com')
+		self.assertEqual((len(ecdsa.cache), len(crypto.verifier_cache)), (1, 0))
+
+	def test_badKeyDoesNotVerify(self):
+		key = make_dnskey(self.signing_keys[DNSPacket.ALGO_TYPE_ECDSAP256SHA256],
+						  algorithm=DNSPacket.ALGO_TYPE_ECDSAP256SHA256)
+		key.key = key.key[:-1]
+		key.rdata = key.rdata[:-1]
+		self.assertFalse(crypto.verify_signature(b'\x00' * 64, key, b'data'))
+
+	def test_incompleteAlgorithmRejected(self):
+		class NoVerify(crypto.Algorithm):
+			def build_verifier(self, dnskey):
+				return None
+
+		self.assertRaises(TypeError, crypto.Algorithm, 253, 'PRIVATEDNS', SHA256)
+		self.assertRaises(TypeError, NoVerify, 253, 'PRIVATEDNS', SHA256)
+
+
+class TestDSDigests(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.keys = [make_dnskey(RSA.generate(1024)) for _ in range(3)]
+
+	def setUp(self):
+		crypto.fingerprint_cache.clear()
+
+	def test_digestTypes(self):
+		for digest_type, length in ((1, 20), (2, 32), (4, 48)):
+			ds = make_ds(self.keys[1], digest_type=digest_type)
+			self.assertEqual(len(ds.digest), length)
+			self.assertIs(find_ds_match('example.com', [ds], self.keys), self.keys[1])
+
+	def test_unknownDigestTypeSkipped(self):
+		unknown = make_ds(self.keys[0])
+		unknown.digest_type = 3
+		self.assertIsNone(find_ds_match('example.com', [unknown], self.keys))
+		good = make_ds(self.keys[0], digest_type=4)
+		self.assertIs(find_ds_match('example.com', [unknown, good], self.keys), self.keys[0])
+
+	def test_wrongOwnerDoesNotMatch(self):
+		ds = make_ds(self.keys[0], owner='example.org')
+		self.assertIsNone(find_ds_match('example.com', [ds], self.keys))
+
+	def test_oneHashPerKey(self):
+		# A rollover: lots of stale DS records, with the live one last
+		stale = [make_ds(make_dnskey(RSA.generate(1024))) for _ in range(4)]
+		ds_records = stale + [make_ds(self.keys[2])]
+		self.assertIs(find_ds_match('Example.com', ds_records, self.keys), self.keys[2])
+		self.assertEqual(crypto.fingerprint_cache.misses, len(self.keys))
+		find_ds_match('example.com.', ds_records, self.keys)
+		self.assertEqual(crypto.fingerprint_cache.misses, len(self.keys))
+
+
+class TestVerificationExecutor(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.rsa_keys = [RSA.generate(1024) for _ in range(2)]
+		cls.keys = [make_dnskey(rsa_key) for rsa_key in cls.rsa_keys]
+		cls.executor = VerificationExecutor(workers=2)
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.executor.close()
+
+	def test_verdictsInOrder(self):
+		rr_set = [make_a_record((192, 0, 2, 1))]
+		checks = []
+		expected = []
+		for i in range(20):
+			sig = sign_rrset(self.rsa_keys[i % 2], self.keys[i % 2], rr_set)
+			key = self.keys[(i // 3) % 2]
+			checks.append((sig.signature, key, crypto.createRRSetData(rr_set, sig, 'example.com')))
+			expected.append(key is self.keys[i % 2])
+		self.assertEqual(self.executor.verify_many(checks), expected)
+		self.assertEqual(self.executor.run(), [])
+
+	def test_validateWithExecutor(self):
+		ecc_key = ECC.generate(curve='P-256')
+		ecc_dnskey = make_dnskey(ecc_key, algorithm=DNSPacket.ALGO_TYPE_ECDSAP256SHA256)
+		rr_set = [make_a_record((192, 0, 2, 1)), make_a_record((192, 0, 2, 2))]
+		bad = sign_rrset(self.rsa_keys[0], self.keys[0], rr_set)
+		bad.signature = bytes(len(bad.signature))
+		good = sign_rrset(ecc_key, ecc_dnskey, rr_set)
+		keys = self.keys + [ecc_dnskey]
+		self.assertIs(validate_RRSET(keys, [bad, good], rr_set, 'example.com', self.executor), good)
+		self.assertIsNone(validate_RRSET(keys, [bad], rr_set, 'example.com', self.executor))
+
+	def test_queuedChecksKeptApart(self):
+		rr_set = [make_a_record((192, 0, 2, 1))]
+		good = sign_rrset(self.rsa_keys[0], self.keys[0], rr_set)
+		bad = sign_rrset(self.rsa_keys[0], self.keys[0], rr_set)
+		bad.signature = bytes(len(bad.signature))
+		# Someone else's check, already queued, must not lend its verdict to the bad RRSIG
+		position = self.executor.submit(good.signature, self.keys[0], crypto.createRRSetData(rr_set, good, 'example.com'))
+		self.assertIsNone(validate_RRSET(self.keys, [bad], rr_set, 'example.com', self.executor))
+		self.assertEqual(self.executor.run()[position], True)
+
+
+class TestBatch(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.answers = make_signed_zones(['com', 'example.com'])
+		add_signed_a_record(cls.answers, 'example.com')
+		cls.upstream = StubUpstream(cls.answers, rcodes={'gone.example.com': 3})
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.upstream.close()
+
+	def run_batch(self, lines, output_format):
+		out = io.StringIO()
+		validator = Validator(self.upstream.address)
+		self.addCleanup(validator.close)
+		count, valid = dnsclient.run_batch(lines, out, output_format, validator)
+		return count, valid, out.getvalue().splitlines()
+
+	def test_oneFailureDoesNotStopOthers(self):
+		lines = ["example.com A\n", "# comment\n", "\n", "nosuch.com A\n", "gone.example.com A\n",
+				 "bad line here\n", "example.com MX\n", "Example.com DNSKEY\n"]
+		count, valid, output = self.run_batch(lines, 'jsonl')
+		results = [json.loads(line) for line in output]
+		self.assertEqual([(result['name'], result['status']) for result in results],
+						 [('example.com', 'VALID'), ('nosuch.com', 'MISSING-DS'), ('gone.example.com', 'NOTFOUND'),
+						  ('bad line here', 'BAD-INPUT'), ('example.com', 'NOT-SUPPORTED'), ('Example.com', 'VALID')])
+		self.assertEqual((count, valid), (6, 2))
+		self.assertEqual(results[0]['records'], ['IP\t192.0.2.1'])
+
+	def test_sharedCachesAndTSV(self):
+		queries_before = len(self.upstream.queries)
+		count, valid, output = self.run_batch(["example.com A\n"] * 3, 'tsv')
+		self.assertEqual(output, ["example.com\tA\tVALID\t1"] * 3)
+		# Chain for com and example.com, the A record and its zone keys, and then nothing for the repeats
+		self.assertEqual(len(self.upstream.queries) - queries_before, 5)
+
+
+class TestValidator(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.answers = make_signed_zones(['com', 'example.com'])
+		add_signed_a_record(cls.answers, 'example.com')
+		cls.upstream = StubUpstream(cls.answers, rcodes={'gone.example.com': 3, 'broken.example.com': 2})
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.upstream.close()
+
+	def setUp(self):
+		self.validator = Validator(self.upstream.address)
+		self.addCleanup(self.validator.close)
+
+	def test_validResultAndCache(self):
+		result = self.validator.validate('example.com', 'A')
+		self.assertTrue(result.valid)
+		self.assertEqual((result.type, len(result.rr_set)), (DNSPacket.RR_TYPE_A, 1))
+		self.assertEqual(result.rrsig.type_covered, DNSPacket.RR_TYPE_A)
+		queries = len(self.upstream.queries)
+		self.assertTrue(self.validator.validate('example.com', DNSPacket.RR_TYPE_A).valid)
+		self.assertEqual(len(self.upstream.queries), queries)
+
+	def test_errorStatusesWithoutSideEffects(self):
+		out = io.StringIO()
+		with contextlib.redirect_stdout(out):
+			results = list(self.validator.validate_many([('nosuch.com', 'A'), ('gone.example.com', 'A'),
+														 ('broken.example.com', 'A'), ('example.com', 'MX')]))
+		self.assertEqual([result.status for result in results], ['MISSING-DS', 'NOTFOUND', 'SERVFAIL', 'NOT-SUPPORTED'])
+		self.assertFalse(any(result.valid for result in results))
+		self.assertEqual(out.getvalue(), '')
+
+	def test_invalidSignature(self):
+		answers = dict(self.answers)
+		rr_set, sig = answers[('example.com', DNSPacket.RR_TYPE_A)]
+		forged = make_a_record((198, 51, 100, 1))
+		answers[('example.com', DNSPacket.RR_TYPE_A)] = [forged, sig]
+		upstream = StubUpstream(answers)
+		self.addCleanup(upstream.close)
+		with Validator(upstream.address) as validator:
+			result = validator.validate('example.com', 'A')
+		self.assertEqual(result.status, 'INVALID-RRSIG')
+		self.assertEqual(result.rr_set[0].rdata, forged.rdata)
+		self.assertIsNone(result.rrsig)
+
+	def test_expiredSignature(self):
+		answers = dict(self.answers)
+		rsa_key, key = zone_keys['example.com']
+		rr_set = [make_a_record((192, 0, 2, 1))]
+		# Expired two days ago
+		answers[('example.com', DNSPacket.RR_TYPE_A)] = rr_set + [
+			sign_rrset(rsa_key, key, rr_set, signed_at=time.time() - 3 * 86400)]
+		upstream = StubUpstream(answers)
+		self.addCleanup(upstream.close)
+		with Validator(upstream.address) as validator:
+			for _ in range(2):
+				result = validator.validate('example.com', 'A')
+				self.assertEqual(result.status, 'INVALID-RRSIG')
+				self.assertEqual(len(result.rr_set), 1)
+
+	def test_malformedResponse(self):
+		class LazyConnection(FakeConnection):
+			"""
+			Hands back answers as lazily parsed packets, so broken RDATA only shows when it is read
+			"""
+
+			def sendPacket(self, addr, packet):
+				FakeConnection.sendPacket(self, addr, packet)
+				self.query = packet.bytes
+
+			def waitForPacket(self):
+				return DNSPacket.newFromBytes(build_response(self.query, self.answers.get(self.queries[-1], [])),
+											  lazy=True)
+
+			def close(self):
+				pass
+
+		answers = dict(self.answers)
+		sig = answers[('example.com', DNSPacket.RR_TYPE_DS)][1]
+		short = make_ds(zone_keys['example.com'][1])
+		short.rdata = short.rdata[:2]
+		short.rdata_len = 2
+		# Last in the packet, so decoding it runs off the end
+		answers[('example.com', DNSPacket.RR_TYPE_DS)] = [sig, short]
+		with Validator(None, connection=LazyConnection(answers)) as validator:
+			self.assertEqual(validator.validate('example.com', 'A').status, 'MALFORMED')
+
+
+class TestStubResolver(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.answers = make_signed_zones(['com', 'example.com'])
+		add_signed_a_record(cls.answers, 'example.com')
+		cls.upstream = StubUpstream(cls.answers, rcodes={'gone.example.com': 3})
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.upstream.close()
+
+	def setUp(self):
+		# The server runs on its own event loop in the background, like a daemon would
+		self.loop = asyncio.new_event_loop()
+		thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+		thread.start()
+		self.server = StubResolver(self.upstream.address, ('127.0.0.1', 0))
+		self.on_loop(self.server.start())
+		self.addCleanup(self.stop, thread)
+
+	def on_loop(self, coroutine):
+		return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(10)
+
+	def stop(self, thread):
+		async def close():
+			self.server.close()
+			# Let the transports finish closing before the loop stops
+			await asyncio.sleep(0.01)
+
+		self.on_loop(close())
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		thread.join()
+		self.loop.close()
+
+	def query(self, name, type, using_dnssec=True):
+		packet = DNSPacket.newQuery(name, type, using_dnssec)
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.addCleanup(sock.close)
+		sock.settimeout(5)
+		sock.sendto(packet.bytes, self.server.address)
+		return DNSPacket.newFromBytes(sock.recv(4096), packet.id)
+
+	def test_validatedAnswerHasADBit(self):
+		response = self.query('example.com', DNSPacket.RR_TYPE_A)
+		self.assertTrue(response.ad)
+		self.assertEqual([rr.type for rr in response.answers], [DNSPacket.RR_TYPE_A, DNSPacket.RR_TYPE_RRSIG])
+		self.assertEqual(response.answers[0].ip_addr, bytes((192, 0, 2, 1)))
+		# Without the DO bit only the records are sent
+		response = self.query('Example.COM', DNSPacket.RR_TYPE_A, using_dnssec=False)
+		self.assertTrue(response.ad)
+		self.assertEqual([rr.type for rr in response.answers], [DNSPacket.RR_TYPE_A])
+
+	def test_validationSharedBetweenClients(self):
+		self.query('example.com', DNSPacket.RR_TYPE_DNSKEY)
+		queries = len(self.upstream.queries)
+		for _ in range(3):
+			self.assertTrue(self.query('example.com', DNSPacket.RR_TYPE_DNSKEY).ad)
+		self.assertEqual(len(self.upstream.queries), queries)
+
+	def test_failures(self):
+		with self.assertRaises(DNSError) as error:
+			self.query('nosuch.com', DNSPacket.RR_TYPE_A)
+		self.assertEqual(error.exception.status, 'SERVFAIL')
+		with self.assertRaises(DNSError) as error:
+			self.query('gone.example.com', DNSPacket.RR_TYPE_A)
+		self.assertEqual(error.exception.status, 'NOTFOUND')
+		with self.assertRaises(DNSError) as error:
+			self.query('example.com', 15)
+		self.assertEqual(error.exception.status, 'NOTIMP')
+
+	def test_malformedQuery(self):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.addCleanup(sock.close)
+		sock.settimeout(5)
+		sock.sendto(struct.pack('!HHHHHH', 4321, 0x0100, 1, 0, 0, 0) + b'\x07example', self.server.address)
+		response = sock.recv(4096)
+		self.assertEqual(struct.unpack_from('!HH', response), (4321, 0x8181))
+
+	def test_pipelinedOverTCP(self):
+		connection = TCPConnection(self.server.address)
+		self.addCleanup(connection.close)
+		packets = [DNSPacket.newQuery(name, type, True) for name, type in
+				   [('example.com', DNSPacket.RR_TYPE_A), ('com', DNSPacket.RR_TYPE_DNSKEY), ('example.com', DNSPacket.RR_TYPE_DNSKEY)]]
+		responses = connection.query_many(packets)
+		self.assertTrue(all(response.ad for response in responses))
+		self.assertEqual([response.answers[0].type for response in responses],
+						 [DNSPacket.RR_TYPE_A, DNSPacket.RR_TYPE_DNSKEY, DNSPacket.RR_TYPE_DNSKEY])
+
+
+class TestResolverWorkers(unittest.TestCase):
+
+	def test_workersShareOnePortAndZones(self):
+		answers = make_signed_zones(['com', 'example.com'])
+		add_signed_a_record(answers, 'example.com')
+		upstream = StubUpstream(answers)
+		self.addCleanup(upstream.close)
+		workers = ResolverWorkers(upstream.address, ('127.0.0.1', 0), workers=2)
+		workers.start()
+		self.addCleanup(workers.close)
+		self.assertEqual(len(workers.processes), 2)
+
+		# A new socket for every query, so the kernel spreads them over both workers
+		for _ in range(8):
+			packet = DNSPacket.newQuery('example.com', DNSPacket.RR_TYPE_A, True)
+			with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+				sock.settimeout(5)
+				sock.sendto(packet.bytes, workers.address)
+				self.assertTrue(DNSPacket.newFromBytes(sock.recv(4096), packet.id).ad)
+		# Whichever worker validated the chain first, the other picked it up from the shared table
+		self.assertEqual(upstream.queries.count(('example.com', DNSPacket.RR_TYPE_DS)), 1)
+		shared_file = workers.shared_file
+		workers.close()
+		self.assertFalse(os.path.exists(shared_file))
+
+
+class TestRetransmission(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.answers = make_signed_zones(['com'])
+
+	def setUp(self):
+		self.upstream = StubUpstream(self.answers)
+		self.addCleanup(self.upstream.close)
+		self.connection = UDPCommunication()
+		self.addCleanup(self.connection.close)
+
+	def query(self):
+		self.connection.sendPacket(self.upstream.address, DNSPacket.newQuery('com', DNSPacket.RR_TYPE_DNSKEY, True))
+		return self.connection.waitForPacket()
+
+	def test_rttEstimator(self):
+		rtt = RTTEstimator()
+		self.assertEqual(rtt.rto, RTTEstimator.INITIAL_RTO)
+		rtt.sample(0.1)
+		self.assertAlmostEqual(rtt.rto, 0.1 + 4 * 0.05)
+		rtt.backoff()
+		self.assertAlmostEqual(rtt.rto, 0.6)
+		for _ in range(5):
+			rtt.backoff()
+		self.assertEqual(rtt.rto, RTTEstimator.MAX_RTO)
+		# A measured answer resets the backoff
+		rtt.sample(0.1)
+		self.assertAlmostEqual(rtt.rto, 0.1 + 4 * 0.0375)
+		for _ in range(50):
+			rtt.sample(0.0001)
+		self.assertEqual(rtt.rto, RTTEstimator.MIN_RTO)
+
+	def test_lostQueryRetriedQuickly(self):
+		# Before any answer the timeout is the initial one, not the whole budget
+		self.upstream.drop = 1
+		start = time.perf_counter()
+		self.assertEqual(len(self.query().answers), 2)
+		self.assertLess(time.perf_counter() - start, RTTEstimator.INITIAL_RTO + 0.5)
+		# Once the resolver's round trip time is known, a loss costs a fraction of that
+		for _ in range(3):
+			self.query()
+		self.upstream.drop = 1
+		start = time.perf_counter()
+		self.assertEqual(len(self.query().answers), 2)
+		self.assertLess(time.perf_counter() - start, 0.5)
+		self.assertEqual(len(self.upstream.queries), 7)
+
+	def test_retryBudget(self):
+		for _ in range(3):
+			self.query()
+		self.upstream.drop = 100
+		start = time.perf_counter()
+		with self.assertRaises(DNSError) as error:
+			self.query()
+		self.assertEqual(error.exception.status, 'NORESPONSE')
+		self.assertLess(time.perf_counter() - start, 2)
+		self.assertEqual(len(self.upstream.queries), 3 + UDPCommunication.MAX_TRIES)
+
+	def test_asyncLostQueryRetried(self):
+		async def query_twice():
+			transport = AsyncUDPTransport()
+			await transport.query(self.upstream.address, 'com', DNSPacket.RR_TYPE_DNSKEY)
+			self.upstream.drop = 1
+			start = time.perf_counter()
+			response = await transport.query(self.upstream.address, 'com', DNSPacket.RR_TYPE_DNSKEY)
+			elapsed = time.perf_counter() - start
+			transport.close()
+			return response, elapsed
+
+		response, elapsed = asyncio.run(query_twice())
+		self.assertEqual(len(response.answers), 2)
+		self.assertLess(elapsed, 0.5)
+		self.assertEqual(len(self.upstream.queries), 3)
+
+
+class TestUpstreamPool(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.answers = make_signed_zones(['com'])
+
+	def setUp(self):
+		self.now = 0
+		self.pool = UpstreamPool([('127.0.0.1', 1), ('127.0.0.1', 2)], clock=lambda: self.now)
+		self.a, self.b = self.pool.addresses
+
+	def upstreams(self, count, **kwargs):
+		upstreams = []
+		for _ in range(count):
+			upstream = StubUpstream(self.answers, **kwargs)
+			self.addCleanup(upstream.close)
+			upstreams.append(upstream)
+		return upstreams
+
+	def test_fastestSelected(self):
+		# Until something is measured the first is picked, and the other is probed alongside it
+		self.assertEqual(self.pool.select(), self.a)
+		self.assertEqual(self.pool.probe(exclude=[self.a]), self.b)
+		self.assertIsNone(self.pool.probe(exclude=[self.a]))
+		# Measured upstreams come first
+		self.pool.answered(self.a, 0.2)
+		self.assertEqual(self.pool.select(), self.a)
+		self.pool.answered(self.b, 0.01)
+		self.assertEqual(self.pool.select(), self.b)
+		self.assertEqual(self.pool.select(exclude=[self.b]), self.a)
+		self.assertIsNone(self.pool.select(exclude=[self.a, self.b]))
+		self.assertIsNone(self.pool.probe())
+
+	def test_downAndProbed(self):
+		self.pool.answered(self.a, 0.2)
+		self.pool.answered(self.b, 0.01)
+		for _ in range(UpstreamPool.DOWN_AFTER):
+			self.pool.failed(self.b)
+		self.assertTrue(self.pool.is_down(self.b))
+		self.assertEqual(self.pool.select(), self.a)
+		self.assertIsNone(self.pool.probe(exclude=[self.a]))
+		# Once the probe interval passes, one query sends it a copy
+		self.now = UpstreamPool.PROBE_INTERVAL
+		self.assertEqual(self.pool.select(), self.a)
+		self.assertEqual(self.pool.probe(exclude=[self.a]), self.b)
+		self.assertIsNone(self.pool.probe(exclude=[self.a]))
+		# A failed probe waits twice as long for the next
+		self.pool.failed(self.b)
+		self.now += UpstreamPool.PROBE_INTERVAL
+		self.assertIsNone(self.pool.probe(exclude=[self.a]))
+		self.now += UpstreamPool.PROBE_INTERVAL
+		self.assertEqual(self.pool.probe(exclude=[self.a]), self.b)
+		self.pool.answered(self.b, 0.01)
+		self.assertFalse(self.pool.is_down(self.b))
+		self.assertEqual(self.pool.select(), self.b)
+		# Everything down still picks something
+		for address in self.pool.addresses:
+			for _ in range(UpstreamPool.DOWN_AFTER):
+				self.pool.failed(address)
+		self.assertIsNotNone(self.pool.select())
+
+	def test_retryDelay(self):
+		self.assertEqual(self.pool.retry_delay(self.a), RTTEstimator.INITIAL_RTO)
+		self.pool.hedge = True
+		for _ in range(UpstreamPool.HEDGE_SAMPLES):
+			self.pool.answered(self.a, 0.5)
+		self.assertAlmostEqual(self.pool.retry_delay(self.a), 0.5)
+		# Hedging never waits longer than the timeout
+		self.pool.rtt[self.a].rto = 0.1
+		self.assertAlmostEqual(self.pool.retry_delay(self.a), 0.1)
+		# Only its own answers count
+		for _ in range(UpstreamPool.LATENCY_WINDOW):
+			self.pool.answered(self.b, 0.01)
+		self.assertAlmostEqual(self.pool.retry_delay(self.a), 0.1)
+		for _ in range(UpstreamPool.LATENCY_WINDOW):
+			self.pool.answered(self.a, 0.01)
+		self.assertAlmostEqual(self.pool.retry_delay(self.a), 0.01)
+
+	def test_failover(self):
+		dead, alive = self.upstreams(2)
+		dead.drop = 100
+		pool = UpstreamPool([dead.address, alive.address])
+		# Both measured, and the one about to stop answering the faster
+		pool.answered(dead.address, 0.001)
+		pool.answered(alive.address, 0.01)
+		connection = UDPCommunication()
+		self.addCleanup(connection.close)
+		for _ in range(UpstreamPool.DOWN_AFTER):
+			connection.sendPacket(pool, DNSPacket.newQuery('com', DNSPacket.RR_TYPE_DNSKEY, True))
+			self.assertEqual(len(connection.waitForPacket().answers), 2)
+		self.assertTrue(pool.is_down(pool.addresses[0]))
+		# Now it is skipped without waiting on it
+		start = time.perf_counter()
+		connection.sendPacket(pool, DNSPacket.newQuery('com', DNSPacket.RR_TYPE_DNSKEY, True))
+		self.assertEqual(len(connection.waitForPacket().answers), 2)
+		self.assertLess(time.perf_counter() - start, 0.5)
+		self.assertEqual(len(dead.queries), UpstreamPool.DOWN_AFTER)
+
+	def test_deadUpstreamNeverWaitedOn(self):
+		dead, alive = self.upstreams(2)
+		dead.drop = 100
+		pool = UpstreamPool([dead.address, alive.address])
+
+		async def query():
+			transport = AsyncUDPTransport()
+			elapsed = []
+			for _ in range(3):
+				start = time.perf_counter()
+				await transport.query(pool, 'com', DNSPacket.RR_TYPE_DNSKEY)
+				elapsed.append(time.perf_counter() - start)
+			# Down, backed off as far as it goes, and due a probe
+			for _ in range(UpstreamPool.DOWN_AFTER):
+				pool.failed(dead.address)
+			pool.rtt[dead.address].rto = RTTEstimator.MAX_RTO
+			pool.upstreams[dead.address].down_until = 0
+			start = time.perf_counter()
+			await transport.query(pool, 'com', DNSPacket.RR_TYPE_DNSKEY)
+			elapsed.append(time.perf_counter() - start)
+			transport.close()
+			return elapsed
+
+		# Tried first while nothing was measured, probed once the live one was, and probed again once down.
+		# Every query was answered by the live one straight away
+		self.assertLess(max(asyncio.run(query())), 0.5)
+		self.assertEqual(len(dead.queries), 3)
+
+		connection = UDPCommunication()
+		self.addCleanup(connection.close)
+		pool.upstreams[dead.address].down_until = 0
+		start = time.perf_counter()
+		connection.sendPacket(pool, DNSPacket.newQuery('com', DNSPacket.RR_TYPE_DNSKEY, True))
+		self.assertEqual(len(connection.waitForPacket().answers), 2)
+		self.assertLess(time.perf_counter() - start, 0.5)
+		self.assertEqual(len(dead.queries), 4)
+
+	def test_asyncHedge(self):
+		fast, slow = self.upstreams(2)
+		slow.delay = 0.3
+		pool = UpstreamPool([fast.address, slow.address], hedge=True)
+
+		async def query():
+			transport = AsyncUDPTransport()
+			for _ in range(UpstreamPool.HEDGE_SAMPLES + 1):
+				await transport.query(pool, 'com', DNSPacket.RR_TYPE_DNSKEY)
+			# The usually fast upstream stalls, so the query is hedged to the other one
+			fast.delay, slow.delay = 1, 0
+			start = time.perf_counter()
+			response = await transport.query(pool, 'com', DNSPacket.RR_TYPE_DNSKEY)
+			elapsed = time.perf_counter() - start
+			transport.close()
+			return response, elapsed
+
+		response, elapsed = asyncio.run(query())
+		self.assertEqual(len(response.answers), 2)
+		self.assertLess(elapsed, 0.5)
+		self.assertEqual(len(slow.queries), 2)
+
+	def test_beatenCopyNotFailed(self):
+		first, second = self.upstreams(2)
+		first.delay, second.delay = 0.1, 0.3
+		pool = UpstreamPool([first.address, second.address], hedge=True)
+		pool.answered(first.address, 0.01)
+		pool.answered(second.address, 0.2)
+
+		async def race():
+			transport = AsyncUDPTransport()
+			for _ in range(UpstreamPool.DOWN_AFTER + 1):
+				# Sent to the second one after 0.05s, then beaten by the first one's answer at 0.1s
+				pool.rtt[first.address].rto = 0.05
+				await transport.query(pool, 'com', DNSPacket.RR_TYPE_DNSKEY)
+			transport.close()
+
+		asyncio.run(race())
+		self.assertEqual(len(second.queries), UpstreamPool.DOWN_AFTER + 1)
+		self.assertFalse(pool.is_down(second.address))
+		self.assertEqual(pool.upstreams[second.address].failures, 0)
+
+	def test_parseServer(self):
+		self.assertEqual(dnsclient.parse_server('@127.0.0.1'), ('127.0.0.1', dnsclient.DEFAULT_PORT))
+		pool = dnsclient.parse_server('@127.0.0.1:5300,localhost', hedge=True)
+		self.assertEqual(pool.addresses, [('127.0.0.1', 5300), ('127.0.0.1', dnsclient.DEFAULT_PORT)])
+		self.assertTrue(pool.hedge)
+
+
 if __name__ == '__main__':
 	unittest.main()
@@ -9,6 +9,9 @@ import struct
 # A global variable, which can be set from main
 debug_print_enabled = False
 
+# Longest a domain name can be in wire format
+MAX_NAME_LEN = 255
+
 
 def dprint(*args):
     if debug_print_enabled:
@@ -71,57 +74,87 @@ def dump_packet(data):
             print(s)
 
 
-def skip_name(bytes):
+def skip_name(data, offset=0):
     """
     Returns the length of a name from a DNS record
-    :param bytes: The bytes of the DNS record starting at the name
+    :param data: The bytes (or memoryview) holding the name
+    :param offset: Index of the start of the name
     :return: The number of bytes to skip
     """
-    i = 0
-    if (bytes[i] >> 6) == 0b11:
+    i = offset
+    if (data[i] >> 6) == 0b11:
         # If the first two bits of the 'name' field are 1, then there is a pointer here, not the actual name.
         #  just move past it
-        # print("Found a pointer to name")
         i += 2
     else:
         # Not a pointer.. move i past this string
-        num_bytes = bytes[i]
+        num_bytes = data[i]
         while num_bytes != 0:
             i += 1 + num_bytes
-            num_bytes = bytes[i]
+            num_bytes = data[i]
         i += 1
-    return i
+    return i - offset
 
 
-def parse_name(bytes):
+def read_name(data, offset=0, names=None):
     """
-    Parses a name in a DNS record
-    :param bytes: The bytes of the record starting at the name
-    :return: A tuple containing the length of the name and the name
+    Reads a name from a packet, following compression pointers to put it back together
+    https://tools.ietf.org/html/rfc1035#section-4.1.4
+
+    names is a table of offset -> uncompressed name for the packet. Every label read is added to it, so
+    later pointers to the same suffix are answered from the table instead of walking the labels again.
+    Pointers may only point backwards, and names may not be longer than 255 bytes, so a malicious
+    packet can't send us round in circles
+    :param data: The bytes (or memoryview) of the whole packet
+    :param offset: Index of the start of the name
+    :param names: The packet's name table, shared between calls
+    :return: A tuple containing the number of bytes the name takes up at offset, and the uncompressed
+             name in wire format
     """
-    i = 0
-    if (bytes[i] >> 6) == 0b11:
-        # Name is stored as a 2-byte pointer. We will just ignore this for now
-        domain = bytes[i:i + 2]
-        i += 2
-    else:
-        # Not a pointer.. parse out the string
-        reading_domain_string = True
-        domain = []
-        while reading_domain_string:
-            num_bytes = bytes[i]
-            # print("num_bytes =", num_bytes)
-            domain.append(num_bytes.to_bytes(1, byteorder='big'))
-            i += 1
-            if num_bytes == 0:
-                # A zero byte means the domain part is done
-                # print("Done reading domain")
-                reading_domain_string = False
-            else:
-                domain.append(bytes[i: i + num_bytes])
-                i += num_bytes
-
-    return i, domain
+    if names is None:
+        names = {}
+    label_offsets = []
+    labels = []
+    name_len = 1
+    end = None
+    i = offset
+    while True:
+        num_bytes = data[i]
+        if (num_bytes >> 6) == 0b11:
+            # A pointer to where the rest of the name was already written
+            target = ((num_bytes & 0x3F) << 8) | data[i + 1]
+            if end is None:
+                end = i + 2
+            if target >= i:
+                raise ValueError("Name compression pointer at {0} does not point backwards".format(i))
+            if target in names:
+                suffix = names[target]
+                break
+            i = target
+        elif num_bytes >> 6 != 0:
+            raise ValueError("Unknown label type at {0}".format(i))
+        elif num_bytes == 0:
+            # A zero byte means the domain part is done
+            if end is None:
+                end = i + 1
+            suffix = b'\x00'
+            break
+        else:
+            name_len += 1 + num_bytes
+            if name_len > MAX_NAME_LEN:
+                raise ValueError("Name at {0} is longer than {1} bytes".format(offset, MAX_NAME_LEN))
+            label_offsets.append(i)
+            labels.append(bytes(data[i:i + 1 + num_bytes]))
+            i += 1 + num_bytes
+
+    # Put the name together from the end, remembering the name starting at each label
+    name = suffix
+    for label_offset, label in zip(reversed(label_offsets), reversed(labels)):
+        name = label + name
+        names[label_offset] = name
+    if len(name) > MAX_NAME_LEN:
+        raise ValueError("Name at {0} is longer than {1} bytes".format(offset, MAX_NAME_LEN))
+    return end - offset, name
 
 
 def ts_to_dt(ts):
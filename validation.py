@@ -0,0 +1,251 @@
+"""
+Validation of RRsets and of the chain of trust, shared by the command line client and the resolvers
+"""
+import struct
+import time
+
+import crypto
+from canonical import canonical_order
+from DNSPacket import DNSPacket
+from domain_name import DomainName
+from util import dprint
+
+
+def get_packet(connection, domain_name, resolver_address, type):
+    """
+    Requests a packet from domain_name and returns it
+    :param connection: A UDPConnection to use
+    :param domain_name: The domain name to request
+    :param resolver_address: The resolver addresss
+    :param type: The type of packet being requested
+    :return: The packet
+    """
+    query = DNSPacket.newQuery(domain_name, type, using_dnssec=True)
+    connection.sendPacket(resolver_address, query)
+    return connection.waitForPacket()
+
+
+def get_keys(dnskey_response):
+    """
+    Pulls DNSKEYs out of a response packet
+    :param dnskey_response: A DNS response
+    :return: A list of DNSKEY records
+    """
+    keys = []
+    for answer in dnskey_response.answers:
+        if answer.type == DNSPacket.RR_TYPE_DNSKEY:
+            keys.append(answer)
+    return keys
+
+
+def get_rrsigs(response):
+    """
+    Pulls out the RRSIGs from a response packet
+    :param response: A DNS response
+    :return: A list of RRSIG records
+    """
+    rrsig_set = []
+    for answer in response.answers:
+        if answer.type == DNSPacket.RR_TYPE_RRSIG:
+            rrsig_set.append(answer)
+    return rrsig_set
+
+
+def get_rrset(response):
+    """
+    Pulls out the RRSET which was signed from a response packet
+    :param response: A DNS response
+    :return: The RRSET
+    """
+    rr_set = []
+    for answer in response.answers:
+        if answer.type != DNSPacket.RR_TYPE_RRSIG:
+            rr_set.append(answer)
+    return rr_set
+
+
+def in_validity_period(sig, now):
+    """
+    Checks that an RRSIG's validity period covers the current time
+    https://tools.ietf.org/html/rfc4035#section-5.3.1
+    :param sig: The RRSIG record
+    :param now: The current time, as a unix timestamp
+    :return: True if the signature is usable now, false otherwise
+    """
+    return struct.unpack('!I', sig.inception)[0] <= now < struct.unpack('!I', sig.expiration)[0]
+
+
+def validate_RRSET(keys, rrsig_set, rr_set, domain_name, executor=None):
+    """
+    Validates the signature on an RRset. RRSIGs outside their validity period are never used
+    :param keys: The DNSKEYS to check with
+    :param rrsig_set: A set of RRSIGs to check
+    :param rr_set: The RRset, in any order
+    :param domain_name: The domain name of the RRset
+    :param executor: Optional verify_pool.VerificationExecutor. Every (RRSIG, key) pair is checked at once
+                     across its workers instead of one after another
+    :return: The RRSIG record that verified, or None if none did
+    """
+    # The signer always signs the canonical ordering, so there is exactly one buffer to check per RRSIG
+    ordered_rr_set = canonical_order(rr_set)
+    key_index = crypto.index_keys(keys)
+    now = time.time()
+    if executor is not None:
+        return _validate_RRSET_parallel(key_index, rrsig_set, ordered_rr_set, domain_name, executor, now)
+    for sig in rrsig_set:
+        if not in_validity_period(sig, now):
+            dprint("RRSIG with tag {0} is expired or not yet valid".format(sig.tag))
+            continue
+        if crypto.get_algorithm(sig.algorithm) is None:
+            # Another RRSIG over the same RRset may use an algorithm we do support
+            dprint("ERROR\tUNKNOWN ALGORITHM", sig.algorithm)
+            continue
+        candidate_keys = key_index.get((sig.tag, sig.algorithm), [])
+        if len(candidate_keys) == 0:
+            dprint("No DNSKEY with tag {0} for RRSIG".format(sig.tag))
+            continue
+        # Hashed once, then checked against each candidate key
+        rrset_hash = crypto.hashRRSetData(ordered_rr_set, sig, domain_name)
+        for key in candidate_keys:
+            if crypto.verify_signature(sig.signature, key, rrset_hash):
+                return sig
+    return None
+
+
+def _validate_RRSET_parallel(key_index, rrsig_set, ordered_rr_set, domain_name, executor, now):
+    # Run as a batch of their own, so checks other callers have queued on the executor can't shift the verdicts
+    checks = []
+    sigs = []
+    for sig in rrsig_set:
+        if not in_validity_period(sig, now):
+            dprint("RRSIG with tag {0} is expired or not yet valid".format(sig.tag))
+            continue
+        if crypto.get_algorithm(sig.algorithm) is None:
+            dprint("ERROR\tUNKNOWN ALGORITHM", sig.algorithm)
+            continue
+        candidate_keys = key_index.get((sig.tag, sig.algorithm), [])
+        if len(candidate_keys) == 0:
+            continue
+        rrset_data = crypto.createRRSetData(ordered_rr_set, sig, domain_name)
+        for key in candidate_keys:
+            checks.append((sig.signature, key, rrset_data))
+            sigs.append(sig)
+    # Verdicts come back in the order given, so the first good one is the one the serial loop would pick
+    for sig, verdict in zip(sigs, executor.verify_many(checks)):
+        if verdict:
+            return sig
+    return None
+
+
+def get_ds_records(ds_response):
+    """
+    Pulls DS records out of a response packet
+    :param ds_response: A DNS response
+    :return: A list of DS records
+    """
+    ds_records = []
+    for answer in ds_response.answers:
+        if answer.type == DNSPacket.RR_TYPE_DS:
+            ds_records.append(answer)
+    return ds_records
+
+
+def find_ds_match(zone, ds_records, keys):
+    """
+    Tries to validate a key, any key, against the DS records from the parent zone.
+    Each DS names the key it is for by tag, algorithm and digest, so the keys are fingerprinted once per
+    digest type and each DS is a single lookup
+    :param zone: The zone the keys belong to
+    :param ds_records: The DS records for the zone
+    :param keys: The zone's DNSKEY records
+    :return: The DNSKEY matching a DS, or None if none do
+    """
+    # Digest type -> fingerprint table
+    tables = {}
+    for ds_record in ds_records:
+        digest_type = ds_record.digest_type
+        if digest_type not in crypto.DIGEST_TYPES:
+            dprint("Skipping DS with unknown digest type", digest_type)
+            continue
+        table = tables.get(digest_type)
+        if table is None:
+            table = tables[digest_type] = crypto.fingerprint_cache.fingerprints(keys, zone, digest_type)
+        key = table.get((ds_record.key_id, ds_record.algorithm, bytes(ds_record.digest)))
+        dprint("\nDS hash: ", ds_record.digest)
+        if key is not None:
+            dprint("MATCH WOOHOO")
+            return key
+    return None
+
+
+def verify_zone(domain_name, connection, resolver_address, chain_cache=None):
+    """
+    Attempts to verify the public key of the given zone by establishing PKI from root
+    :param domain_name: The domain name to begin at
+    :param connection: A UDP connection object to use
+    :param resolver_address: The address of the resolver
+    :param chain_cache: Optional ChainCache. The walk stops at the first zone already in it,
+                        and every zone validated on the way is added to it
+    :return: True if zone verified, false otherwise
+    """
+    chain = []
+    parent_expires = float('inf')
+    # Every zone from the domain up to, but not including, the root
+    for cur_domain in DomainName.get(domain_name).ancestors()[:-1]:
+        parent_domain = cur_domain.parent
+        if chain_cache is not None:
+            entry = chain_cache.get(cur_domain)
+            if entry is not None:
+                dprint("\n\n{0} already verified".format(cur_domain))
+                parent_expires = entry.expires
+                break
+        dprint("\n\nVerifying {0} key using {1}".format(cur_domain, parent_domain))
+
+        # Fetch DS records
+        query = DNSPacket.newQuery(cur_domain, DNSPacket.RR_TYPE_DS, using_dnssec=True)
+        connection.sendPacket(resolver_address, query)
+        ds_response = connection.waitForPacket()
+
+        # Pull DS records out from the response
+        ds_records = get_ds_records(ds_response)
+        if len(ds_records) == 0:
+            return False
+        dprint("\nFound {0} ds records".format(len(ds_records)))
+
+        # Fetch DNSKEY records
+        query = DNSPacket.newQuery(cur_domain, DNSPacket.RR_TYPE_DNSKEY, using_dnssec=True)
+        connection.sendPacket(resolver_address, query)
+        dnskey_response = connection.waitForPacket()
+
+        # Pull keys from the response
+        keys = get_keys(dnskey_response)
+        if len(keys) == 0:
+            return False
+        dprint("\nFound {0} keys".format(len(keys)))
+
+        if find_ds_match(cur_domain, ds_records, keys) is None:
+            dprint("ERROR: Unable to validate any DNSKEY with parent zone")
+            return False
+        chain.append((cur_domain, keys, get_rrsigs(dnskey_response), ds_records, get_rrsigs(ds_response)))
+
+    if chain_cache is not None:
+        chain.reverse()
+        chain_cache.put_chain(chain, parent_expires)
+    return True
+
+
+def get_zone_keys(connection, zone, resolver_address, chain_cache):
+    """
+    Gets the DNSKEYs of a zone and the RRSIGs over them, from the chain cache if verify_zone already fetched them
+    :param connection: A UDPConnection to use
+    :param zone: The zone name
+    :param resolver_address: The resolver address
+    :param chain_cache: The ChainCache
+    :return: Tuple of (list of DNSKEY records, list of RRSIG records)
+    """
+    entry = chain_cache.get(zone)
+    if entry is not None:
+        return entry.keys, entry.key_rrsigs
+    dnskey_response = get_packet(connection, zone, resolver_address, DNSPacket.RR_TYPE_DNSKEY)
+    dprint("\nDNSKEY Record Response packet:")
+    return get_keys(dnskey_response), get_rrsigs(dnskey_response)
@@ -0,0 +1,180 @@
+"""
+A DNSSEC validator for embedding in long running programs. It keeps its socket and caches between lookups,
+and reports every outcome as a ValidationResult instead of printing or exiting
+"""
+
+import struct
+
+import util
+from cache import AnswerCache, ChainCache
+from DNSPacket import DNSError, DNSPacket
+from domain_name import DomainName
+from network import UDPCommunication
+from snapshot import load_snapshot, save_snapshot
+from util import dprint
+from validation import get_packet, get_rrset, get_rrsigs, get_zone_keys, validate_RRSET, verify_zone
+
+# Record type names the validator accepts -> type numbers
+RECORD_TYPES = {"A": DNSPacket.RR_TYPE_A, "DNSKEY": DNSPacket.RR_TYPE_DNSKEY, "DS": DNSPacket.RR_TYPE_DS}
+
+# Lookup statuses. Missing records are reported as 'MISSING-<type>' (EX: 'MISSING-A'), and error response
+# codes by their short name from DNSPacket.RCODE_STATUS (EX: 'SERVFAIL'). RRSIGs which don't verify, including
+# ones outside their validity period, are INVALID_RRSIG
+VALID = 'VALID'
+INVALID_RRSIG = 'INVALID-RRSIG'
+MISSING_DS = 'MISSING-DS'
+MISSING_DNSKEY = 'MISSING-DNSKEY'
+MISSING_RRSIG = 'MISSING-RRSIG'
+NOTFOUND = 'NOTFOUND'
+NORESPONSE = 'NORESPONSE'
+NOT_SUPPORTED = 'NOT-SUPPORTED'
+# A response too broken to read
+MALFORMED = 'MALFORMED'
+
+
+class ValidationResult:
+    """
+    The outcome of validating one RRset
+    """
+    __slots__ = ('name', 'type', 'status', 'rr_set', 'rrsig')
+
+    def __init__(self, name, type, status, rr_set=(), rrsig=None):
+        """
+        :param name: The domain name
+        :param type: The record type number
+        :param status: VALID, or an error status (EX: MISSING_DS, INVALID_RRSIG, NOTFOUND)
+        :param rr_set: The records found, which may be there even when they didn't validate
+        :param rrsig: The RRSIG that validated them, or None
+        """
+        self.name = name
+        self.type = type
+        self.status = status
+        self.rr_set = list(rr_set)
+        self.rrsig = rrsig
+
+    @property
+    def valid(self):
+        return self.status == VALID
+
+    def __repr__(self):
+        return "ValidationResult({0!r}, {1!r}, {2!r}, {3} records)".format(
+            self.name, self.type, self.status, len(self.rr_set))
+
+
+class Validator:
+    """
+    Fetches and validates RRsets through one resolver. The socket, chain cache and answer cache live as long
+    as the Validator, so later lookups skip whatever earlier ones already validated
+    """
+
+    def __init__(self, resolver_address, connection=None, chain_cache=None, answer_cache=None, cache_file=None):
+        """
+        :param resolver_address: The (host, port) of the resolver, or an UpstreamPool
+        :param connection: The UDPCommunication to use. One is opened if not given
+        :param chain_cache: The ChainCache to use. An empty one if not given
+        :param answer_cache: The AnswerCache to use. An empty one if not given
+        :param cache_file: Optional snapshot file to load the chain cache from, and save it to with save()
+        """
+        self.resolver_address = resolver_address
+        self.connection = connection if connection is not None else UDPCommunication()
+        self.chain_cache = chain_cache if chain_cache is not None else ChainCache()
+        self.answer_cache = answer_cache if answer_cache is not None else AnswerCache()
+        self.cache_file = cache_file
+        if cache_file:
+            dprint("Loaded {0} zones from {1}".format(load_snapshot(cache_file, self.chain_cache), cache_file))
+
+    def validate(self, domain_name, query_type):
+        """
+        Fetches and validates one RRset
+        :param domain_name: The domain name to query for
+        :param query_type: The record type, as a number or a name from RECORD_TYPES (EX: 'A')
+        :return: A ValidationResult
+        """
+        if isinstance(query_type, str):
+            if query_type.upper() not in RECORD_TYPES:
+                return ValidationResult(domain_name, query_type, NOT_SUPPORTED)
+            query_type = RECORD_TYPES[query_type.upper()]
+        elif query_type not in RECORD_TYPES.values():
+            return ValidationResult(domain_name, query_type, NOT_SUPPORTED)
+
+        # A cached answer was already validated, so there is no network or crypto work left to do
+        answer = self.answer_cache.get(domain_name, query_type)
+        if answer is not None:
+            return ValidationResult(domain_name, query_type, VALID if answer.valid else INVALID_RRSIG,
+                                    answer.rr_set, answer.rrsig)
+        try:
+            return self._validate(domain_name, query_type)
+        except DNSError as error:
+            return ValidationResult(domain_name, query_type, error.status)
+        except OSError as error:
+            dprint("Lookup of {0} failed: {1!r}".format(domain_name, error))
+            return ValidationResult(domain_name, query_type, NORESPONSE)
+        except (ValueError, IndexError, struct.error) as error:
+            dprint("Malformed response looking up {0}: {1!r}".format(domain_name, error))
+            return ValidationResult(domain_name, query_type, MALFORMED)
+
+    def _validate(self, domain_name, query_type):
+        connection = self.connection
+        resolver_address = self.resolver_address
+        # Regardless of query type, we need to verify the chain of trust
+        if not verify_zone(domain_name, connection, resolver_address, self.chain_cache):
+            return ValidationResult(domain_name, query_type, MISSING_DS)
+
+        if query_type == DNSPacket.RR_TYPE_DNSKEY:
+            dprint("\n\n\nGetting Keys:")
+            rr_set, rrsig_set = get_zone_keys(connection, domain_name, resolver_address, self.chain_cache)
+            keys = rr_set
+            if len(rr_set) == 0:
+                return ValidationResult(domain_name, query_type, MISSING_DNSKEY)
+        else:
+            dprint("\n\n\nGetting {0} records:".format(DNSPacket.record_type_name[query_type]))
+            response = get_packet(connection, domain_name, resolver_address, query_type)
+            response.print()
+            if util.debug_print_enabled:
+                response.dump()
+            rr_set = get_rrset(response)
+            rrsig_set = get_rrsigs(response)
+            if len(rr_set) == 0:
+                return ValidationResult(domain_name, query_type, 'MISSING-' + DNSPacket.record_type_name[query_type])
+        if len(rrsig_set) == 0:
+            return ValidationResult(domain_name, query_type, MISSING_RRSIG, rr_set)
+
+        if query_type != DNSPacket.RR_TYPE_DNSKEY:
+            # DS records are signed by the parent zone, everything else by the zone itself
+            signer_zone = domain_name
+            if query_type == DNSPacket.RR_TYPE_DS:
+                signer_zone = DomainName.get(domain_name).parent
+            keys, _ = get_zone_keys(connection, signer_zone, resolver_address, self.chain_cache)
+            if len(keys) == 0:
+                return ValidationResult(domain_name, query_type, MISSING_DNSKEY, rr_set)
+
+        associated_rrsig = validate_RRSET(keys, rrsig_set, rr_set, domain_name)
+        self.answer_cache.put(domain_name, query_type, rr_set, associated_rrsig, associated_rrsig is not None)
+        return ValidationResult(domain_name, query_type, VALID if associated_rrsig is not None else INVALID_RRSIG,
+                                rr_set, associated_rrsig)
+
+    def validate_many(self, queries):
+        """
+        Validates a sequence of lookups, one after another
+        :param queries: An iterable of (domain name, record type) tuples
+        :return: A generator of ValidationResults, in order
+        """
+        for domain_name, query_type in queries:
+            yield self.validate(domain_name, query_type)
+
+    def save(self):
+        """
+        Writes the chain cache to the cache file, if there is one
+        :return: None
+        """
+        if self.cache_file:
+            save_snapshot(self.cache_file, self.chain_cache)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
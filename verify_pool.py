@@ -0,0 +1,99 @@
+"""
+Spreads signature checks across a pool of worker processes, for validating big batches of names where the
+RSA math, not the network, is what takes the time
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import crypto
+
+
+class _PackedKey:
+    """
+    Just enough of a DNSKEY record to build a verifier from, and cheap to send to a worker
+    """
+    __slots__ = ('rdata', 'algorithm', 'key')
+
+    def __init__(self, rdata):
+        self.rdata = rdata
+        self.algorithm = rdata[3]
+        self.key = rdata[4:]
+
+
+def _verify_job(job):
+    """
+    Runs one signature check inside a worker. Each worker has its own copy of the crypto module, so the
+    key objects stay cached in the worker between jobs
+    :param job: Tuple of (signature, DNSKEY rdata, signed data)
+    :return: True if the signature is good, false otherwise
+    """
+    signature, rdata, data = job
+    return crypto.verify_signature(signature, _PackedKey(rdata), data)
+
+
+def _job(signature, key, data):
+    return bytes(signature), bytes(key.rdata), bytes(data)
+
+
+class VerificationExecutor:
+    """
+    Collects pending (signature, key, data) checks and runs them across a process pool. Verdicts come back
+    in the order the checks were submitted
+    """
+    # Jobs sent to a worker at a time, so each round trip to the pool does a useful amount of work
+    CHUNK_SIZE = 16
+
+    def __init__(self, workers=None):
+        """
+        :param workers: Number of worker processes, one per core by default
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+        self.jobs = []
+
+    def submit(self, signature, key, data):
+        """
+        Queues a signature check
+        :param signature: The signature
+        :param key: The DNSKEY record
+        :param data: The signed data, as bytes (see crypto.createRRSetData)
+        :return: Position of the verdict in the list run returns
+        """
+        self.jobs.append(_job(signature, key, data))
+        return len(self.jobs) - 1
+
+    def run(self):
+        """
+        Runs every queued check
+        :return: A list of verdicts, one per submitted check, in order
+        """
+        jobs, self.jobs = self.jobs, []
+        return self._run_jobs(jobs)
+
+    def verify_many(self, checks):
+        """
+        Runs a list of checks straight away. Checks queued with submit are left queued for run
+        :param checks: An iterable of (signature, key, data) tuples
+        :return: A list of verdicts, one per check, in order
+        """
+        return self._run_jobs([_job(signature, key, data) for signature, key, data in checks])
+
+    def _run_jobs(self, jobs):
+        if len(jobs) == 0:
+            return []
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        return list(self.pool.map(_verify_job, jobs, chunksize=VerificationExecutor.CHUNK_SIZE))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        self.jobs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()